@@ -1,46 +1,2121 @@
+import atexit
+import base64
+import copy
+import gzip
+import hashlib
+import hmac
+import html
+import importlib
 import json
+import logging
+import math
 import os
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
 from datetime import datetime
 from functools import wraps
+from types import SimpleNamespace
 
-import groq
-from flask import Flask, render_template, request, jsonify, g
+import msgpack
+from flask import Flask, Response, render_template, request, jsonify, g, has_request_context, stream_with_context
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, auth, firestore, initialize_app
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _LazyModule:
+    """Module proxy that imports the real module on first attribute access."""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+# Ciężkie SDK (gRPC, protobuf, httpx) ładujemy dopiero przy pierwszym użyciu - szybszy cold start
+groq = _LazyModule('groq')
+httpx = _LazyModule('httpx')
+firebase_admin = _LazyModule('firebase_admin')
+credentials = _LazyModule('firebase_admin.credentials')
+auth = _LazyModule('firebase_admin.auth')
+firestore = _LazyModule('firebase_admin.firestore')
+google_exceptions = _LazyModule('google.api_core.exceptions')
+
+load_dotenv()
+app = Flask(__name__, static_folder='static', template_folder='templates')
+
+# LOG_LEVEL=DEBUG włącza szczegółowe logi per dokument (domyślnie wyłączone)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(message)s')
+log = logging.getLogger('flowmind')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{escaped}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Counter:
+    """Prometheus counter with optional labels."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def values(self):
+        """Snapshot of all series keyed by their label values (in label-name order)."""
+        with self._lock:
+            return {tuple(value for name, value in key): count for key, count in self._values.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Prometheus histogram with cumulative buckets and optional labels."""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_format_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", "+Inf"),))} {series["count"]}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {series["count"]}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('flowmind_request_duration_seconds', 'HTTP request latency by endpoint.')
+PHASE_SECONDS = Histogram('flowmind_phase_duration_seconds', 'Time spent in a request phase (auth, prompt, groq, parse, firestore).')
+LLM_TOKENS = Counter('flowmind_llm_tokens_total', 'Tokens reported by chat_completion.usage.')
+LLM_CALLS = Counter('flowmind_llm_calls_total', 'Groq chat completion calls by outcome.')
+LLM_ADMISSIONS = Counter('flowmind_llm_admissions_total', 'LLM scheduler decisions (admitted, rate_limited, queue_full, deadline).')
+LLM_RESILIENCE = Counter('flowmind_llm_resilience_events_total', 'Hedges, fallbacks, timeouts and circuit breaker events by model.')
+LLM_QUEUE_WAIT = Histogram('flowmind_llm_queue_wait_seconds', 'Time LLM calls waited for a scheduler slot.')
+FIRESTORE_OPS = Counter('flowmind_firestore_operations_total', 'Firestore operations by kind and outcome.')
+EXPANSION_HYDRATIONS = Counter('flowmind_expansion_hydrations_total', 'Cached expansions attached to a response by subtree hydration.')
+METRICS = [REQUEST_SECONDS, PHASE_SECONDS, LLM_TOKENS, LLM_CALLS, LLM_ADMISSIONS, LLM_QUEUE_WAIT, LLM_RESILIENCE,
+           FIRESTORE_OPS, EXPANSION_HYDRATIONS]
+
+
+class timed:
+    """Context manager / decorator measuring one phase of the current request.
+
+    The duration goes to PHASE_SECONDS and, inside a request, to g.timings so
+    it can be logged and sent back in the Server-Timing header.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        endpoint = request.endpoint if has_request_context() else 'background'
+        PHASE_SECONDS.observe(elapsed, phase=self.phase, endpoint=endpoint or 'unknown')
+        if has_request_context() and hasattr(g, 'timings'):
+            g.timings[self.phase] = g.timings.get(self.phase, 0.0) + elapsed
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.phase):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def firestore_op(kind):
+    """Decorator timing a storage helper as a Firestore read or write and counting its outcome."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(f'firestore_{kind}'):
+                try:
+                    result = func(*args, **kwargs)
+                except Exception:
+                    FIRESTORE_OPS.inc(kind=kind, outcome='error')
+                    raise
+            FIRESTORE_OPS.inc(kind=kind, outcome='ok')
+            return result
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(chat_completion, model):
+    usage = getattr(chat_completion, 'usage', None)
+    if usage is None:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        value = getattr(usage, kind, None)
+        if value:
+            LLM_TOKENS.inc(value, kind=kind.split('_')[0], model=model)
+            if has_request_context() and hasattr(g, 'tokens'):
+                g.tokens[kind] = g.tokens.get(kind, 0) + value
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.timings = {}
+    g.tokens = {}
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    if g.timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{phase};dur={duration * 1000:.1f}' for phase, duration in g.timings.items()
+        )
+    if endpoint not in ('metrics', 'static'):
+        log.info(json.dumps({
+            'endpoint': endpoint,
+            'method': request.method,
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 1),
+            'phases': {phase: round(duration * 1000, 1) for phase, duration in g.timings.items()},
+            'tokens': g.tokens or None,
+            'user': getattr(g, 'user_id', None)
+        }))
+    return response
+
+
+# Odpowiedzi z ETagiem (304 przy If-None-Match) i próg kompresji odpowiedzi JSON
+ETAG_ENDPOINTS = {'get_map', 'get_maps'}
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+
+
+@app.after_request
+def _conditional_and_compressed(response):
+    """Answer unchanged map reads with 304 and compress large JSON bodies (br when installed, else gzip).
+
+    The weak ETag is computed from the uncompressed body, so it is the same
+    for every Content-Encoding. Registered after the metrics hook, so it
+    runs first and the logged status is the final one.
+    """
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return response
+    if request.endpoint in ETAG_ENDPOINTS and request.method in ('GET', 'HEAD'):
+        response.add_etag(weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if response.mimetype != 'application/json' or 'Content-Encoding' in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    with timed('compress'):
+        response.set_data(_compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Konfiguracja z Twoim ID projektu
+firebase_config = {'projectId': 'ai-mind-mapper'}
+
+
+class ServiceClients:
+    """Firebase app, Firestore client and Groq client, created on first use.
+
+    Nothing is initialized at import time, so a worker can answer /healthz
+    before credential discovery and gRPC setup have finished. Each client is
+    created at most once, under a lock; the outcome is reported by status().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._firebase_state = 'pending'
+        self._db = None
+        self._groq = None
+        self.started = time.time()
+
+    def _init_firebase(self):
+        try:
+            if not firebase_admin._apps:
+                if os.path.exists("serviceAccountKey.json"):
+                    cred = credentials.Certificate("serviceAccountKey.json")
+                    firebase_admin.initialize_app(cred, firebase_config)
+                    log.info("✅ Init z serviceAccountKey.json")
+                elif os.path.exists("firebase-admin-key.json"):
+                    cred = credentials.Certificate("firebase-admin-key.json")
+                    firebase_admin.initialize_app(cred, firebase_config)
+                    log.info("✅ Init z firebase-admin-key.json")
+                else:
+                    # Fallback dla środowiska chmurowego (Render)
+                    firebase_admin.initialize_app(options=firebase_config)
+                    log.info("✅ Init default (cloud)")
+            self._db = firestore.client()
+        except ValueError as e:
+            self._db = firestore.client()
+            log.info(f"ℹ️ Firebase Admin already initialized: {e}")
+        except Exception as e:
+            log.warning(f"⚠️ WARNING: Firebase Admin failed to initialize: {e}")
+            log.info("ℹ️ The app will run without Firebase Admin authorization.")
+            log.warning("📝 REMINDER: Download serviceAccountKey.json from the Firebase console and add it to the project!")
+        self._firebase_state = 'ready' if self._db is not None else 'failed'
+        if self._db is not None:
+            threading.Thread(target=_cert_refresh_loop, name='auth-cert-refresh', daemon=True).start()
+
+    def ensure_firebase(self):
+        """Initialize the Firebase app and Firestore client once; return True when Firestore is usable."""
+        if self._firebase_state == 'pending':
+            with self._lock:
+                if self._firebase_state == 'pending':
+                    self._init_firebase()
+        return self._firebase_state == 'ready'
+
+    @property
+    def db(self):
+        self.ensure_firebase()
+        return self._db
+
+    @property
+    def groq(self):
+        if self._groq is None:
+            with self._lock:
+                if self._groq is None:
+                    self._groq = groq.Groq(
+                        api_key=os.getenv("GROQ_API_KEY"),
+                        max_retries=GROQ_MAX_RETRIES,
+                        http_client=groq.DefaultHttpxClient(
+                            limits=httpx.Limits(
+                                max_connections=GROQ_POOL_SIZE,
+                                max_keepalive_connections=GROQ_POOL_SIZE
+                            )
+                        )
+                    )
+        return self._groq
+
+    def status(self):
+        return {
+            'firebase': self._firebase_state,
+            'groq': 'ready' if self._groq is not None else 'pending',
+            'uptimeSeconds': round(time.time() - self.started, 1)
+        }
+
+
+clients = ServiceClients()
+
+
+def __getattr__(name):
+    # Zgodność wstecz: app.db / app.client dla skryptów spoza modułu
+    if name == 'db':
+        return clients.db
+    if name == 'client':
+        return clients.groq
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+GROQ_MODEL = "moonshotai/kimi-k2-instruct-0905"
+# Ponowienia robi warstwa llm_create (fallback, hedging) - SDK domyślnie ponawiałby po cichu
+GROQ_MAX_RETRIES = int(os.getenv('GROQ_MAX_RETRIES', 0))
+# Pula połączeń klienta Groq - przy workerach gthread (GUNICORN_THREADS) wszystkie wątki procesu dzielą jednego klienta
+GROQ_POOL_SIZE = int(os.getenv('GROQ_POOL_SIZE', 200))
+
+# Wersja promptów - podbij przy każdej zmianie treści promptu, żeby unieważnić cache
+PROMPT_VERSION = 1
+
+MAP_CACHE_SIZE = int(os.getenv('MAP_CACHE_SIZE', 256))
+MAP_CACHE_TTL = float(os.getenv('MAP_CACHE_TTL', 24 * 3600))
+MAP_CACHE_PATH = os.getenv('MAP_CACHE_PATH')
+
+_MISSING = object()
+
+
+class _Flight:
+    """A single in-progress computation that concurrent callers wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """Thread-safe LRU cache with TTL eviction, optional SQLite tier and single-flight loading.
+
+    Values must be JSON-serializable and are shared between callers, so they
+    must not be mutated after being stored. With max_bytes the memory tier is
+    also bounded by the size of its values: their JSON size, or whatever
+    `weigher` returns for memory-only caches of other values.
+    """
+
+    def __init__(self, name, max_size, ttl, disk_path=None, max_bytes=None, weigher=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_bytes = max_bytes
+        self.weigher = weigher or (lambda value: len(json.dumps(value, ensure_ascii=False).encode('utf-8')))
+        self._entries = OrderedDict()
+        self._weights = {}
+        self.bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        if disk_path:
+            try:
+                self._disk = sqlite3.connect(disk_path, timeout=5, check_same_thread=False)
+                self._disk.execute(
+                    'CREATE TABLE IF NOT EXISTS cache '
+                    '(name TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (name, key))'
+                )
+                self._disk.commit()
+            except sqlite3.Error as e:
+                log.warning(f"⚠️ Cache '{name}': disk tier disabled ({e})")
+                self._disk = None
+
+    def _get_memory(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires = entry
+        if expires <= now:
+            self._drop_memory(key)
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _drop_memory(self, key):
+        self._entries.pop(key, None)
+        self.bytes -= self._weights.pop(key, 0)
+
+    def _set_memory(self, key, value, expires):
+        self._drop_memory(key)
+        self._entries[key] = (value, expires)
+        if self.max_bytes:
+            weight = self.weigher(value)
+            self._weights[key] = weight
+            self.bytes += weight
+        while self._entries and (len(self._entries) > self.max_size
+                                 or (self.max_bytes and self.bytes > self.max_bytes)):
+            self._drop_memory(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _get_disk(self, key, now):
+        if self._disk is None:
+            return _MISSING, 0
+        try:
+            with self._disk_lock:
+                row = self._disk.execute(
+                    'SELECT value, expires FROM cache WHERE name = ? AND key = ?',
+                    (self.name, key)
+                ).fetchone()
+        except sqlite3.Error as e:
+            log.warning(f"⚠️ Cache '{self.name}': disk read failed: {e}")
+            return _MISSING, 0
+        if row is None or row[1] <= now:
+            return _MISSING, 0
+        return json.loads(row[0]), row[1]
+
+    def _set_disk(self, key, value, expires):
+        if self._disk is None:
+            return
+        try:
+            with self._disk_lock:
+                self._disk.execute(
+                    'INSERT OR REPLACE INTO cache (name, key, value, expires) VALUES (?, ?, ?, ?)',
+                    (self.name, key, json.dumps(value, ensure_ascii=False), expires)
+                )
+                self._disk.commit()
+        except sqlite3.Error as e:
+            log.warning(f"⚠️ Cache '{self.name}': disk write failed: {e}")
+
+    def get(self, key, default=None):
+        """Return the cached value for key (memory first, then disk) or default."""
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+        value, expires = self._get_disk(key, now)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.disk_hits += 1
+            self._set_memory(key, value, expires)
+        return value
+
+    def peek(self, key, default=None):
+        """Read the memory tier without touching hit/miss counters or LRU order."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                return default
+            return entry[0]
+
+    def __contains__(self, key):
+        return self.peek(key, _MISSING) is not _MISSING
+
+    def delete(self, key):
+        """Remove key from both tiers; return True if it was held in memory."""
+        with self._lock:
+            found = key in self._entries
+            self._drop_memory(key)
+        self._delete_disk(key)
+        return found
+
+    def clear(self):
+        """Drop every entry of this cache from both tiers; return how many were in memory."""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._weights.clear()
+            self.bytes = 0
+        self._delete_disk(None)
+        return count
+
+    def _delete_disk(self, key):
+        if self._disk is None:
+            return
+        try:
+            with self._disk_lock:
+                if key is None:
+                    self._disk.execute('DELETE FROM cache WHERE name = ?', (self.name,))
+                else:
+                    self._disk.execute('DELETE FROM cache WHERE name = ? AND key = ?', (self.name, key))
+                self._disk.commit()
+        except sqlite3.Error as e:
+            log.warning(f"⚠️ Cache '{self.name}': disk delete failed: {e}")
+
+    def set(self, key, value, expires_at=None):
+        expires = expires_at if expires_at is not None else time.time() + self.ttl
+        with self._lock:
+            self._set_memory(key, value, expires)
+        self._set_disk(key, value, expires)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value or compute it, running at most one compute per key at a time."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            value = self._get_memory(key, time.time())
+            if value is not _MISSING:
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = compute()
+            self.set(key, value)
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'diskHits': self.disk_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hitRate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'bytes': self.bytes if self.max_bytes else None,
+                'maxBytes': self.max_bytes,
+                'diskEnabled': self._disk is not None
+            }
+
+
+def normalize_topic(topic):
+    """Normalize a topic for cache lookups (Unicode NFC, collapsed whitespace)."""
+    return ' '.join(unicodedata.normalize('NFC', str(topic)).split())
+
+
+def make_cache_key(*parts):
+    """Build a stable hash key from JSON-serializable parts."""
+    raw = json.dumps(parts, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+map_cache = ResultCache('generate-map', MAP_CACHE_SIZE, MAP_CACHE_TTL, MAP_CACHE_PATH)
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 4096))
+AUTH_CERT_REFRESH_SECONDS = float(os.getenv('AUTH_CERT_REFRESH_SECONDS', 3600))
+
+# Zweryfikowane tokeny trzymamy tylko w pamięci - wpis wygasa razem z claimem 'exp'
+token_cache = ResultCache('auth-tokens', AUTH_TOKEN_CACHE_SIZE, 3600)
+
+
+def prefetch_token_certs():
+    """Fetch Google's ID-token signing certs so the verifier's HTTP cache is warm."""
+    from firebase_admin import _token_gen
+    verifier = auth._get_client(None)._token_verifier
+    verifier.request(url=_token_gen.ID_TOKEN_CERT_URI, method='GET')
+
+
+def _cert_refresh_loop():
+    while True:
+        try:
+            prefetch_token_certs()
+        except Exception as e:
+            log.warning(f"⚠️ Token cert prefetch failed: {e}")
+        time.sleep(AUTH_CERT_REFRESH_SECONDS)
+
+
+class GroqBackend:
+    """Chat completions served by the shared (pooled) Groq client."""
+
+    name = 'groq'
+
+    def create(self, **kwargs):
+        return clients.groq.chat.completions.create(**kwargs)
+
+    def stream(self, **kwargs):
+        return clients.groq.chat.completions.create(stream=True, **kwargs)
+
+
+# Fake LLM: opóźnienie log-normalne (mediana w ms, sigma) i rozmiar drzewa (stopień, głębokość)
+FAKE_LLM_LATENCY_MS = float(os.getenv('FAKE_LLM_LATENCY_MS', 800))
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv('FAKE_LLM_LATENCY_SIGMA', 0.5))
+FAKE_LLM_FANOUT = int(os.getenv('FAKE_LLM_FANOUT', 4))
+FAKE_LLM_DEPTH = int(os.getenv('FAKE_LLM_DEPTH', 3))
+FAKE_LLM_CHUNK_CHARS = int(os.getenv('FAKE_LLM_CHUNK_CHARS', 24))
+# Odsetek wywołań kończących się błędem (testy fallbacku i circuit breakera)
+FAKE_LLM_ERROR_RATE = float(os.getenv('FAKE_LLM_ERROR_RATE', 0))
+FAKE_LLM_SEED = int(os.getenv('FAKE_LLM_SEED', 0))
+
+
+class FakeLLMBackend:
+    """Deterministic local stand-in for Groq used by benchmarks and offline runs.
+
+    The reply shape is inferred from the prompt (whole map, node expansion,
+    packed sibling expansion or free-text explanation) and every random choice
+    is seeded from the prompt, so the same request always gets the same tree.
+    Latency is log-normal around `latency_ms` and, like the `error_rate`
+    failures, is drawn per call from a seeded stream, so duplicate requests
+    (hedges) see independent delays. Fanout varies between 1 and
+    2 * fanout - 1 per node.
+    """
+
+    name = 'fake'
+    _TOPIC_RE = re.compile(r'na temat: "(.*?)"')
+    _CONTEXT_RE = re.compile(r'Kontekst: "(.*?)"')
+    _SIBLING_RE = re.compile(r'^\s+(\d+)\. "', re.MULTILINE)
+    _EMOJIS = ['🧠', '💡', '📚', '🔬', '🌍', '🔧', '📈', '🎯', '⚙️', '🌱']
+
+    def __init__(self, latency_ms, latency_sigma, fanout, depth, chunk_chars, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.fanout = fanout
+        self.depth = depth
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self._calls = random.Random(seed)
+        self._calls_lock = threading.Lock()
+
+    def _rng(self, prompt):
+        return random.Random(hashlib.sha256(prompt.encode('utf-8')).digest())
+
+    def _sleep(self):
+        with self._calls_lock:
+            delay = self._calls.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma) \
+                if self.latency_ms > 0 else 0.0
+            failed = self._calls.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise RuntimeError('Fake LLM: injected upstream error')
+
+    def _node(self, rng, text, emojis):
+        if emojis:
+            return {'text': text, 'emoji': rng.choice(self._EMOJIS)}
+        return {'content': text}
+
+    def _children(self, rng, parent, depth, emojis):
+        count = rng.randint(1, max(1, 2 * self.fanout - 1))
+        nodes = []
+        for index in range(count):
+            node = self._node(rng, f'{parent} {index + 1}', emojis)
+            if depth > 1 and rng.random() < 0.7:
+                node['children'] = self._children(rng, f'{parent} {index + 1}', depth - 1, emojis)
+            nodes.append(node)
+        return nodes
+
+    def _reply(self, prompt, kwargs, rng):
+        if kwargs.get('response_format') is None:
+            return f'Wyjaśnienie ({len(prompt)} znaków promptu): ' + ' '.join(
+                f'zdanie {rng.randint(1, 1000)}.' for _ in range(self.fanout * 3))
+        emojis = '"emoji"' in prompt
+        if '"results"' in prompt:
+            siblings = self._SIBLING_RE.findall(prompt)
+            return json.dumps({'results': [
+                {'index': int(index), 'nodes': self._children(rng, f'Podpunkt {index}', 1, emojis)}
+                for index in siblings
+            ]}, ensure_ascii=False)
+        if '"nodes"' in prompt:
+            match = self._CONTEXT_RE.search(prompt)
+            last = match.group(1).split(' -> ')[-1] if match else 'Węzeł'
+            return json.dumps({'nodes': self._children(rng, last, 1, emojis)}, ensure_ascii=False)
+        match = self._TOPIC_RE.search(prompt)
+        topic = match.group(1) if match else 'Temat'
+        root = self._node(rng, topic, emojis)
+        root['children'] = self._children(rng, topic, self.depth, emojis)
+        return json.dumps(root, ensure_ascii=False)
+
+    def _completion(self, kwargs):
+        prompt = '\n'.join(message['content'] for message in kwargs.get('messages', []))
+        self._sleep()
+        content = self._reply(prompt, kwargs, self._rng(prompt))
+        finish_reason = 'stop'
+        max_tokens = kwargs.get('max_tokens')
+        if max_tokens and len(content) // 4 > max_tokens:
+            content, finish_reason = content[:max_tokens * 4], 'length'
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4)
+        return content, usage, finish_reason
+
+    def create(self, **kwargs):
+        content, usage, finish_reason = self._completion(kwargs)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish_reason)],
+            usage=usage
+        )
+
+    def stream(self, **kwargs):
+        content, usage, finish_reason = self._completion(kwargs)
+        for start in range(0, len(content), self.chunk_chars):
+            last = start + self.chunk_chars >= len(content)
+            yield SimpleNamespace(choices=[SimpleNamespace(
+                delta=SimpleNamespace(content=content[start:start + self.chunk_chars]),
+                finish_reason=finish_reason if last else None
+            )])
+
+
+# Backend LLM: 'groq' (produkcja) albo 'fake' (benchmarki, praca offline)
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'groq')
+
+if LLM_BACKEND == 'fake':
+    llm_backend = FakeLLMBackend(FAKE_LLM_LATENCY_MS, FAKE_LLM_LATENCY_SIGMA, FAKE_LLM_FANOUT,
+                                 FAKE_LLM_DEPTH, FAKE_LLM_CHUNK_CHARS, FAKE_LLM_ERROR_RATE, FAKE_LLM_SEED)
+    log.info(f"🧪 Using fake LLM backend (median latency {FAKE_LLM_LATENCY_MS:.0f} ms)")
+elif LLM_BACKEND == 'groq':
+    llm_backend = GroqBackend()
+else:
+    raise ValueError(f'Unknown LLM_BACKEND: {LLM_BACKEND}')
+
+
+# Kontrola dostępu do LLM: globalny limit równoległych wywołań + kubełki tokenów per użytkownik
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 16))
+LLM_QUEUE_MAX = int(os.getenv('LLM_QUEUE_MAX', 64))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 10))
+USER_RATE_PER_MINUTE = float(os.getenv('USER_RATE_PER_MINUTE', 30))
+USER_BURST = float(os.getenv('USER_BURST', 10))
+
+
+class AdmissionRejected(Exception):
+    """Raised when an LLM call is refused; carries the suggested Retry-After in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f'Zbyt wiele zapytań ({reason}), spróbuj ponownie za {retry_after} s')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    """Admission control in front of every LLM call.
+
+    At most `max_concurrency` calls run at once. Further callers wait in a
+    FIFO queue of at most `queue_max` entries and are shed with
+    AdmissionRejected once they have waited `queue_timeout` seconds. Freed
+    slots are handed directly to the oldest waiter. Per-user token buckets
+    (`rate_per_minute`, `burst`) are checked by the rate_limited decorator
+    before a request starts.
+    """
+
+    def __init__(self, max_concurrency, queue_max, queue_timeout, rate_per_minute, burst):
+        self.max_concurrency = max_concurrency
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+        self._buckets = {}
+        self._hold_seconds = 1.0
+
+    def _retry_after(self):
+        waiting = len(self._waiters) + 1
+        return max(1, math.ceil(self._hold_seconds * waiting / max(1, self.max_concurrency)))
+
+    def take_token(self, user_id, cost=1):
+        """Charge `cost` tokens (at most `burst`, see rate_limited) to the user's bucket or raise AdmissionRejected."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < cost:
+                self._buckets[user_id] = (tokens, now)
+                LLM_ADMISSIONS.inc(outcome='rate_limited')
+                wait = (cost - tokens) / self.rate if self.rate > 0 else 60
+                raise AdmissionRejected('rate_limited', max(1, math.ceil(wait)))
+            self._buckets[user_id] = (tokens - cost, now)
+            if len(self._buckets) > 10000:
+                idle = [uid for uid, (left, at) in self._buckets.items() if left + (now - at) * self.rate >= self.burst]
+                for uid in idle:
+                    del self._buckets[uid]
+
+    def acquire(self):
+        started = time.monotonic()
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                LLM_QUEUE_WAIT.observe(0.0)
+                LLM_ADMISSIONS.inc(outcome='admitted')
+                return
+            if len(self._waiters) >= self.queue_max:
+                LLM_ADMISSIONS.inc(outcome='queue_full')
+                raise AdmissionRejected('queue_full', self._retry_after())
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        waiter.wait(self.queue_timeout)
+        with self._lock:
+            if not waiter.is_set():
+                self._waiters.remove(waiter)
+                LLM_ADMISSIONS.inc(outcome='deadline')
+                raise AdmissionRejected('deadline', self._retry_after())
+        LLM_QUEUE_WAIT.observe(time.monotonic() - started)
+        LLM_ADMISSIONS.inc(outcome='admitted')
+
+    def try_acquire(self):
+        """Take a slot only if one is free right now (used for optional work such as hedges)."""
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                return True
+            return False
+
+    def release(self, held_seconds):
+        with self._lock:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held_seconds
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._active -= 1
+
+    def busy(self):
+        """True when every slot is taken and callers are already queuing."""
+        with self._lock:
+            return bool(self._waiters)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self._active,
+                'queued': len(self._waiters),
+                'maxConcurrency': self.max_concurrency,
+                'queueMax': self.queue_max,
+                'queueTimeoutSeconds': self.queue_timeout,
+                'avgCallSeconds': round(self._hold_seconds, 3),
+                'trackedUsers': len(self._buckets)
+            }
+
+
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_QUEUE_MAX, LLM_QUEUE_TIMEOUT,
+                             USER_RATE_PER_MINUTE, USER_BURST)
+
+
+@app.errorhandler(AdmissionRejected)
+def _admission_rejected(e):
+    response = jsonify({'error': str(e), 'reason': e.reason, 'retryAfter': e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def rate_limited(cost=None):
+    """Decorator charging the authenticated user's token bucket before an LLM-backed route runs.
+
+    `cost` may be a function of the parsed request body (any JSON value, or
+    None) returning how many LLM calls the request can make (default 1); it
+    runs before the route validates the body. A request costing more than
+    the whole bucket (USER_BURST) could never be admitted, so it is
+    rejected with 400. Use below @require_auth.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            amount = max(1, cost(request.get_json(silent=True)) if cost else 1)
+            if amount > llm_scheduler.burst:
+                return jsonify({'error': f'Zapytanie wymaga {amount} wywołań modelu (limit: {int(llm_scheduler.burst)})'}), 400
+            llm_scheduler.take_token(g.user_id, amount)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+# Budżety czasu na wywołanie LLM per endpoint (sekundy); nadpisanie: LLM_BUDGETS='{"expand_node": 6}'
+LLM_BUDGETS = {
+    'generate_map': 45, 'generate_map_stream': 60,
+    'expand_node': 10, 'expand_nodes': 20, 'expand_node_stream': 20,
+    'get_explanation': 25, 'get_explanation_stream': 40,
+    'background': 30
+}
+LLM_BUDGETS.update({name: float(value) for name, value in json.loads(os.getenv('LLM_BUDGETS', '{}')).items()})
+LLM_DEFAULT_BUDGET = float(os.getenv('LLM_DEFAULT_BUDGET', 30))
+LLM_HEDGE = os.getenv('LLM_HEDGE', '1') == '1'
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', 0.3))
+LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', 'llama-3.1-8b-instant')
+LLM_FALLBACK_SHARE = float(os.getenv('LLM_FALLBACK_SHARE', 0.3))
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+
+
+class LLMUnavailable(Exception):
+    """Raised when every candidate model is behind an open circuit breaker."""
+
+    status_code = 503
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMTimeout(LLMUnavailable):
+    """Raised when no LLM answer arrived within the endpoint's latency budget."""
+
+    status_code = 504
+
+
+@app.errorhandler(LLMUnavailable)
+def _llm_unavailable(e):
+    response = jsonify({'error': str(e), 'retryAfter': e.retry_after})
+    response.status_code = e.status_code
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+class CircuitBreaker:
+    """Per-model breaker: opens after `failures` consecutive errors and lets one probe through every `cooldown` seconds."""
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def available(self, model):
+        """Like allow(), but without taking the half-open probe."""
+        with self._lock:
+            state = self._state.get(model)
+            return state is None or state['opened'] is None or time.monotonic() - state['opened'] >= self.cooldown
+
+    def allow(self, model):
+        """Whether a call to model may start now; in half-open state this takes the single probe."""
+        with self._lock:
+            state = self._state.get(model)
+            if state is None or state['opened'] is None:
+                return True
+            if time.monotonic() - state['opened'] >= self.cooldown:
+                # Półotwarty: jedna próba, kolejna dopiero po następnym cooldownie
+                state['opened'] = time.monotonic()
+                return True
+            return False
+
+    def record(self, model, ok):
+        with self._lock:
+            state = self._state.setdefault(model, {'errors': 0, 'opened': None})
+            if ok:
+                state['errors'] = 0
+                state['opened'] = None
+                return
+            state['errors'] += 1
+            if state['errors'] >= self.failures and state['opened'] is None:
+                state['opened'] = time.monotonic()
+                LLM_RESILIENCE.inc(event='breaker_opened', model=model)
+                log.warning(f"⚠️ Circuit breaker opened for {model} after {state['errors']} errors")
+
+    def stats(self):
+        with self._lock:
+            return {model: {'consecutiveErrors': state['errors'], 'open': state['opened'] is not None}
+                    for model, state in self._state.items()}
+
+
+class LatencyTracker:
+    """Recent successful LLM latencies per endpoint; their p95 is the hedging delay."""
+
+    def __init__(self, window=200):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples = {}
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self._window)).append(seconds)
+
+    def p95(self, endpoint):
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def stats(self):
+        with self._lock:
+            endpoints = list(self._samples)
+        return {endpoint: self.p95(endpoint) for endpoint in endpoints}
+
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN)
+llm_latency = LatencyTracker()
+_llm_pool = ThreadPoolExecutor(max_workers=max(4, LLM_MAX_CONCURRENCY * 2), thread_name_prefix='llm')
+
+
+_llm_scope = threading.local()
+
+
+class llm_call_scope:
+    """Context manager giving llm_create/llm_stream an endpoint and deadline in threads without a request.
+
+    Worker threads of a request (e.g. expand_paths_batch jobs) enter the
+    caller's scope, so they use its budget and latency stats instead of
+    'background'.
+    """
+
+    def __init__(self, endpoint, deadline):
+        self.endpoint = endpoint
+        self.deadline = deadline
+
+    def __enter__(self):
+        self._previous = getattr(_llm_scope, 'current', None)
+        _llm_scope.current = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _llm_scope.current = self._previous
+        return False
+
+
+def _llm_endpoint():
+    scope = getattr(_llm_scope, 'current', None)
+    if scope is not None:
+        return scope.endpoint
+    return (request.endpoint if has_request_context() else None) or 'background'
+
+
+def _llm_deadline(endpoint):
+    deadline = time.monotonic() + LLM_BUDGETS.get(endpoint, LLM_DEFAULT_BUDGET)
+    scope = getattr(_llm_scope, 'current', None)
+    return min(deadline, scope.deadline) if scope is not None else deadline
+
+
+def _llm_models(model):
+    """Models to try in order: the requested one, then LLM_FALLBACK_MODEL.
+
+    Breakers are checked (llm_breaker.allow) only right before a model is
+    called, so a fallback that is never needed does not use up its
+    half-open probe.
+    """
+    return [candidate for candidate in dict.fromkeys((model, LLM_FALLBACK_MODEL)) if candidate]
+
+
+def _llm_allow(model):
+    if llm_breaker.allow(model):
+        return True
+    LLM_RESILIENCE.inc(event='breaker_rejected', model=model)
+    return False
+
+
+def _call_with_hedge(endpoint, kwargs, deadline):
+    """Run create() on the worker pool; once it outlives the endpoint's p95, race a duplicate against it.
+
+    The caller holds one scheduler slot for the first request. A hedge is
+    only sent when another slot is free, and every request releases its
+    slot when it really finishes, so losers still count against
+    LLM_MAX_CONCURRENCY.
+    """
+    model = kwargs['model']
+    started = time.monotonic()
+
+    def submit(hedge):
+        submitted = time.monotonic()
+        future = _llm_pool.submit(llm_backend.create, timeout=max(0.1, deadline - submitted), **kwargs)
+        future.add_done_callback(lambda f: llm_scheduler.release(time.monotonic() - submitted))
+        future.hedge = hedge
+        return future
+
+    pending = {submit(hedge=False)}
+    p95 = llm_latency.p95(endpoint) if LLM_HEDGE else None
+    hedge_at = started + max(LLM_HEDGE_MIN_DELAY, p95) if p95 is not None else None
+    error = None
+    while pending:
+        now = time.monotonic()
+        if now >= deadline:
+            LLM_RESILIENCE.inc(event='timeout', model=model)
+            raise LLMTimeout(f'Model {model} nie odpowiedział w wyznaczonym czasie')
+        until = min(hedge_at, deadline) if hedge_at is not None else deadline
+        done, pending = wait_futures(pending, timeout=until - now, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future.hedge:
+                    LLM_RESILIENCE.inc(event='hedge_won', model=model)
+                llm_latency.observe(endpoint, time.monotonic() - started)
+                return future.result()
+            error = future.exception()
+        if pending and hedge_at is not None and time.monotonic() >= hedge_at:
+            hedge_at = None
+            if llm_scheduler.try_acquire():
+                pending.add(submit(hedge=True))
+                LLM_RESILIENCE.inc(event='hedge_sent', model=model)
+    raise error
+
+
+def llm_create(**kwargs):
+    """Call chat.completions.create within the endpoint's latency budget.
+
+    Goes through the scheduler, hedges slow calls and, when the requested
+    model errors, times out or has an open breaker, retries on
+    LLM_FALLBACK_MODEL. The first model may use only part of the budget so
+    the fallback still has LLM_FALLBACK_SHARE of it left.
+    """
+    endpoint = _llm_endpoint()
+    deadline = _llm_deadline(endpoint)
+    requested = kwargs.get('model', GROQ_MODEL)
+    models = _llm_models(requested)
+    error = LLMUnavailable('Żaden model LLM nie jest obecnie dostępny', math.ceil(LLM_BREAKER_COOLDOWN))
+    for index, model in enumerate(models):
+        if not _llm_allow(model):
+            continue
+        if model != requested:
+            LLM_RESILIENCE.inc(event='fallback', model=model)
+        with timed('llm_queue'):
+            llm_scheduler.acquire()
+        now = time.monotonic()
+        # Część budżetu zostawiamy na fallback, o ile jego breaker w ogóle go dopuści
+        has_fallback = any(llm_breaker.available(other) for other in models[index + 1:])
+        attempt_deadline = now + (deadline - now) * (1 - LLM_FALLBACK_SHARE) if has_fallback else deadline
+        if now >= deadline:
+            llm_scheduler.release(0.0)
+            LLM_RESILIENCE.inc(event='timeout', model=model)
+            error = LLMTimeout(f'Model {model} nie odpowiedział w wyznaczonym czasie')
+            break
+        try:
+            with timed('groq'):
+                chat_completion = _call_with_hedge(endpoint, dict(kwargs, model=model), attempt_deadline)
+        except Exception as e:
+            llm_breaker.record(model, ok=False)
+            LLM_CALLS.inc(model=model, outcome='timeout' if isinstance(e, LLMTimeout) else 'error')
+            log.warning(f"⚠️ LLM call to {model} failed ({endpoint}): {e}")
+            error = e
+            continue
+        llm_breaker.record(model, ok=True)
+        LLM_CALLS.inc(model=model, outcome='ok')
+        record_llm_usage(chat_completion, model)
+        return chat_completion
+    raise error
+
+
+def llm_stream(**kwargs):
+    """Yield streamed completion chunks, holding a scheduler slot until the stream ends.
+
+    Streams are not hedged; the breaker still picks the model and the
+    endpoint budget is passed to the backend as its request timeout.
+    """
+    endpoint = _llm_endpoint()
+    requested = kwargs.get('model', GROQ_MODEL)
+    model = next((candidate for candidate in _llm_models(requested) if _llm_allow(candidate)), None)
+    if model is None:
+        raise LLMUnavailable('Żaden model LLM nie jest obecnie dostępny', math.ceil(LLM_BREAKER_COOLDOWN))
+    if model != requested:
+        LLM_RESILIENCE.inc(event='fallback', model=model)
+    with timed('llm_queue'):
+        llm_scheduler.acquire()
+    started = time.monotonic()
+    try:
+        stream = llm_backend.stream(timeout=max(0.1, _llm_deadline(endpoint) - started), **dict(kwargs, model=model))
+        LLM_CALLS.inc(model=model, outcome='stream')
+        for chunk in stream:
+            yield chunk
+        llm_breaker.record(model, ok=True)
+    except GeneratorExit:
+        raise
+    except Exception:
+        llm_breaker.record(model, ok=False)
+        raise
+    finally:
+        llm_scheduler.release(time.monotonic() - started)
+
+
+def llm_resilience_stats():
+    return {
+        'budgets': LLM_BUDGETS,
+        'fallbackModel': LLM_FALLBACK_MODEL or None,
+        'hedging': LLM_HEDGE,
+        'hedgeDelaySeconds': {endpoint: round(p95, 3) if p95 is not None else None
+                              for endpoint, p95 in llm_latency.stats().items()},
+        'breakers': llm_breaker.stats(),
+        'events': {f'{event}:{model}': value for (event, model), value in LLM_RESILIENCE.values().items()}
+    }
+
+
+MAP_SUMMARY_FIELDS = ['title', 'name', 'createdAt', 'lastUpdated', 'content.content', 'mapData.content', 'mapStructure.content']
+
+
+def encode_page_cursor(doc_id, last_updated):
+    raw = json.dumps({'id': doc_id, 't': last_updated.isoformat() if last_updated else None})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(cursor):
+    """Decode a listing cursor into the start_after field values; raise ValueError if malformed."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return {'lastUpdated': datetime.fromisoformat(raw['t']), '__name__': str(raw['id'])}
+    except (KeyError, TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f'Nieprawidłowy kursor: {e}')
+
+
+def _maps_page_query(maps_ref, limit, cursor, summary):
+    query = maps_ref.order_by('lastUpdated', direction=firestore.Query.DESCENDING) \
+        .order_by('__name__', direction=firestore.Query.DESCENDING)
+    if summary:
+        query = query.select(MAP_SUMMARY_FIELDS)
+    if cursor:
+        query = query.start_after(decode_page_cursor(cursor))
+    return query.limit(limit)
+
+
+def resolve_map_title(doc_id, map_data):
+    """Pick a display title from any of the known document layouts."""
+    if map_data.get('title'):
+        return map_data['title']
+    if map_data.get('name'):
+        return map_data['name']
+    for field in ('content', 'mapData', 'mapStructure'):
+        value = map_data.get(field)
+        if isinstance(value, dict) and value.get('content'):
+            return str(value['content'])
+    if isinstance(map_data.get('content'), str) and map_data['content']:
+        return map_data['content']
+    return f'Mapa {doc_id[:8]}'
+
+
+# Format zapisu drzewa: 'legacy' (content + mapData) albo 'packed' (jeden skompresowany blob)
+MAP_STORAGE_FORMAT = os.getenv('MAP_STORAGE_FORMAT', 'legacy')
+MAP_CODEC_MAGIC = b'FMT'
+MAP_CODEC_VERSION = 1
+MAP_CODEC_HEADER = struct.Struct('>3sBI')
+MAP_CODEC_LEVEL = int(os.getenv('MAP_CODEC_LEVEL', 6))
+# Limit rozmiaru po dekompresji chroni przed "bombami" zlib
+MAP_CODEC_MAX_RAW_BYTES = int(os.getenv('MAP_CODEC_MAX_RAW_BYTES', 16 * 1024 * 1024))
+
+
+def encode_map_tree(tree):
+    """Encode a map tree as header + zlib(msgpack(tree)).
+
+    The header holds the magic bytes, the codec version and the length of the
+    uncompressed msgpack payload.
+    """
+    raw = msgpack.packb(tree, use_bin_type=True)
+    return MAP_CODEC_HEADER.pack(MAP_CODEC_MAGIC, MAP_CODEC_VERSION, len(raw)) + zlib.compress(raw, MAP_CODEC_LEVEL)
+
+
+def decode_map_tree(blob):
+    """Decode a blob produced by encode_map_tree; raise ValueError if it is not one."""
+    blob = bytes(blob)
+    if len(blob) < MAP_CODEC_HEADER.size:
+        raise ValueError('Zbyt krótki blob mapy')
+    magic, version, raw_length = MAP_CODEC_HEADER.unpack_from(blob)
+    if magic != MAP_CODEC_MAGIC:
+        raise ValueError('Nieznany format bloba mapy')
+    if version != MAP_CODEC_VERSION:
+        raise ValueError(f'Nieobsługiwana wersja bloba mapy: {version}')
+    if raw_length > MAP_CODEC_MAX_RAW_BYTES:
+        raise ValueError('Blob mapy przekracza dopuszczalny rozmiar')
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(blob[MAP_CODEC_HEADER.size:], raw_length + 1)
+    if len(raw) != raw_length or not decompressor.eof:
+        raise ValueError('Uszkodzony blob mapy')
+    return msgpack.unpackb(raw, raw=False)
+
+
+def extract_map_tree(map_data):
+    """Return the map tree from any stored layout (packedTree, mapData, mapStructure, content).
+
+    The packed blob is only decoded here, so callers that never need the
+    tree (e.g. summary listings) never pay for decompression.
+    """
+    if map_data.get('packedTree') is not None:
+        return decode_map_tree(map_data['packedTree'])
+    for field in ('mapData', 'mapStructure', 'content'):
+        if map_data.get(field) is not None:
+            return map_data[field]
+    return None
+
+
+def map_tree_fields(tree, for_update=False):
+    """Build the document fields that store tree in the configured MAP_STORAGE_FORMAT."""
+    if MAP_STORAGE_FORMAT != 'packed':
+        return {'content': tree, 'mapData': tree}
+    fields = {'packedTree': encode_map_tree(tree), 'storageVersion': MAP_CODEC_VERSION}
+    if for_update:
+        fields['content'] = firestore.DELETE_FIELD
+        fields['mapData'] = firestore.DELETE_FIELD
+    return fields
+
+
+def unpack_map_document(map_data):
+    """Replace a packedTree blob with the decoded tree under 'content' for API responses."""
+    if 'packedTree' in map_data:
+        map_data['content'] = decode_map_tree(map_data.pop('packedTree'))
+    return map_data
+
+
+class JsonPatchError(ValueError):
+    """Raised for malformed or inapplicable RFC 6902 patch operations."""
+
+
+class JsonPatchTestFailed(JsonPatchError):
+    """Raised when a 'test' operation does not match the current document."""
+
+
+class RevisionConflict(Exception):
+    """Raised when a patch targets a revision older than the stored one."""
+
+    def __init__(self, current_revision):
+        super().__init__(f'Nieaktualna rewizja mapy (aktualna: {current_revision})')
+        self.current_revision = current_revision
+
+
+class MapNotFound(LookupError):
+    """Raised by a batch write when one of its maps no longer exists."""
+
+
+def _parse_json_pointer(pointer):
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise JsonPatchError(f'Nieprawidłowy JSON Pointer: {pointer!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _resolve_parent(document, tokens):
+    """Return the container holding the last token of a pointer."""
+    target = document
+    for token in tokens[:-1]:
+        target = _resolve_child(target, token)
+    return target
+
+
+def _resolve_child(container, token):
+    if isinstance(container, dict):
+        if token not in container:
+            raise JsonPatchError(f'Brak klucza: {token}')
+        return container[token]
+    if isinstance(container, list):
+        index = _list_index(container, token, allow_end=False)
+        return container[index]
+    raise JsonPatchError(f'Nie można wejść w wartość skalarną przy: {token}')
+
+
+def _list_index(container, token, allow_end):
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchError(f'Nieprawidłowy indeks listy: {token}')
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JsonPatchError(f'Indeks poza zakresem: {token}')
+    return index
+
+
+def _patch_get(document, tokens):
+    target = document
+    for token in tokens:
+        target = _resolve_child(target, token)
+    return target
+
+
+def _patch_add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, tokens[-1], allow_end=True), value)
+    else:
+        raise JsonPatchError('Cel operacji add nie jest kontenerem')
+    return document
+
+
+def _patch_remove(document, tokens):
+    if not tokens:
+        raise JsonPatchError('Nie można usunąć korzenia mapy')
+    parent = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise JsonPatchError(f'Brak klucza: {tokens[-1]}')
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, tokens[-1], allow_end=False))
+    raise JsonPatchError('Cel operacji remove nie jest kontenerem')
+
+
+def apply_json_patch(document, operations):
+    """Apply RFC 6902 operations to document (mutated in place) and return the result."""
+    if not isinstance(operations, list):
+        raise JsonPatchError('Patch musi być listą operacji')
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise JsonPatchError('Każda operacja musi mieć pola op i path')
+        op = operation['op']
+        tokens = _parse_json_pointer(operation['path'])
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise JsonPatchError(f'Operacja {op} wymaga pola value')
+        if op in ('move', 'copy') and 'from' not in operation:
+            raise JsonPatchError(f'Operacja {op} wymaga pola from')
+
+        if op == 'add':
+            document = _patch_add(document, tokens, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _patch_remove(document, tokens)
+        elif op == 'replace':
+            _patch_get(document, tokens)
+            if tokens:
+                _patch_remove(document, tokens)
+            document = _patch_add(document, tokens, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            source = _parse_json_pointer(operation['from'])
+            if tokens[:len(source)] == source and tokens != source:
+                raise JsonPatchError('Nie można przenieść węzła do jego potomka')
+            value = _patch_remove(document, source) if source else document
+            document = _patch_add(document, tokens, value)
+        elif op == 'copy':
+            value = copy.deepcopy(_patch_get(document, _parse_json_pointer(operation['from'])))
+            document = _patch_add(document, tokens, value)
+        elif op == 'test':
+            if _patch_get(document, tokens) != operation['value']:
+                raise JsonPatchTestFailed(f"Test nie powiódł się dla {operation['path']}")
+        else:
+            raise JsonPatchError(f'Nieobsługiwana operacja: {op}')
+    return document
+
+
+# Limity sprawdzamy na drzewie po patchu (z uwzględnieniem zapisanej mapy), nie na pojedynczych wartościach
+_NO_TREE_LIMITS = {'max_nodes': math.inf, 'max_depth': math.inf, 'max_text_chars': math.inf}
+
+
+def normalize_patch_values(operations):
+    """Return a copy of operations whose add/replace values are already in stored (normalized) form.
+
+    Node objects and 'children' lists go through normalize_tree, '/content'
+    strings are stripped, so the client can copy the values back into its
+    tree and later 'test' operations match what was saved.
+    """
+    if not isinstance(operations, list):
+        return operations
+    normalized = []
+    for operation in operations:
+        if isinstance(operation, dict) and operation.get('op') in ('add', 'replace') and 'value' in operation:
+            path = operation.get('path')
+            value = operation['value']
+            if isinstance(value, dict):
+                value = normalize_tree(copy.deepcopy(value), strict=True, **_NO_TREE_LIMITS)
+            elif isinstance(value, list) and isinstance(path, str) and path.endswith('/children'):
+                value = normalize_tree({'content': '', 'children': copy.deepcopy(value)}, strict=True,
+                                       **_NO_TREE_LIMITS)['children']
+            elif isinstance(value, str) and isinstance(path, str) and path.endswith('/content'):
+                value = value.strip()
+            operation = dict(operation, value=value)
+        normalized.append(operation)
+    return normalized
+
+
+def _build_patched_update(map_data, operations, expected_revision):
+    revision = map_data.get('revision', 0)
+    if expected_revision is not None and expected_revision != revision:
+        raise RevisionConflict(revision)
+    tree = extract_map_tree(map_data)
+    # Mapy zapisane przed wprowadzeniem limitów można edytować, ale nie mogą urosnąć
+    limits = stored_tree_limits(tree)
+    tree = apply_json_patch(tree, operations)
+    if not isinstance(tree, dict):
+        raise TreeValidationError('Drzewo mapy musi być obiektem JSON', 400)
+    normalize_tree(tree, strict=True, **limits)
+    update_data = {'revision': revision + 1, 'lastUpdated': datetime.utcnow()}
+    update_data.update(map_tree_fields(tree, for_update=True))
+    return update_data
+
+
+def _patch_map_transaction(transaction, map_ref, operations, expected_revision):
+    snapshot = map_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    update_data = _build_patched_update(snapshot.to_dict(), operations, expected_revision)
+    transaction.update(map_ref, update_data)
+    return update_data['revision']
+
+
+class FirestoreMapStore:
+    """Map documents in users/{uid}/maps."""
+
+    name = 'firestore'
+
+    def available(self):
+        return clients.db is not None
+
+    def _maps_ref(self, user_id):
+        return clients.db.collection('users').document(user_id).collection('maps')
+
+    def list_maps(self, user_id):
+        return [(doc.id, doc.to_dict()) for doc in self._maps_ref(user_id).stream()]
+
+    def list_page(self, user_id, limit, cursor, summary):
+        query = _maps_page_query(self._maps_ref(user_id), limit, cursor, summary)
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def get(self, user_id, map_id):
+        snapshot = self._maps_ref(user_id).document(map_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def exists(self, user_id, map_id):
+        return self._maps_ref(user_id).document(map_id).get(field_paths=['revision']).exists
+
+    def add(self, user_id, data):
+        write_time, doc_ref = self._maps_ref(user_id).add(data)
+        return doc_ref.id
+
+    def update(self, user_id, map_id, data):
+        map_ref = self._maps_ref(user_id).document(map_id)
+        if not map_ref.get().exists:
+            return False
+        map_ref.update(data)
+        return True
+
+    def patch(self, user_id, map_id, operations, expected_revision):
+        map_ref = self._maps_ref(user_id).document(map_id)
+        transactional = firestore.transactional(_patch_map_transaction)
+        return transactional(clients.db.transaction(), map_ref, operations, expected_revision)
+
+    def list_after(self, user_id, cursor, limit):
+        """One page of every document in document-id order, starting after `cursor`."""
+        query = self._maps_ref(user_id).order_by('__name__').limit(limit)
+        if cursor:
+            query = query.start_after({'__name__': cursor})
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def update_many(self, user_id, updates):
+        """Apply {map_id: fields} in one atomic batch; raises MapNotFound (nothing written) if a map is gone."""
+        batch = clients.db.batch()
+        for map_id, data in updates.items():
+            batch.update(self._maps_ref(user_id).document(map_id), data)
+        try:
+            batch.commit()
+        except google_exceptions.NotFound as e:
+            raise MapNotFound(str(e)) from e
+
+    def get_fields(self, user_id, map_ids, field_paths):
+        """Return {map_id: {field: value} or None} for the given maps, reading only field_paths."""
+        refs = [self._maps_ref(user_id).document(map_id) for map_id in map_ids]
+        return {snapshot.id: snapshot.to_dict() if snapshot.exists else None
+                for snapshot in clients.db.get_all(refs, field_paths=field_paths)}
+
+    def _job_ref(self, user_id, job_id):
+        return clients.db.collection('users').document(user_id).collection('jobs').document(job_id)
+
+    def save_job(self, user_id, job_id, data):
+        self._job_ref(user_id, job_id).set(data)
+
+    def get_job(self, user_id, job_id):
+        snapshot = self._job_ref(user_id, job_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+
+class MemoryMapStore:
+    """In-process map store with the same semantics as FirestoreMapStore.
+
+    Understands Increment and DELETE_FIELD sentinels, the (lastUpdated,
+    id) descending page order with cursors and the summary projection.
+    Documents are deep-copied in and out so callers cannot share state.
+    Used for benchmarks and local runs without Firebase.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._maps = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def available(self):
+        return True
+
+    @staticmethod
+    def _apply(document, fields):
+        for name, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                document.pop(name, None)
+            elif isinstance(value, firestore.Increment):
+                document[name] = document.get(name, 0) + value.value
+            else:
+                document[name] = copy.deepcopy(value)
+
+    @staticmethod
+    def _project(document):
+        summary = {}
+        for field in MAP_SUMMARY_FIELDS:
+            head, _, tail = field.partition('.')
+            value = document.get(head)
+            if not tail:
+                if head in document:
+                    summary[head] = value
+            elif isinstance(value, dict) and tail in value:
+                summary.setdefault(head, {})[tail] = value[tail]
+        return summary
+
+    def list_maps(self, user_id):
+        with self._lock:
+            return [(map_id, copy.deepcopy(data)) for map_id, data in self._maps.get(user_id, {}).items()]
+
+    def list_page(self, user_id, limit, cursor, summary):
+        after = decode_page_cursor(cursor) if cursor else None
+        with self._lock:
+            ordered = sorted(
+                ((data['lastUpdated'], map_id, data) for map_id, data in self._maps.get(user_id, {}).items()
+                 if data.get('lastUpdated') is not None),
+                key=lambda item: (item[0], item[1]), reverse=True
+            )
+            page = []
+            for last_updated, map_id, data in ordered:
+                if after and (last_updated, map_id) >= (after['lastUpdated'], after['__name__']):
+                    continue
+                page.append((map_id, self._project(data) if summary else copy.deepcopy(data)))
+                if len(page) == limit:
+                    break
+            return page
+
+    def get(self, user_id, map_id):
+        with self._lock:
+            data = self._maps.get(user_id, {}).get(map_id)
+            return copy.deepcopy(data) if data is not None else None
 
-load_dotenv()
-app = Flask(__name__, static_folder='static', template_folder='templates')
+    def exists(self, user_id, map_id):
+        with self._lock:
+            return map_id in self._maps.get(user_id, {})
 
-# Konfiguracja z Twoim ID projektu
-firebase_config = {'projectId': 'ai-mind-mapper'}
+    def add(self, user_id, data):
+        map_id = uuid.uuid4().hex[:20]
+        document = {}
+        self._apply(document, data)
+        with self._lock:
+            self._maps.setdefault(user_id, {})[map_id] = document
+        return map_id
+
+    def update(self, user_id, map_id, data):
+        with self._lock:
+            document = self._maps.get(user_id, {}).get(map_id)
+            if document is None:
+                return False
+            self._apply(document, data)
+            return True
+
+    def patch(self, user_id, map_id, operations, expected_revision):
+        with self._lock:
+            document = self._maps.get(user_id, {}).get(map_id)
+            if document is None:
+                return None
+            update_data = _build_patched_update(copy.deepcopy(document), operations, expected_revision)
+            self._apply(document, update_data)
+            return update_data['revision']
+
+    def list_after(self, user_id, cursor, limit):
+        with self._lock:
+            documents = self._maps.get(user_id, {})
+            ids = sorted(map_id for map_id in documents if not cursor or map_id > cursor)[:limit]
+            return [(map_id, copy.deepcopy(documents[map_id])) for map_id in ids]
+
+    def update_many(self, user_id, updates):
+        with self._lock:
+            documents = self._maps.get(user_id, {})
+            missing = [map_id for map_id in updates if map_id not in documents]
+            if missing:
+                raise MapNotFound(f'No document to update: {missing[0]}')
+            for map_id, data in updates.items():
+                self._apply(documents[map_id], data)
+
+    def get_fields(self, user_id, map_ids, field_paths):
+        with self._lock:
+            documents = self._maps.get(user_id, {})
+            return {map_id: {field: copy.deepcopy(documents[map_id][field])
+                             for field in field_paths if field in documents[map_id]}
+                    if map_id in documents else None
+                    for map_id in map_ids}
+
+    def save_job(self, user_id, job_id, data):
+        with self._lock:
+            self._jobs[(user_id, job_id)] = copy.deepcopy(data)
+
+    def get_job(self, user_id, job_id):
+        with self._lock:
+            data = self._jobs.get((user_id, job_id))
+            return copy.deepcopy(data) if data is not None else None
+
+
+# Magazyn map: 'firestore' (produkcja) albo 'memory' (benchmarki, praca offline)
+MAP_STORE = os.getenv('MAP_STORE', 'firestore')
+
+if MAP_STORE == 'memory':
+    map_store = MemoryMapStore()
+    log.info("🧪 Using in-memory map store")
+elif MAP_STORE == 'firestore':
+    map_store = FirestoreMapStore()
+else:
+    raise ValueError(f'Unknown MAP_STORE: {MAP_STORE}')
+
+
+# Cache odczytów map w pamięci procesu. Zapisy z innych workerów go nie unieważniają, więc przy
+# domyślnej konfiguracji gunicorn.conf.py (WEB_CONCURRENCY=2) jest WYŁĄCZONY. Włącza się sam przy
+# WEB_CONCURRENCY=1; MAP_READ_CACHE=1 wymusza go przy wielu workerach (ryzyko nieaktualnych odczytów)
+MAP_READ_CACHE = os.getenv('MAP_READ_CACHE', '1' if int(os.getenv('WEB_CONCURRENCY', 2)) == 1 else '0') == '1'
+MAP_DOCUMENT_CACHE_SIZE = int(os.getenv('MAP_DOCUMENT_CACHE_SIZE', 2000))
+MAP_DOCUMENT_CACHE_MAX_BYTES = int(os.getenv('MAP_DOCUMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+MAP_LISTING_CACHE_SIZE = int(os.getenv('MAP_LISTING_CACHE_SIZE', 1000))
+MAP_LISTING_CACHE_MAX_BYTES = int(os.getenv('MAP_LISTING_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+MAP_READ_CACHE_TTL = float(os.getenv('MAP_READ_CACHE_TTL', 60))
+
+
+def _document_weight(value):
+    """Approximate memory size of Firestore documents (timestamps and packed blobs are not JSON)."""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+class MapReadCache:
+    """Read-through cache of map documents keyed by (uid, map_id) and of per-user listings.
+
+    Every write through this app calls invalidate(), which drops the map's
+    document and bumps the user's generation. Listing keys include the
+    generation, so all of the user's listings go stale at once. A load that
+    raced with a write is not stored, because the generation it started
+    with no longer matches. Cached documents are shared: callers get
+    shallow copies and must not mutate nested values.
+
+    Writes handled by other processes are not seen, so when disabled
+    (MAP_READ_CACHE, off with several workers) every read goes to the store.
+    """
+
+    def __init__(self, enabled, document_size, listing_size, ttl, document_bytes, listing_bytes):
+        self.enabled = enabled
+        self.documents = ResultCache('map-documents', document_size, ttl,
+                                     max_bytes=document_bytes, weigher=_document_weight)
+        self.listings = ResultCache('map-listings', listing_size, ttl,
+                                    max_bytes=listing_bytes, weigher=_document_weight)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.invalidations = 0
+
+    def _generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def document(self, user_id, map_id, load):
+        if not self.enabled:
+            return load()
+        key = make_cache_key('map-document', user_id, map_id)
+        document = self.documents.get(key, _MISSING)
+        if document is _MISSING:
+            generation = self._generation(user_id)
+            document = load()
+            if document is not None and self._generation(user_id) == generation:
+                self.documents.set(key, document)
+        return dict(document) if document is not None else None
+
+    def listing(self, user_id, parts, load):
+        if not self.enabled:
+            return load()
+        generation = self._generation(user_id)
+        key = make_cache_key('map-listing', user_id, generation, *parts)
+        documents = self.listings.get(key, _MISSING)
+        if documents is _MISSING:
+            documents = load()
+            if self._generation(user_id) == generation:
+                self.listings.set(key, documents)
+        return [(doc_id, dict(data)) for doc_id, data in documents]
+
+    def invalidate(self, user_id, map_id=None):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self.invalidations += 1
+        if map_id is not None:
+            self.documents.delete(make_cache_key('map-document', user_id, map_id))
+
+    def stats(self):
+        with self._lock:
+            invalidations = self.invalidations
+        return {'enabled': self.enabled, 'documents': self.documents.stats(), 'listings': self.listings.stats(),
+                'invalidations': invalidations}
+
+
+map_read_cache = MapReadCache(MAP_READ_CACHE, MAP_DOCUMENT_CACHE_SIZE, MAP_LISTING_CACHE_SIZE, MAP_READ_CACHE_TTL,
+                              MAP_DOCUMENT_CACHE_MAX_BYTES, MAP_LISTING_CACHE_MAX_BYTES)
+
+
+@firestore_op('read')
+def _read_map_listing(user_id):
+    return map_store.list_maps(user_id)
+
+
+@firestore_op('read')
+def _read_map_page(user_id, limit, cursor, summary):
+    return map_store.list_page(user_id, limit, cursor, summary)
+
+
+@firestore_op('read')
+def _read_map_document(user_id, map_id):
+    return map_store.get(user_id, map_id)
+
+
+@firestore_op('read')
+def map_document_exists(user_id, map_id):
+    """Check that a map exists without reading its tree."""
+    return map_store.exists(user_id, map_id)
+
+
+def list_map_documents(user_id):
+    """Return (id, data) pairs for every document in users/{uid}/maps."""
+    write_buffer.flush_user(user_id)
+    return map_read_cache.listing(user_id, ('all',), lambda: _read_map_listing(user_id))
+
+
+def list_map_page(user_id, limit, cursor=None, summary=True):
+    """Return one page of (id, data) pairs ordered by lastUpdated (newest first).
+
+    In summary mode only MAP_SUMMARY_FIELDS are fetched (Firestore select).
+    Documents without lastUpdated are not part of the ordered listing.
+    """
+    write_buffer.flush_user(user_id)
+    return map_read_cache.listing(user_id, ('page', limit, cursor, summary),
+                                  lambda: _read_map_page(user_id, limit, cursor, summary))
+
+
+def get_map_document(user_id, map_id):
+    """Return the full map document or None when it does not exist."""
+    write_buffer.flush_key(user_id, map_id)
+    return map_read_cache.document(user_id, map_id, lambda: _read_map_document(user_id, map_id))
+
+
+@firestore_op('write')
+def add_map_document(user_id, data):
+    """Create a map document and return its id."""
+    map_id = map_store.add(user_id, data)
+    map_read_cache.invalidate(user_id)
+    return map_id
+
+
+@firestore_op('write')
+def patch_map_document(user_id, map_id, operations, expected_revision=None):
+    """Apply a JSON Patch to the stored tree inside a transaction.
+
+    Returns the new revision, or None when the map does not exist. Raises
+    RevisionConflict when expected_revision is stale and JsonPatchError when
+    the patch cannot be applied.
+    """
+    write_buffer.flush_key(user_id, map_id)
+    try:
+        return map_store.patch(user_id, map_id, operations, expected_revision)
+    finally:
+        map_read_cache.invalidate(user_id, map_id)
+
+
+@firestore_op('write')
+def update_map_document(user_id, map_id, data):
+    """Update an existing map document; return False when it does not exist."""
+    try:
+        return map_store.update(user_id, map_id, data)
+    finally:
+        map_read_cache.invalidate(user_id, map_id)
+
+
+# Okno (w sekundach) łączenia szybkich zapisów tej samej mapy; 0 wyłącza bufor.
+# Bufor żyje w jednym procesie - przy kilku workerach dwa bufory mogłyby zapisać mapę w złej
+# kolejności, więc działa tylko przy WEB_CONCURRENCY=1
+WRITE_BEHIND_WINDOW = float(os.getenv('WRITE_BEHIND_WINDOW', 0))
+if WRITE_BEHIND_WINDOW > 0 and int(os.getenv('WEB_CONCURRENCY', 2)) != 1:
+    log.warning("⚠️ WRITE_BEHIND_WINDOW ignored: write-behind needs a single worker (WEB_CONCURRENCY=1)")
+    WRITE_BEHIND_WINDOW = 0.0
+# Ile razy ponawiać nieudany zapis z bufora, zanim zmiany zostaną porzucone
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', 5))
+
+
+class WriteBehindBuffer:
+    """Coalesces bursts of full-map updates per (uid, map_id) into a single Firestore write.
+
+    enqueue() merges the new fields into the pending entry and returns at
+    once; a background thread flushes entries older than `window` seconds.
+    The tree is encoded only at flush time, so superseded versions cost
+    nothing. Writes of one map are serialized by a per-key lock, taken
+    before the entry is popped, so snapshots reach the store in enqueue
+    order. A failed write is put back under any newer changes (a tree
+    with a lower sequence number than a newer enqueued one is dropped) and
+    retried after another window, up to `max_attempts` times. Pending
+    entries are flushed on interpreter exit.
+    """
+
+    def __init__(self, window, max_attempts):
+        self.window = window
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._key_locks = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self.enqueued = 0
+        self.writes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.superseded = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def is_pending(self, user_id, map_id):
+        with self._lock:
+            return (user_id, map_id) in self._pending
+
+    @staticmethod
+    def _merge(entry, fields, tree, tree_sequence):
+        for name, value in fields.items():
+            previous = entry['fields'].get(name)
+            if isinstance(value, firestore.Increment) and isinstance(previous, firestore.Increment):
+                value = firestore.Increment(previous.value + value.value)
+            entry['fields'][name] = value
+        if tree is not _MISSING and tree_sequence > entry['treeSequence']:
+            entry['tree'] = tree
+            entry['treeSequence'] = tree_sequence
+
+    def enqueue(self, user_id, map_id, fields, tree=_MISSING):
+        key = (user_id, map_id)
+        with self._lock:
+            self._sequence += 1
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = self._pending[key] = {'fields': {}, 'tree': _MISSING, 'treeSequence': 0,
+                                              'since': time.monotonic(), 'attempts': 0}
+            self._merge(entry, fields, tree, self._sequence)
+            self.enqueued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def _key_lock(self, key):
+        with self._lock:
+            holder = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            holder[1] += 1
+        return holder
+
+    def _release_key_lock(self, key, holder):
+        with self._lock:
+            holder[1] -= 1
+            if holder[1] == 0:
+                del self._key_locks[key]
+
+    def _flush(self, key, due_before=None):
+        """Pop and write the pending entry of one key while holding its lock."""
+        holder = self._key_lock(key)
+        try:
+            with holder[0]:
+                with self._lock:
+                    entry = self._pending.get(key)
+                    if entry is None or (due_before is not None and entry['since'] > due_before):
+                        return
+                    del self._pending[key]
+                self._write(key, entry)
+        finally:
+            self._release_key_lock(key, holder)
+
+    def _write(self, key, entry):
+        fields = dict(entry['fields'])
+        if entry['tree'] is not _MISSING:
+            fields.update(map_tree_fields(entry['tree'], for_update=True))
+        try:
+            if not update_map_document(key[0], key[1], fields):
+                log.warning(f"⚠️ Write-behind: map {key[1]} (user: {key[0]}) no longer exists")
+            with self._lock:
+                self.writes += 1
+        except Exception as e:
+            self._requeue(key, entry, e)
+
+    def _requeue(self, key, entry, error):
+        with self._lock:
+            self.failures += 1
+            entry['attempts'] += 1
+            if entry['attempts'] >= self.max_attempts:
+                self.dropped += 1
+                log.error(f"❌ Write-behind: dropping changes to map {key[1]} after {entry['attempts']} failed writes: {error}")
+                return
+            # Nowsze zmiany z bufora mają pierwszeństwo; starsze drzewo nie nadpisze nowszego
+            newer = self._pending.pop(key, None)
+            if newer is not None:
+                if newer['treeSequence'] > entry['treeSequence']:
+                    self.superseded += 1
+                self._merge(entry, newer['fields'], newer['tree'], newer['treeSequence'])
+            entry['since'] = time.monotonic()
+            self._pending[key] = entry
+        log.error(f"❌ Write-behind flush failed for map {key[1]} (attempt {entry['attempts']}), will retry: {error}")
+
+    def flush_key(self, user_id, map_id):
+        """Write the pending entry for one map now (used before reads and patches)."""
+        self._flush((user_id, map_id))
+
+    def flush_user(self, user_id):
+        """Write every pending entry of one user (used before reading all their maps)."""
+        with self._lock:
+            keys = [key for key in self._pending if key[0] == user_id]
+        for key in keys:
+            self._flush(key)
+
+    def flush_all(self):
+        with self._lock:
+            keys = list(self._pending)
+        for key in keys:
+            self._flush(key)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait(timeout=self.window / 2)
+                cutoff = time.monotonic() - self.window
+                due = [key for key, entry in self._pending.items() if entry['since'] <= cutoff]
+            for key in due:
+                self._flush(key, due_before=cutoff)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'windowSeconds': self.window,
+                'pending': len(self._pending),
+                'enqueued': self.enqueued,
+                'writes': self.writes,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'superseded': self.superseded,
+                'coalescingRatio': round(self.enqueued / self.writes, 2) if self.writes else 0.0
+            }
+
+
+write_buffer = WriteBehindBuffer(WRITE_BEHIND_WINDOW, WRITE_BEHIND_MAX_ATTEMPTS)
+atexit.register(write_buffer.flush_all)
 
-db = None
-try:
-    if not firebase_admin._apps:
-        if os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            initialize_app(cred, firebase_config)
-            print("✅ Init z serviceAccountKey.json")
-        elif os.path.exists("firebase-admin-key.json"):
-            cred = credentials.Certificate("firebase-admin-key.json")
-            initialize_app(cred, firebase_config)
-            print("✅ Init z firebase-admin-key.json")
-        else:
-            # Fallback dla środowiska chmurowego (Render)
-            initialize_app(options=firebase_config)
-            print("✅ Init default (cloud)")
-    db = firestore.client()
-except ValueError as e:
-    db = firestore.client()
-    print(f"ℹ️ Firebase Admin already initialized: {e}")
-except Exception as e:
-    print(f"⚠️ WARNING: Firebase Admin failed to initialize: {e}")
-    print("ℹ️ The app will run without Firebase Admin authorization.")
-    print("📝 REMINDER: Download serviceAccountKey.json from the Firebase console and add it to the project!")
-
-client = groq.Groq(api_key=os.getenv("GROQ_API_KEY"))
-GROQ_MODEL = "moonshotai/kimi-k2-instruct-0905"
 
 def require_auth(f):
     """Decorator validating a Firebase token before executing the wrapped function."""
@@ -51,117 +2126,1101 @@ def require_auth(f):
         if not auth_header or not auth_header.startswith('Bearer '):
             return jsonify({"error": "Brak tokena lub niepoprawny format"}), 401
 
-        token = auth_header.split(' ')[1]
-        
-        try:
-            decoded_token = auth.verify_id_token(token)
-            uid = decoded_token['uid']
-            g.user_id = uid
-            print(f"✅ User verified: {g.user_id}")
-        except Exception as e:
-            print(f"❌ Token verification failed: {e}")
-            return jsonify({"error": "Nieprawidłowy token"}), 403
+        token = auth_header.split(' ')[1]
+        token_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        
+        try:
+            with timed('auth'):
+                decoded_token = token_cache.get(token_key)
+                if decoded_token is None or decoded_token.get('exp', 0) <= time.time():
+                    clients.ensure_firebase()
+                    decoded_token = auth.verify_id_token(token)
+                    token_cache.set(token_key, decoded_token, expires_at=decoded_token.get('exp'))
+            uid = decoded_token['uid']
+            g.user_id = uid
+            log.debug(f"✅ User verified: {g.user_id}")
+        except Exception as e:
+            log.error(f"❌ Token verification failed: {e}")
+            return jsonify({"error": "Nieprawidłowy token"}), 403
+
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe; answers immediately and never triggers client initialization."""
+    return jsonify({'status': 'ok', 'mapStore': MAP_STORE, 'llmBackend': LLM_BACKEND, **clients.status()}), 200
+
+# Limity drzew map (z modelu i od klienta) oraz maksymalny rozmiar ciała zapytania
+TREE_MAX_DEPTH = int(os.getenv('TREE_MAX_DEPTH', 24))
+TREE_MAX_NODES = int(os.getenv('TREE_MAX_NODES', 5000))
+TREE_MAX_TEXT_CHARS = int(os.getenv('TREE_MAX_TEXT_CHARS', 1000))
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', 8 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+
+class TreeValidationError(ValueError):
+    """Raised when a client tree is malformed (400) or exceeds the TREE_* limits (413)."""
+
+    def __init__(self, message, status_code=413):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@app.errorhandler(TreeValidationError)
+def _tree_validation_error(e):
+    return jsonify({'error': str(e)}), e.status_code
+
+
+@app.errorhandler(413)
+def _request_too_large(e):
+    return jsonify({'error': f'Zapytanie jest za duże (maks. {MAX_REQUEST_BYTES} bajtów)'}), 413
+
+
+def node_content(node, emojis_enabled):
+    """Return the canonical 'content' of a raw node ('emoji text' or plain text), or None if it is not text.
+
+    Does not modify the node; 'text' wins over 'content' like in the prompts.
+    """
+    value = node.get('text', node.get('content', ''))
+    if value is None:
+        value = ''
+    elif isinstance(value, (int, float)):
+        value = str(value)
+    elif not isinstance(value, str):
+        return None
+    value = value.strip()
+    if emojis_enabled:
+        value = f"{node.get('emoji') or '📌'} {value}"
+    return value
+
+
+def _filter_children(children, too_deep, room, strict, drop_empty, max_depth, max_nodes):
+    """Slow path of normalize_tree: fix up one 'children' list in place so it fits the limits."""
+    kept = []
+    for child in children:
+        if child.__class__ is str and not strict:
+            child = {'content': child}
+        if child.__class__ is not dict:
+            if strict:
+                raise TreeValidationError('Węzeł mapy musi być obiektem JSON', 400)
+            continue
+        if drop_empty and not node_content(child, False):
+            continue
+        if too_deep or len(kept) >= room:
+            if strict:
+                if too_deep:
+                    raise TreeValidationError(f'Mapa jest zbyt głęboka (maks. {max_depth} poziomów)')
+                raise TreeValidationError(f'Mapa ma zbyt wiele węzłów (maks. {max_nodes})')
+            continue
+        kept.append(child)
+    children[:] = kept
+
+
+def normalize_tree(root, emojis_enabled=False, strict=False, max_depth=None, drop_empty=False, max_nodes=None,
+                   max_text_chars=None):
+    """Canonicalize a map tree in place to {'content': str, 'children': [...]} nodes, without recursion.
+
+    Model 'text'/'emoji' pairs become a single 'content' string. Limits
+    (max_depth, default TREE_MAX_DEPTH; max_nodes, default TREE_MAX_NODES;
+    max_text_chars, default TREE_MAX_TEXT_CHARS)
+    are checked before a child is queued, so nothing past them is walked.
+    With strict=True (client uploads) any violation raises
+    TreeValidationError; otherwise (model output) texts are cut, subtrees
+    past the limits are dropped and bare strings in 'children' become
+    nodes. drop_empty removes children with empty text. Returns root.
+    """
+    if not isinstance(root, dict):
+        raise TreeValidationError('Drzewo mapy musi być obiektem JSON', 400)
+    max_depth = TREE_MAX_DEPTH if max_depth is None else max_depth
+    max_nodes = TREE_MAX_NODES if max_nodes is None else max_nodes
+    max_text_chars = TREE_MAX_TEXT_CHARS if max_text_chars is None else max_text_chars
+    count = 1
+    pruned = 0
+    # Stos list rodzeństwa: jeden wpis na rodzica zamiast jednego na węzeł
+    stack = [([root], 0)]
+    while stack:
+        nodes, depth = stack.pop()
+        for node in nodes:
+            content = node_content(node, emojis_enabled)
+            if content is None:
+                if strict:
+                    raise TreeValidationError('Treść węzła musi być tekstem', 400)
+                content = ''
+            if len(content) > max_text_chars:
+                if strict:
+                    raise TreeValidationError(f'Treść węzła jest za długa (maks. {max_text_chars} znaków)')
+                content = content[:max_text_chars]
+            node['content'] = content
+            node.pop('text', None)
+            node.pop('emoji', None)
+
+            children = node.get('children')
+            if children is None:
+                node.pop('children', None)
+                continue
+            if children.__class__ is not list:
+                if strict:
+                    raise TreeValidationError('Pole children musi być listą', 400)
+                del node['children']
+                continue
+            if not children:
+                continue
+            if (drop_empty or depth >= max_depth or count + len(children) > max_nodes
+                    or not all(child.__class__ is dict for child in children)):
+                before = len(children)
+                _filter_children(children, depth >= max_depth, max_nodes - count, strict, drop_empty, max_depth,
+                                 max_nodes)
+                pruned += before - len(children)
+            count += len(children)
+            stack.append((children, depth + 1))
+    if pruned:
+        log.warning(f"⚠️ Pruned {pruned} subtree(s) exceeding the tree limits ({count} node(s) kept)")
+    return root
+
+
+def tree_extent(root):
+    """Return (nodes, depth, longest text) of a raw tree without recursion (malformed parts are skipped)."""
+    if not isinstance(root, dict):
+        return 0, 0, 0
+    nodes, deepest, longest = 0, 0, 0
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes += 1
+        deepest = max(deepest, depth)
+        longest = max(longest, len(node_content(node, False) or ''))
+        children = node.get('children')
+        if children.__class__ is not list:
+            continue
+        stack.extend((child, depth + 1) for child in children if child.__class__ is dict)
+    return nodes, deepest, longest
+
+
+def stored_tree_limits(stored_tree):
+    """normalize_tree limits for an edit of stored_tree: the TREE_* defaults or the stored map's own maxima.
+
+    Maps saved before the limits existed stay editable (and can shrink),
+    but cannot grow past their current size, depth or longest text.
+    """
+    nodes, depth, longest = tree_extent(stored_tree)
+    return {
+        'max_nodes': max(TREE_MAX_NODES, nodes),
+        'max_depth': max(TREE_MAX_DEPTH, depth),
+        'max_text_chars': max(TREE_MAX_TEXT_CHARS, longest),
+    }
+
+
+def validate_client_tree(tree, user_id=None, map_id=None):
+    """Normalize a tree uploaded by the client (strict); non-object trees are rejected with 400.
+
+    For an existing map an upload over the TREE_* limits is checked again
+    against stored_tree_limits() of the stored map, which is read only then.
+    """
+    if not isinstance(tree, dict):
+        raise TreeValidationError('Drzewo mapy musi być obiektem JSON', 400)
+    try:
+        return normalize_tree(tree, strict=True)
+    except TreeValidationError as e:
+        if e.status_code != 413 or map_id is None:
+            raise
+        stored = get_map_document(user_id, map_id)
+        if stored is None:
+            raise
+    return normalize_tree(tree, strict=True, **stored_tree_limits(extract_map_tree(stored)))
+
+
+@timed('prompt')
+def build_map_prompt(topic, emojis_enabled):
+    """Build the system prompt for generating a whole map."""
+    if emojis_enabled:
+        return f"""
+        Jesteś ekspertem w tworzeniu zwięzłych, hierarchicznych map myśli na temat: "{topic}".
+        
+        KRYTYCZNE WYMAGANIA:
+        1. Odpowiedz ZAWSZE w formacie JSON, bez żadnego dodatkowego tekstu.
+        2. Każdy węzeł MUSI zawierać dwa pola: "text" (treść węzła) oraz "emoji" (jedno pasujące emoji Unicode).
+        3. Struktura główna: {{"text": "{topic}", "emoji": "🧠", "children": [...]}}
+        4. Każdy element w "children" również ma "text", "emoji" i opcjonalnie "children".
+        5. Wybieraj emoji, które WIZUALNIE reprezentują dany temat (np. ☀️ dla światła, 🌙 dla ciemności, 📚 dla nauki).
+        6. Używaj WYŁĄCZNIE pojedynczych emoji Unicode (np. "🔬", "💡", "🌍").
+        7. Celuj w 2-4 poziomy zagnieżdzenia na start.
+        
+        Przykład prawidłowej struktury:
+        {{
+          "text": "Fotosynteza",
+          "emoji": "🌱",
+          "children": [
+            {{"text": "Faza świetlna", "emoji": "☀️", "children": [...]}},
+            {{"text": "Faza ciemna", "emoji": "🌙"}}
+          ]
+        }}
+        """
+    return f"""
+        Jesteś ekspertem w tworzeniu zwięzłych, hierarchicznych map myśli na temat: "{topic}".
+        
+        KRYTYCZNE WYMAGANIA:
+        1. Odpowiedz ZAWSZE w formacie JSON, bez żadnego dodatkowego tekstu.
+        2. Struktura główna: {{"content": "{topic}", "children": [...]}}
+        3. Każdy węzeł ma klucz "content" z treścią. Węzły z podpunktami mają "children".
+        4. Celuj w 2-4 poziomy zagnieżdzenia na start.
+        
+        Przykład prawidłowej struktury:
+        {{
+          "content": "Fotosynteza",
+          "children": [
+            {{"content": "Faza świetlna", "children": [...]}},
+            {{"content": "Faza ciemna"}}
+          ]
+        }}
+        """
+
+def _generate_map_data(topic, emojis_enabled):
+    """Ask the LLM for a full map and normalize it to the content/children shape."""
+    chat_completion = llm_create(
+        messages=[{"role": "system", "content": build_map_prompt(topic, emojis_enabled)}],
+        model=GROQ_MODEL,
+        response_format={"type": "json_object"},
+        temperature=0.2
+    )
+
+    map_data_string = chat_completion.choices[0].message.content
+    with timed('parse'):
+        map_data = normalize_tree(json.loads(map_data_string), emojis_enabled)
+    return map_data
+
+class IncrementalTreeParser:
+    """Incremental JSON parser that reports mind-map nodes while the document is still streaming.
+
+    Feed it text chunks with feed(); it returns (path, node) pairs for every node
+    whose own fields are known, i.e. when its "children" list opens or the object
+    closes. path is the list of child indices leading from the root to the node.
+    With root_is_node=False (expansion responses) only list items count as nodes.
+    """
+
+    _NUMBER_CHARS = frozenset('+-0123456789.eE')
+    _LITERALS = {'true': True, 'false': False, 'null': None}
+
+    def __init__(self, root_is_node=True):
+        self.root_is_node = root_is_node
+        self.root = _MISSING
+        self._buffer = ''
+        self._stack = []
+        self._node_paths = {}
+        self._emitted = set()
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        events = []
+        pos = self._consume(self._buffer, events, final=False)
+        self._buffer = self._buffer[pos:]
+        return events
+
+    def close(self):
+        """Flush the buffer and return the fully parsed document."""
+        events = []
+        pos = self._consume(self._buffer, events, final=True)
+        if self._buffer[pos:].strip() or self._stack or self.root is _MISSING:
+            raise ValueError('Niekompletny dokument JSON')
+        self._buffer = ''
+        return self.root, events
+
+    def _consume(self, text, events, final):
+        pos = 0
+        length = len(text)
+        while pos < length:
+            char = text[pos]
+            if char in ' \t\r\n,:':
+                pos += 1
+            elif char == '{' or char == '[':
+                self._open({} if char == '{' else [], events)
+                pos += 1
+            elif char == '}' or char == ']':
+                self._close(events)
+                pos += 1
+            elif char == '"':
+                try:
+                    value, end = json.decoder.scanstring(text, pos + 1)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                self._scalar(value, is_string=True)
+                pos = end
+            else:
+                end = pos
+                while end < length and text[end] not in ' \t\r\n,:]}':
+                    end += 1
+                if end == length and not final:
+                    break
+                token = text[pos:end]
+                if token in self._LITERALS:
+                    value = self._LITERALS[token]
+                elif token and set(token) <= self._NUMBER_CHARS:
+                    value = json.loads(token)
+                else:
+                    raise ValueError(f'Nieoczekiwany fragment JSON: {token[:20]}')
+                self._scalar(value, is_string=False)
+                pos = end
+        return pos
+
+    def _attach(self, value):
+        """Attach a value to the current container; return the (container, key) it went into."""
+        if not self._stack:
+            self.root = value
+            return None, None
+        frame = self._stack[-1]
+        container = frame['value']
+        if isinstance(container, list):
+            container.append(value)
+            return container, len(container) - 1
+        key = frame['key']
+        container[key] = value
+        frame['key'] = _MISSING
+        return container, key
+
+    def _open(self, value, events):
+        parent_frame = self._stack[-1] if self._stack else None
+        container, key = self._attach(value)
+        if isinstance(value, dict):
+            path = None
+            if container is None:
+                if self.root_is_node:
+                    path = ()
+            elif isinstance(container, list) and parent_frame.get('children_of') is not None:
+                path = parent_frame['children_of'] + (key,)
+            if path is not None:
+                self._node_paths[id(value)] = (path, value)
+        frame = {'value': value, 'key': _MISSING, 'children_of': None}
+        if isinstance(value, list):
+            if container is None:
+                if not self.root_is_node:
+                    frame['children_of'] = ()
+            elif isinstance(container, dict) and key in ('children', 'nodes'):
+                owner = self._node_paths.get(id(container))
+                if owner is not None:
+                    frame['children_of'] = owner[0]
+                    self._emit(container, events)
+                elif not self.root_is_node and container is self.root:
+                    frame['children_of'] = ()
+        self._stack.append(frame)
+
+    def _close(self, events):
+        if not self._stack:
+            raise ValueError('Nieoczekiwane zamknięcie JSON')
+        frame = self._stack.pop()
+        if isinstance(frame['value'], dict):
+            self._emit(frame['value'], events)
+
+    def _scalar(self, value, is_string):
+        if self._stack:
+            frame = self._stack[-1]
+            if isinstance(frame['value'], dict) and frame['key'] is _MISSING:
+                if not is_string:
+                    raise ValueError('Klucz obiektu JSON musi być tekstem')
+                frame['key'] = value
+                return
+        self._attach(value)
+
+    def _emit(self, node, events):
+        entry = self._node_paths.get(id(node))
+        if entry is None or id(node) in self._emitted:
+            return
+        self._emitted.add(id(node))
+        events.append((list(entry[0]), node))
+
+
+def _node_display_content(node, emojis_enabled):
+    """Return the normalized 'content' string for a single streamed node."""
+    return (node_content(node, emojis_enabled) or '')[:TREE_MAX_TEXT_CHARS]
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def _sse_response(generator):
+    return Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _iter_tree_nodes(tree):
+    """Yield (path, node) pairs of an already normalized tree in pre-order."""
+    stack = [([], tree)]
+    while stack:
+        path, node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        yield path, node
+        children = node.get('children')
+        if isinstance(children, list):
+            for index in range(len(children) - 1, -1, -1):
+                stack.append((path + [index], children[index]))
+
+
+def _stream_completion(system_prompt, root_is_node, temperature=0.2):
+    """Call the LLM backend in streaming mode and yield (path, node) events, then ('done', document)."""
+    stream = llm_stream(
+        messages=[{"role": "system", "content": system_prompt}],
+        model=GROQ_MODEL,
+        response_format={"type": "json_object"},
+        temperature=temperature
+    )
+    parser = IncrementalTreeParser(root_is_node=root_is_node)
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            for event in parser.feed(delta):
+                yield event
+    document, events = parser.close()
+    for event in events:
+        yield event
+    yield 'done', document
+
+@app.route('/generate-map', methods=['POST'])
+@require_auth
+@rate_limited()
+def generate_map():
+    """Generate a complete mind map for the requested topic."""
+    topic = request.json.get('topic')
+    emojis_enabled = request.json.get('emojisEnabled', False)
+    
+    if not topic:
+        return jsonify({'error': 'Nie podano tematu'}), 400
+
+    topic = normalize_topic(topic)
+    emojis_enabled = bool(emojis_enabled)
+    cache_key = make_cache_key(topic, emojis_enabled, GROQ_MODEL, PROMPT_VERSION)
+
+    try:
+        map_data = map_cache.get_or_compute(
+            cache_key, lambda: _generate_map_data(topic, emojis_enabled)
+        )
+        prefetcher.schedule(g.user_id, map_data, emojis_enabled)
+        return jsonify(map_data)
+
+    except (AdmissionRejected, LLMUnavailable):
+        raise
+    except Exception as e:
+        log.error(f"Groq error while generating the map: {e}")
+        return jsonify({'error': 'Wystąpił błąd podczas komunikacji z AI.'}), 500
+
+@app.route('/generate-map/stream', methods=['POST'])
+@require_auth
+@rate_limited()
+def generate_map_stream():
+    """Stream a new mind map as Server-Sent Events, one 'node' event per completed node."""
+    topic = request.json.get('topic')
+    emojis_enabled = request.json.get('emojisEnabled', False)
+    
+    if not topic:
+        return jsonify({'error': 'Nie podano tematu'}), 400
+
+    topic = normalize_topic(topic)
+    emojis_enabled = bool(emojis_enabled)
+    cache_key = make_cache_key(topic, emojis_enabled, GROQ_MODEL, PROMPT_VERSION)
+    user_id = g.user_id
+
+    def generate():
+        cached = map_cache.get(cache_key, _MISSING)
+        if cached is not _MISSING:
+            prefetcher.schedule(user_id, cached, emojis_enabled)
+            for path, node in _iter_tree_nodes(cached):
+                yield sse_event('node', {'path': path, 'content': node.get('content', '')})
+            yield sse_event('done', cached)
+            return
+        try:
+            for path, node in _stream_completion(build_map_prompt(topic, emojis_enabled), root_is_node=True):
+                if path == 'done':
+                    map_data = node
+                    break
+                yield sse_event('node', {'path': path, 'content': _node_display_content(node, emojis_enabled)})
+            map_data = normalize_tree(map_data, emojis_enabled)
+            map_cache.set(cache_key, map_data)
+            prefetcher.schedule(user_id, map_data, emojis_enabled)
+            yield sse_event('done', map_data)
+        except (AdmissionRejected, LLMUnavailable) as e:
+            yield sse_event('error', {'error': str(e), 'retryAfter': e.retry_after})
+        except Exception as e:
+            log.error(f"Groq error while streaming the map: {e}")
+            yield sse_event('error', {'error': 'Wystąpił błąd podczas komunikacji z AI.'})
+
+    return _sse_response(generate())
+
+@app.route('/cache-stats', methods=['GET'])
+@require_auth
+def cache_stats():
+    """Report hit/miss counters of the in-process result caches."""
+    return jsonify({
+        'generateMap': map_cache.stats(),
+        'authTokens': token_cache.stats(),
+        'expansions': expansion_cache.stats(),
+        'explanations': explanation_cache.stats(),
+        'prefetch': prefetcher.stats(),
+        'llmScheduler': llm_scheduler.stats(),
+        'llmResilience': llm_resilience_stats(),
+        'searchIndex': search_index.stats(),
+        'mapReads': map_read_cache.stats(),
+        'writeBehind': write_buffer.stats()
+    }), 200
+
+@timed('prompt')
+def build_expand_prompt(context, emojis_enabled):
+    """Build the system prompt for expanding the last element of a node path."""
+    if emojis_enabled:
+        return f"""
+        Kontekst: "{context}". Wygeneruj TYLKO listę podpunktów dla OSTATNIEGO elementu.
+        
+        KRYTYCZNE WYMAGANIA:
+        1. Odpowiedz w formacie JSON jako obiekt zawierający klucz "nodes" z listą.
+        2. Każdy element listy MUSI zawierać "text" (treść) i "emoji" (jedno pasujące emoji Unicode).
+        3. Format: {{"nodes": [{{"text": "...", "emoji": "🔥"}}, {{"text": "...", "emoji": "💧"}}]}}
+        4. Wybieraj emoji, które WIZUALNIE reprezentują temat (np. 🔬 nauka, 💡 pomysł, 🌍 świat).
+        5. Używaj WYŁĄCZNIE pojedynczych emoji Unicode.
+        6. Jeśli nie ma podpunktów, zwróć: {{"nodes": []}}
+        
+        Przykład prawidłowej odpowiedzi:
+        {{
+          "nodes": [
+            {{"text": "Definicja", "emoji": "📖"}},
+            {{"text": "Przykłady", "emoji": "💡"}},
+            {{"text": "Zastosowania", "emoji": "🔧"}}
+          ]
+        }}
+        """
+    return f"""
+        Kontekst: "{context}". Wygeneruj TYLKO listę podpunktów dla OSTATNIEGO elementu.
+        
+        KRYTYCZNE WYMAGANIA:
+        1. Odpowiedz w formacie JSON jako obiekt zawierający klucz "nodes" z listą.
+        2. Każdy element listy ma pole "content" z treścią węzła.
+        3. Format: {{"nodes": [{{"content": "..."}}, {{"content": "..."}}]}}
+        4. Jeśli nie ma podpunktów, zwróć: {{"nodes": []}}
+        
+        Przykład prawidłowej odpowiedzi:
+        {{
+          "nodes": [
+            {{"content": "Definicja"}},
+            {{"content": "Przykłady"}},
+            {{"content": "Zastosowania"}}
+          ]
+        }}
+        """
+
+def normalize_expanded_nodes(response_data, emojis_enabled):
+    """Convert an LLM expansion response into a list of {'content': ...} nodes."""
+    if isinstance(response_data, list):
+        items = response_data
+    elif isinstance(response_data, dict):
+        items = response_data.get('children') or response_data.get('nodes')
+    else:
+        items = None
+    if not isinstance(items, list):
+        return []
+    parent = normalize_tree({'children': items}, emojis_enabled, max_depth=1, drop_empty=True)
+    return [{'content': node['content']} for node in parent['children']]
+
+EXPAND_BATCH_MAX_PATHS = int(os.getenv('EXPAND_BATCH_MAX_PATHS', 50))
+EXPAND_BATCH_WORKERS = int(os.getenv('EXPAND_BATCH_WORKERS', 4))
+EXPAND_PACK_MAX_SIBLINGS = int(os.getenv('EXPAND_PACK_MAX_SIBLINGS', 6))
+
+def expand_path(node_path, emojis_enabled):
+    """Ask the LLM for the children of the last element of node_path."""
+    context = " -> ".join(node_path)
+    chat_completion = llm_create(
+        messages=[{"role": "system", "content": build_expand_prompt(context, emojis_enabled)}],
+        model=GROQ_MODEL,
+        response_format={"type": "json_object"},
+        temperature=0.2
+    )
+    with timed('parse'):
+        response_data = json.loads(chat_completion.choices[0].message.content)
+    return normalize_expanded_nodes(response_data, emojis_enabled)
+
+@timed('prompt')
+def build_sibling_expand_prompt(parent_path, siblings, emojis_enabled):
+    """Build one prompt that expands several siblings sharing the same parent path."""
+    context = " -> ".join(parent_path)
+    items = "\n".join(f'        {index}. "{name}"' for index, name in enumerate(siblings))
+    if emojis_enabled:
+        node_rule = 'Każdy element "nodes" MUSI zawierać "text" (treść) i "emoji" (jedno pasujące emoji Unicode).'
+        node_example = '{"text": "...", "emoji": "🔥"}'
+    else:
+        node_rule = 'Każdy element "nodes" ma pole "content" z treścią węzła.'
+        node_example = '{"content": "..."}'
+    return f"""
+        Kontekst: "{context}". Dla KAŻDEGO z poniższych elementów wygeneruj TYLKO listę jego podpunktów.
+        
+        Elementy:
+{items}
+        
+        KRYTYCZNE WYMAGANIA:
+        1. Odpowiedz w formacie JSON jako obiekt z kluczem "results" - listą obiektów {{"index": <numer elementu>, "nodes": [...]}}.
+        2. {node_rule}
+        3. Format: {{"results": [{{"index": 0, "nodes": [{node_example}]}}]}}
+        4. Każdy element z listy musi mieć dokładnie jeden wpis w "results". Jeśli nie ma podpunktów, zwróć "nodes": [].
+        """
+
+def expand_siblings(parent_path, siblings, emojis_enabled):
+    """Expand several siblings with a single LLM call; return {sibling_index: nodes}."""
+    chat_completion = llm_create(
+        messages=[{"role": "system", "content": build_sibling_expand_prompt(parent_path, siblings, emojis_enabled)}],
+        model=GROQ_MODEL,
+        response_format={"type": "json_object"},
+        temperature=0.2
+    )
+    with timed('parse'):
+        response_data = json.loads(chat_completion.choices[0].message.content)
+    results = {}
+    entries = response_data.get('results') if isinstance(response_data, dict) else None
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not isinstance(entry.get('index'), int):
+            continue
+        if 0 <= entry['index'] < len(siblings):
+            results[entry['index']] = normalize_expanded_nodes({'nodes': entry.get('nodes')}, emojis_enabled)
+    return results
+
+def expand_paths_batch(paths, emojis_enabled, pack_siblings=True):
+    """Expand many paths with bounded parallelism; siblings may share one packed prompt.
+
+    Paths already in expansion_cache are answered without an LLM call and
+    packed results are stored there for later single expansions.
+    Returns a list aligned with paths of {'path', 'nodes'} or {'path', 'error'}.
+    """
+    results = [None] * len(paths)
+    groups = OrderedDict()
+    for index, node_path in enumerate(paths):
+        key = expansion_cache_key(node_path, emojis_enabled)
+        cached = expansion_cache.get(key, _MISSING)
+        if cached is not _MISSING:
+            prefetcher.consume(key)
+            results[index] = {'path': node_path, 'nodes': cached}
+            continue
+        groups.setdefault(tuple(node_path[:-1]), []).append(index)
+
+    jobs = []
+    for parent_path, indices in groups.items():
+        if pack_siblings and len(parent_path) > 0 and len(indices) > 1:
+            for start in range(0, len(indices), EXPAND_PACK_MAX_SIBLINGS):
+                jobs.append(('pack', parent_path, indices[start:start + EXPAND_PACK_MAX_SIBLINGS]))
+        else:
+            jobs.extend(('single', parent_path, [index]) for index in indices)
+
+    # Wątki puli nie mają kontekstu requestu - przekazujemy im endpoint i wspólny deadline całego batcha
+    endpoint = _llm_endpoint()
+    deadline = _llm_deadline(endpoint)
+
+    def run_single(index):
+        try:
+            results[index] = {'path': paths[index], 'nodes': expand_path_cached(paths[index], emojis_enabled)}
+        except Exception as e:
+            log.error(f"❌ Batch expansion failed for {paths[index]}: {e}")
+            results[index] = {'path': paths[index], 'error': str(e)}
+
+    def run_job(job):
+        with llm_call_scope(endpoint, deadline):
+            run_job_in_scope(job)
+
+    def run_job_in_scope(job):
+        kind, parent_path, indices = job
+        if kind == 'single':
+            run_single(indices[0])
+            return
+        try:
+            packed = expand_siblings(list(parent_path), [paths[i][-1] for i in indices], emojis_enabled)
+        except Exception as e:
+            log.warning(f"⚠️ Packed sibling expansion failed, falling back to single calls: {e}")
+            packed = {}
+        for position, index in enumerate(indices):
+            if position in packed:
+                expansion_cache.set(expansion_cache_key(paths[index], emojis_enabled), packed[position])
+                results[index] = {'path': paths[index], 'nodes': packed[position]}
+            else:
+                run_single(index)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(EXPAND_BATCH_WORKERS, len(jobs)))) as pool:
+        list(pool.map(run_job, jobs))
+    return results
+
+# Wspólny (między użytkownikami) cache rozwinięć węzłów, adresowany treścią ścieżki
+EXPANSION_CACHE_SIZE = int(os.getenv('EXPANSION_CACHE_SIZE', 20000))
+EXPANSION_CACHE_MAX_BYTES = int(os.getenv('EXPANSION_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+EXPANSION_CACHE_TTL = float(os.getenv('EXPANSION_CACHE_TTL', 7 * 24 * 3600))
+EXPANSION_CACHE_PATH = os.getenv('EXPANSION_CACHE_PATH')
+EXPANSION_HYDRATE_DEPTH = int(os.getenv('EXPANSION_HYDRATE_DEPTH', 3))
+EXPANSION_HYDRATE_MAX_NODES = int(os.getenv('EXPANSION_HYDRATE_MAX_NODES', 300))
+
+expansion_cache = ResultCache('expansions', EXPANSION_CACHE_SIZE, EXPANSION_CACHE_TTL,
+                              EXPANSION_CACHE_PATH, max_bytes=EXPANSION_CACHE_MAX_BYTES)
+
+
+def normalize_path_segment(segment):
+    """Normalize one path element for cache keys: NFC, collapsed whitespace, no emoji prefix, casefolded."""
+    text = normalize_topic(segment)
+    head, _, rest = text.partition(' ')
+    if rest and not any(char.isalnum() for char in head):
+        text = rest
+    return text.casefold()
+
+
+def expansion_cache_key(node_path, emojis_enabled):
+    """Content address of an expansion: normalized path, emoji mode, model and prompt version.
+
+    Paths that differ only in emoji prefixes, case or spacing share an entry,
+    so an expansion paid for by one user serves everyone.
+    """
+    segments = [normalize_path_segment(segment) for segment in node_path]
+    return make_cache_key('expand', segments, bool(emojis_enabled), GROQ_MODEL, PROMPT_VERSION)
+
+
+def expand_path_cached(node_path, emojis_enabled):
+    """expand_path() served from expansion_cache, sharing in-flight speculative calls."""
+    key = expansion_cache_key(node_path, emojis_enabled)
+    nodes = expansion_cache.get_or_compute(key, lambda: expand_path(node_path, emojis_enabled))
+    prefetcher.consume(key)
+    return nodes
+
+
+def hydrate_expansion(node_path, nodes, emojis_enabled):
+    """Attach cached expansions of the returned nodes (and of their children) as nested children.
+
+    Walks breadth-first up to EXPANSION_HYDRATE_DEPTH levels below node_path
+    and stops adding once the subtree would exceed EXPANSION_HYDRATE_MAX_NODES.
+    Returns a new list; cached values are never mutated.
+    """
+    nodes = copy.deepcopy(nodes)
+    total = len(nodes)
+    level = [(list(node_path), nodes)]
+    for depth in range(EXPANSION_HYDRATE_DEPTH):
+        next_level = []
+        for parent_path, children in level:
+            for node in children:
+                if node.get('children'):
+                    continue
+                child_path = parent_path + [node.get('content', '')]
+                child_key = expansion_cache_key(child_path, emojis_enabled)
+                cached = expansion_cache.peek(child_key)
+                if not cached or total + len(cached) > EXPANSION_HYDRATE_MAX_NODES:
+                    continue
+                prefetcher.consume(child_key)
+                node['children'] = copy.deepcopy(cached)
+                total += len(cached)
+                EXPANSION_HYDRATIONS.inc()
+                next_level.append((child_path, node['children']))
+        if not next_level:
+            break
+        level = next_level
+    return nodes
+
+
+# Spekulatywne rozwijanie węzłów po wygenerowaniu mapy (opt-in)
+SPECULATIVE_PREFETCH = os.getenv('SPECULATIVE_PREFETCH') == '1'
+PREFETCH_TOP_K = int(os.getenv('PREFETCH_TOP_K', 4))
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 2))
+PREFETCH_USER_BUDGET = int(os.getenv('PREFETCH_USER_BUDGET', 40))
+PREFETCH_BUDGET_WINDOW = float(os.getenv('PREFETCH_BUDGET_WINDOW', 3600))
+# Po ilu sekundach (mniej więcej długość sesji) nieodczytany prefetch liczymy jako zmarnowany
+PREFETCH_WASTE_WINDOW = float(os.getenv('PREFETCH_WASTE_WINDOW', 1800))
+PREFETCH_MAX_OUTSTANDING = int(os.getenv('PREFETCH_MAX_OUTSTANDING', 10000))
+
+
+def prefetch_paths(map_data, limit):
+    """Return up to `limit` leaf paths, shallowest first, as expand_node() would receive them."""
+    paths = []
+    queue = [([map_data.get('content', '')], map_data)]
+    while queue and len(paths) < limit:
+        next_level = []
+        for path, node in queue:
+            children = [child for child in node.get('children') or [] if isinstance(child, dict)]
+            if not children and len(path) > 1:
+                paths.append(path)
+                if len(paths) == limit:
+                    break
+            next_level.extend((path + [child.get('content', '')], child) for child in children)
+        queue = next_level
+    return paths
+
+
+class SpeculativePrefetcher:
+    """Expands the likeliest next clicks of a freshly generated map in the background.
+
+    Results land in expansion_cache, so a later /expand-node for the same
+    path is answered from memory, or joins the call that is still running.
+    Each user may start at most `budget` speculative calls per
+    `budget_window` seconds, and nothing is prefetched while real requests
+    are queuing for the LLM. A prefetched entry counts as a hit when a
+    request reads it within `waste_window` seconds and as wasted otherwise;
+    at most `max_outstanding` unread entries are tracked (the oldest are
+    counted as wasted first).
+    """
+
+    def __init__(self, enabled, workers, top_k, budget, budget_window, waste_window, max_outstanding):
+        self.enabled = enabled
+        self.workers = workers
+        self.top_k = top_k
+        self.budget = budget
+        self.budget_window = budget_window
+        self.waste_window = waste_window
+        self.max_outstanding = max_outstanding
+        self._pool = None
+        self._lock = threading.Lock()
+        self._spent = {}
+        self._outstanding = OrderedDict()
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped_budget = 0
+        self.skipped_busy = 0
+        self.skipped_cached = 0
+        self.hits = 0
+        self.wasted = 0
+
+    def _take_budget(self, user_id, now):
+        window_start, spent = self._spent.get(user_id, (now, 0))
+        if now - window_start >= self.budget_window:
+            window_start, spent = now, 0
+        if spent >= self.budget:
+            return False
+        self._spent[user_id] = (window_start, spent + 1)
+        return True
+
+    def _expire(self, now):
+        while self._outstanding:
+            key, expires = next(iter(self._outstanding.items()))
+            if expires > now:
+                break
+            self._outstanding.popitem(last=False)
+            self.wasted += 1
+        while len(self._outstanding) > self.max_outstanding:
+            self._outstanding.popitem(last=False)
+            self.wasted += 1
+
+    def schedule(self, user_id, map_data, emojis_enabled):
+        """Queue speculative expansions for the leaf paths of map_data."""
+        if not self.enabled or not isinstance(map_data, dict):
+            return
+        if llm_scheduler.busy():
+            with self._lock:
+                self.skipped_busy += 1
+            return
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+            for node_path in prefetch_paths(map_data, self.top_k):
+                key = expansion_cache_key(node_path, emojis_enabled)
+                if key in expansion_cache or key in self._outstanding:
+                    self.skipped_cached += 1
+                    continue
+                if not self._take_budget(user_id, now):
+                    self.skipped_budget += 1
+                    break
+                self.scheduled += 1
+                self._pool.submit(self._run, key, node_path, emojis_enabled)
+
+    def _run(self, key, node_path, emojis_enabled):
+        def compute():
+            with self._lock:
+                self._outstanding[key] = time.time() + self.waste_window
+                self._expire(time.time())
+            return expand_path(node_path, emojis_enabled)
+
+        try:
+            expansion_cache.get_or_compute(key, compute)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            with self._lock:
+                self._outstanding.pop(key, None)
+                self.failed += 1
+            log.warning(f"⚠️ Speculative expansion failed for {node_path}: {e}")
+
+    def consume(self, key):
+        """Record that a request was served by (or joined) a speculative expansion."""
+        with self._lock:
+            if self._outstanding.pop(key, None) is not None:
+                self.hits += 1
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.time())
+            settled = self.hits + self.wasted
+            return {
+                'enabled': self.enabled,
+                'scheduled': self.scheduled,
+                'completed': self.completed,
+                'failed': self.failed,
+                'skippedBudget': self.skipped_budget,
+                'skippedBusy': self.skipped_busy,
+                'skippedCached': self.skipped_cached,
+                'pending': len(self._outstanding),
+                'hits': self.hits,
+                'wasted': self.wasted,
+                'hitRate': round(self.hits / settled, 4) if settled else 0.0
+            }
+
+
+prefetcher = SpeculativePrefetcher(SPECULATIVE_PREFETCH, PREFETCH_WORKERS, PREFETCH_TOP_K,
+                                   PREFETCH_USER_BUDGET, PREFETCH_BUDGET_WINDOW, PREFETCH_WASTE_WINDOW,
+                                   PREFETCH_MAX_OUTSTANDING)
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+
+def _bearer_token_matches(expected):
+    """Check the request's bearer token against a configured secret in constant time."""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(header[len('Bearer '):].encode('utf-8'), expected.encode('utf-8'))
+
+def _cache_gauge_lines():
+    lines = ['# HELP flowmind_cache_events_total Result cache lookups by cache and outcome.',
+             '# TYPE flowmind_cache_events_total counter']
+    for cache in (map_cache, token_cache, expansion_cache, explanation_cache,
+                  map_read_cache.documents, map_read_cache.listings):
+        stats = cache.stats()
+        for outcome, field in (('hit', 'hits'), ('disk_hit', 'diskHits'), ('miss', 'misses'), ('coalesced', 'coalesced')):
+            lines.append(f'flowmind_cache_events_total{_format_labels((("cache", cache.name), ("outcome", outcome)))} {stats[field]}')
+    lines += ['# HELP flowmind_cache_entries Entries held in memory by each result cache.',
+              '# TYPE flowmind_cache_entries gauge']
+    for cache in (map_cache, token_cache, expansion_cache, explanation_cache,
+                  map_read_cache.documents, map_read_cache.listings):
+        lines.append(f'flowmind_cache_entries{_format_labels((("cache", cache.name),))} {cache.stats()["size"]}')
+    prefetch = prefetcher.stats()
+    lines += ['# HELP flowmind_prefetch_expansions_total Speculative expansions by outcome.',
+              '# TYPE flowmind_prefetch_expansions_total counter']
+    for outcome, field in (('scheduled', 'scheduled'), ('completed', 'completed'), ('failed', 'failed'),
+                           ('skipped_budget', 'skippedBudget'), ('skipped_busy', 'skippedBusy'),
+                           ('hit', 'hits'), ('wasted', 'wasted')):
+        lines.append(f'flowmind_prefetch_expansions_total{_format_labels((("outcome", outcome),))} {prefetch[field]}')
+    scheduler = llm_scheduler.stats()
+    lines += ['# HELP flowmind_llm_queue_depth LLM calls waiting for a scheduler slot.',
+              '# TYPE flowmind_llm_queue_depth gauge',
+              f'flowmind_llm_queue_depth {scheduler["queued"]}',
+              '# HELP flowmind_llm_active_calls LLM calls currently holding a scheduler slot.',
+              '# TYPE flowmind_llm_active_calls gauge',
+              f'flowmind_llm_active_calls {scheduler["active"]}']
+    return lines
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of request, phase, LLM, Firestore and cache metrics (requires METRICS_TOKEN)."""
+    # Bez skonfigurowanego METRICS_TOKEN endpoint nie istnieje
+    if not METRICS_TOKEN:
+        return jsonify({'error': 'Nie znaleziono'}), 404
+    if not _bearer_token_matches(METRICS_TOKEN):
+        return jsonify({'error': 'Brak dostępu'}), 401
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(_cache_gauge_lines())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
-        return f(*args, **kwargs)
-    return decorated_function
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+@app.route('/admin/expansion-cache', methods=['GET', 'DELETE'])
+def admin_expansion_cache():
+    """Inspect or invalidate the shared expansion cache (requires ADMIN_TOKEN).
 
-@app.route('/generate-map', methods=['POST'])
+    GET returns cache, hydration and prefetch statistics. DELETE with
+    {"paths": [[...], ...]} drops those paths in both emoji modes; DELETE
+    without a body clears the whole cache (e.g. after a prompt change).
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Nie znaleziono'}), 404
+    if not _bearer_token_matches(ADMIN_TOKEN):
+        return jsonify({'error': 'Brak dostępu'}), 401
+    if request.method == 'GET':
+        return jsonify({
+            'cache': expansion_cache.stats(),
+            'hydratedSubtrees': EXPANSION_HYDRATIONS.value(),
+            'prefetch': prefetcher.stats(),
+            'promptVersion': PROMPT_VERSION,
+            'model': GROQ_MODEL
+        }), 200
+
+    data = request.get_json(silent=True) or {}
+    paths = data.get('paths')
+    if paths is None:
+        removed = expansion_cache.clear()
+        log.info(f"🧹 Expansion cache cleared ({removed} entries)")
+        return jsonify({'removed': removed}), 200
+    if not isinstance(paths, list) or not all(isinstance(path, list) and path for path in paths):
+        return jsonify({'error': 'Pole paths musi być listą niepustych ścieżek'}), 400
+    removed = 0
+    for node_path in paths:
+        for emojis_enabled in (False, True):
+            removed += expansion_cache.delete(expansion_cache_key(node_path, emojis_enabled))
+    return jsonify({'removed': removed}), 200
+
+@app.route('/expand-node', methods=['POST'])
 @require_auth
-def generate_map():
-    """Generate a complete mind map for the requested topic."""
-    topic = request.json.get('topic')
-    emojis_enabled = request.json.get('emojisEnabled', False)
+@rate_limited()
+def expand_node():
+    """Expand a single branch of the mind map.
+
+    With "hydrate": true, children that are already in the expansion cache
+    come back with their own cached subtrees nested under them.
+    """
+    data = request.json
+    node_path = data.get('path')
+    emojis_enabled = data.get('emojisEnabled', False)
     
-    if not topic:
-        return jsonify({'error': 'Nie podano tematu'}), 400
+    if not node_path:
+        return jsonify({'error': 'Nie podano ścieżki do rozwinięcia'}), 400
 
     try:
+        final_nodes = expand_path_cached(node_path, emojis_enabled)
+        if data.get('hydrate'):
+            final_nodes = hydrate_expansion(node_path, final_nodes, emojis_enabled)
 
-        if emojis_enabled:
-            system_prompt = f"""
-            Jesteś ekspertem w tworzeniu zwięzłych, hierarchicznych map myśli na temat: "{topic}".
-            
-            KRYTYCZNE WYMAGANIA:
-            1. Odpowiedz ZAWSZE w formacie JSON, bez żadnego dodatkowego tekstu.
-            2. Każdy węzeł MUSI zawierać dwa pola: "text" (treść węzła) oraz "emoji" (jedno pasujące emoji Unicode).
-            3. Struktura główna: {{"text": "{topic}", "emoji": "🧠", "children": [...]}}
-            4. Każdy element w "children" również ma "text", "emoji" i opcjonalnie "children".
-            5. Wybieraj emoji, które WIZUALNIE reprezentują dany temat (np. ☀️ dla światła, 🌙 dla ciemności, 📚 dla nauki).
-            6. Używaj WYŁĄCZNIE pojedynczych emoji Unicode (np. "🔬", "💡", "🌍").
-            7. Celuj w 2-4 poziomy zagnieżdzenia na start.
-            
-            Przykład prawidłowej struktury:
-            {{
-              "text": "Fotosynteza",
-              "emoji": "🌱",
-              "children": [
-                {{"text": "Faza świetlna", "emoji": "☀️", "children": [...]}},
-                {{"text": "Faza ciemna", "emoji": "🌙"}}
-              ]
-            }}
-            """
-        else:
-            system_prompt = f"""
-            Jesteś ekspertem w tworzeniu zwięzłych, hierarchicznych map myśli na temat: "{topic}".
-            
-            KRYTYCZNE WYMAGANIA:
-            1. Odpowiedz ZAWSZE w formacie JSON, bez żadnego dodatkowego tekstu.
-            2. Struktura główna: {{"content": "{topic}", "children": [...]}}
-            3. Każdy węzeł ma klucz "content" z treścią. Węzły z podpunktami mają "children".
-            4. Celuj w 2-4 poziomy zagnieżdzenia na start.
-            
-            Przykład prawidłowej struktury:
-            {{
-              "content": "Fotosynteza",
-              "children": [
-                {{"content": "Faza świetlna", "children": [...]}},
-                {{"content": "Faza ciemna"}}
-              ]
-            }}
-            """
-
-        chat_completion = client.chat.completions.create(
-            messages=[{"role": "system", "content": system_prompt}],
-            model=GROQ_MODEL,
-            response_format={"type": "json_object"},
-            temperature=0.2
-        )
-
-        map_data_string = chat_completion.choices[0].message.content
-        map_data = json.loads(map_data_string)
-        
-        if emojis_enabled:
-            def add_emoji_to_content(node):
-                """Recursively append an emoji to the content field."""
-                emoji = node.get('emoji', '📌')
-                text = node.get('text', node.get('content', ''))
-                node['content'] = f"{emoji} {text}"
-                
-                node.pop('text', None)
-                node.pop('emoji', None)
-                
-                if 'children' in node and isinstance(node['children'], list):
-                    for child in node['children']:
-                        add_emoji_to_content(child)
-                
-                return node
-            
-            map_data = add_emoji_to_content(map_data)
-        
-        return jsonify(map_data)
+        return jsonify(final_nodes)
 
+    except (AdmissionRejected, LLMUnavailable):
+        raise
     except Exception as e:
-        print(f"Groq error while generating the map: {e}")
-        return jsonify({'error': 'Wystąpił błąd podczas komunikacji z AI.'}), 500
+        log.exception(f"❌ Groq error while expanding a node: {e}")
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/expand-node', methods=['POST'])
+@app.route('/expand-nodes', methods=['POST'])
 @require_auth
-def expand_node():
-    """Expand a single branch of the mind map."""
+@rate_limited(cost=lambda data: len(data['paths']) if isinstance(data, dict) and isinstance(data.get('paths'), list) else 1)
+def expand_nodes():
+    """Expand many branches in one request; returns per-path results in request order."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Treść zapytania musi być obiektem JSON'}), 400
+    paths = data.get('paths')
+    emojis_enabled = data.get('emojisEnabled', False)
+    pack_siblings = data.get('packSiblings', True)
+
+    if not isinstance(paths, list) or not paths:
+        return jsonify({'error': 'Nie podano ścieżek do rozwinięcia'}), 400
+    if len(paths) > EXPAND_BATCH_MAX_PATHS:
+        return jsonify({'error': f'Maksymalnie {EXPAND_BATCH_MAX_PATHS} ścieżek na zapytanie'}), 400
+    if not all(isinstance(p, list) and p and all(isinstance(x, str) for x in p) for p in paths):
+        return jsonify({'error': 'Każda ścieżka musi być niepustą listą tekstów'}), 400
+
+    return jsonify({'results': expand_paths_batch(paths, emojis_enabled, pack_siblings)}), 200
+
+@app.route('/expand-node/stream', methods=['POST'])
+@require_auth
+@rate_limited()
+def expand_node_stream():
+    """Stream the expansion of a single branch as Server-Sent Events."""
     data = request.json
     node_path = data.get('path')
     emojis_enabled = data.get('emojisEnabled', False)
@@ -170,165 +3229,237 @@ def expand_node():
         return jsonify({'error': 'Nie podano ścieżki do rozwinięcia'}), 400
 
     context = " -> ".join(node_path)
+    key = expansion_cache_key(node_path, emojis_enabled)
 
-    try:
+    def generate():
+        cached = expansion_cache.get(key, _MISSING)
+        if cached is not _MISSING:
+            # Trafienie w cache (także z prefetchu) odtwarzamy jednym zdarzeniem
+            prefetcher.consume(key)
+            yield sse_event('done', cached)
+            return
+        try:
+            index = 0
+            for path, node in _stream_completion(build_expand_prompt(context, emojis_enabled), root_is_node=False):
+                if path == 'done':
+                    final_nodes = normalize_expanded_nodes(node, emojis_enabled)
+                    expansion_cache.set(key, final_nodes)
+                    yield sse_event('done', final_nodes)
+                    break
+                # Węzeł zostaje w dokumencie parsera, więc nie normalizujemy go w miejscu
+                if not node_content(node, False):
+                    continue
+                yield sse_event('node', {'path': [index], 'content': _node_display_content(node, emojis_enabled)})
+                index += 1
+        except (AdmissionRejected, LLMUnavailable) as e:
+            yield sse_event('error', {'error': str(e), 'retryAfter': e.retry_after})
+        except Exception as e:
+            log.error(f"❌ Groq error while streaming a node expansion: {e}")
+            yield sse_event('error', {'error': str(e)})
 
-        if emojis_enabled:
-            system_prompt = f"""
-            Kontekst: "{context}". Wygeneruj TYLKO listę podpunktów dla OSTATNIEGO elementu.
-            
-            KRYTYCZNE WYMAGANIA:
-            1. Odpowiedz w formacie JSON jako obiekt zawierający klucz "nodes" z listą.
-            2. Każdy element listy MUSI zawierać "text" (treść) i "emoji" (jedno pasujące emoji Unicode).
-            3. Format: {{"nodes": [{{"text": "...", "emoji": "🔥"}}, {{"text": "...", "emoji": "💧"}}]}}
-            4. Wybieraj emoji, które WIZUALNIE reprezentują temat (np. 🔬 nauka, 💡 pomysł, 🌍 świat).
-            5. Używaj WYŁĄCZNIE pojedynczych emoji Unicode.
-            6. Jeśli nie ma podpunktów, zwróć: {{"nodes": []}}
-            
-            Przykład prawidłowej odpowiedzi:
-            {{
-              "nodes": [
-                {{"text": "Definicja", "emoji": "📖"}},
-                {{"text": "Przykłady", "emoji": "💡"}},
-                {{"text": "Zastosowania", "emoji": "🔧"}}
-              ]
-            }}
-            """
-        else:
-            system_prompt = f"""
-            Kontekst: "{context}". Wygeneruj TYLKO listę podpunktów dla OSTATNIEGO elementu.
-            
-            KRYTYCZNE WYMAGANIA:
-            1. Odpowiedz w formacie JSON jako obiekt zawierający klucz "nodes" z listą.
-            2. Każdy element listy ma pole "content" z treścią węzła.
-            3. Format: {{"nodes": [{{"content": "..."}}, {{"content": "..."}}]}}
-            4. Jeśli nie ma podpunktów, zwróć: {{"nodes": []}}
-            
-            Przykład prawidłowej odpowiedzi:
-            {{
-              "nodes": [
-                {{"content": "Definicja"}},
-                {{"content": "Przykłady"}},
-                {{"content": "Zastosowania"}}
-              ]
-            }}
-            """
-
-        chat_completion = client.chat.completions.create(
-            messages=[{"role": "system", "content": system_prompt}],
-            model=GROQ_MODEL,
-            response_format={"type": "json_object"},
-            temperature=0.2
-        )
+    return _sse_response(generate())
 
-        response_data = json.loads(chat_completion.choices[0].message.content)
+EXPLANATION_MAX_TOKENS = int(os.getenv('EXPLANATION_MAX_TOKENS', 1024))
+EXPLANATION_MAX_PROMPT_CHARS = int(os.getenv('EXPLANATION_MAX_PROMPT_CHARS', 8000))
+EXPLANATION_CACHE_SIZE = int(os.getenv('EXPLANATION_CACHE_SIZE', 1024))
+EXPLANATION_CACHE_TTL = float(os.getenv('EXPLANATION_CACHE_TTL', 24 * 3600))
 
-        final_nodes = []
-        data_to_check = None
-
-        if isinstance(response_data, list):
-            data_to_check = response_data
-        elif isinstance(response_data, dict):
-            potential_nodes = response_data.get('children') or response_data.get('nodes')
-            if isinstance(potential_nodes, list):
-                data_to_check = potential_nodes
-
-        if data_to_check is not None:
-            if emojis_enabled:
-                for item in data_to_check:
-                    if isinstance(item, dict):
-                        emoji = item.get('emoji', '📌')
-                        text = item.get('text', item.get('content', '')).strip()
-                        
-                        if text:
-                            final_nodes.append({'content': f"{emoji} {text}"})
-            else:
-                for item in data_to_check:
-                    if isinstance(item, dict) and 'content' in item:
-                        content = item['content'].strip()
-                        if content:
-                            final_nodes.append({'content': content})
+explanation_cache = ResultCache('explanations', EXPLANATION_CACHE_SIZE, EXPLANATION_CACHE_TTL)
 
-        return jsonify(final_nodes)
 
-    except Exception as e:
-        import traceback
-        print(f"❌ Groq error while expanding a node: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+def _explanation_request():
+    """Validate the prompt; return (prompt, cache_key, None) or (None, None, error response)."""
+    prompt_content = request.json.get('prompt') if request.json else None
+    if not prompt_content or not isinstance(prompt_content, str):
+        return None, None, (jsonify({'error': 'Brak promptu'}), 400)
+    if len(prompt_content) > EXPLANATION_MAX_PROMPT_CHARS:
+        return None, None, (jsonify({'error': f'Prompt jest za długi (maks. {EXPLANATION_MAX_PROMPT_CHARS} znaków)'}), 413)
+    cache_key = make_cache_key('explain', prompt_content, GROQ_MODEL, EXPLANATION_MAX_TOKENS)
+    return prompt_content, cache_key, None
+
+
+def _explanation_kwargs(prompt_content):
+    return {
+        'messages': [{"role": "system", "content": prompt_content}],
+        'model': GROQ_MODEL,
+        'temperature': 0.4,
+        'max_tokens': EXPLANATION_MAX_TOKENS
+    }
+
+
+def _generate_explanation(prompt_content):
+    chat_completion = llm_create(**_explanation_kwargs(prompt_content))
+    choice = chat_completion.choices[0]
+    return {
+        'explanation': choice.message.content,
+        'truncated': getattr(choice, 'finish_reason', None) == 'length'
+    }
+
 
 @app.route('/get-explanation', methods=['POST'])
 @require_auth
+@rate_limited()
 def get_explanation():
-    """Generate an explanation based on the provided prompt."""
-    print("🔍 /get-explanation invoked")
-    prompt_content = request.json.get('prompt') if request.json else None
-    
-    if not prompt_content:
-        return jsonify({'error': 'Brak promptu'}), 400
+    """Generate an explanation based on the provided prompt (cached by prompt hash and model)."""
+    log.debug("🔍 /get-explanation invoked")
+    prompt_content, cache_key, error = _explanation_request()
+    if error:
+        return error
     
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[{
-                "role": "system",
-                "content": prompt_content
-            }],
-            model=GROQ_MODEL,
-            temperature=0.4
-        )
-        
-        explanation_text = chat_completion.choices[0].message.content
-        return jsonify({"explanation": explanation_text})
+        result = explanation_cache.get_or_compute(cache_key, lambda: _generate_explanation(prompt_content))
+        return jsonify(result)
     
+    except (AdmissionRejected, LLMUnavailable):
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/get-explanation/stream', methods=['POST'])
+@require_auth
+@rate_limited()
+def get_explanation_stream():
+    """Stream an explanation as Server-Sent Events: 'token' events with text deltas, then 'done'."""
+    prompt_content, cache_key, error = _explanation_request()
+    if error:
+        return error
+
+    def generate():
+        cached = explanation_cache.get(cache_key, _MISSING)
+        if cached is not _MISSING:
+            yield sse_event('token', {'text': cached['explanation']})
+            yield sse_event('done', cached)
+            return
+        try:
+            parts = []
+            finish_reason = None
+            for chunk in llm_stream(**_explanation_kwargs(prompt_content)):
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = getattr(choice, 'finish_reason', None) or finish_reason
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    yield sse_event('token', {'text': choice.delta.content})
+            result = {'explanation': ''.join(parts), 'truncated': finish_reason == 'length'}
+            explanation_cache.set(cache_key, result)
+            yield sse_event('done', result)
+        except (AdmissionRejected, LLMUnavailable) as e:
+            yield sse_event('error', {'error': str(e), 'retryAfter': e.retry_after})
+        except Exception as e:
+            log.error(f"❌ Groq error while streaming an explanation: {e}")
+            yield sse_event('error', {'error': str(e)})
+
+    return _sse_response(generate())
+
+MAPS_PAGE_SIZE = int(os.getenv('MAPS_PAGE_SIZE', 50))
+MAPS_PAGE_SIZE_MAX = 200
+
 @app.route('/get-maps', methods=['GET'])
 @require_auth
 def get_maps():
-    """Fetch every user map from the users/{userID}/maps collection."""
+    """Fetch user maps from users/{userID}/maps.
+
+    With limit/cursor/view query parameters returns one page ordered by
+    lastUpdated: {'maps': [...], 'nextCursor': ...}. view=summary (default for
+    paged requests) returns only id, title and timestamps; view=full returns
+    whole documents. Without parameters returns every document (legacy).
+    """
     user_id = g.user_id
-    print(f"🔍 GET-MAPS: Fetching maps for user: {user_id}")
+    if any(param in request.args for param in ('limit', 'cursor', 'view')):
+        return _get_maps_page(user_id)
+
+    log.debug(f"🔍 GET-MAPS: Fetching maps for user: {user_id}")
     try:
-        maps_ref = db.collection('users').document(user_id).collection('maps')
-        maps_stream = maps_ref.stream()
-        
         maps_list = []
-        for doc in maps_stream:
-            map_data = doc.to_dict()
-            
-            print(f"📋 Map ID: {doc.id}")
-            print(f"   Document fields: {list(map_data.keys())}")
-            has_title = 'title' in map_data
-            has_content = 'content' in map_data
-            print(f"   Has 'title': {has_title}")
-            print(f"   Has 'content': {has_content}")
-            if not has_title:
-                print("   ⚠️ Missing 'title' field")
-            if not has_content:
-                print("   ⚠️ Missing 'content' field")
+        for doc_id, map_data in list_map_documents(user_id):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"📋 Map ID: {doc_id}")
+                log.debug(f"   Document fields: {list(map_data.keys())}")
+                has_title = 'title' in map_data
+                has_content = 'content' in map_data
+                log.debug(f"   Has 'title': {has_title}")
+                log.debug(f"   Has 'content': {has_content}")
+                if not has_title:
+                    log.debug("   ⚠️ Missing 'title' field")
+                if not has_content:
+                    log.debug("   ⚠️ Missing 'content' field")
             
-            map_data['id'] = doc.id
+            map_data = unpack_map_document(map_data)
+            map_data['id'] = doc_id
             maps_list.append(map_data)
         
-        print(f"✅ Returning {len(maps_list)} map(s)")
+        log.debug(f"✅ Returning {len(maps_list)} map(s)")
         return jsonify(maps_list), 200 
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _get_maps_page(user_id):
+    view = request.args.get('view', 'summary')
+    if view not in ('summary', 'full'):
+        return jsonify({'error': 'Parametr view musi mieć wartość summary lub full'}), 400
+    try:
+        limit = int(request.args.get('limit', MAPS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Parametr limit musi być liczbą'}), 400
+    limit = max(1, min(limit, MAPS_PAGE_SIZE_MAX))
+    cursor = request.args.get('cursor')
+
+    try:
+        documents = list_map_page(user_id, limit, cursor, summary=(view == 'summary'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    maps_list = []
+    for doc_id, map_data in documents:
+        if view == 'full':
+            map_data = unpack_map_document(map_data)
+        else:
+            map_data = {
+                'title': resolve_map_title(doc_id, map_data),
+                'createdAt': map_data.get('createdAt'),
+                'lastUpdated': map_data.get('lastUpdated')
+            }
+        map_data['id'] = doc_id
+        maps_list.append(map_data)
+
+    next_cursor = None
+    if len(documents) == limit:
+        last_id, last_data = documents[-1]
+        next_cursor = encode_page_cursor(last_id, last_data.get('lastUpdated'))
+    return jsonify({'maps': maps_list, 'nextCursor': next_cursor}), 200
+
+@app.route('/get-map/<map_id>', methods=['GET'])
+@require_auth
+def get_map(map_id):
+    """Fetch a single map document with its full tree."""
+    if not map_store.available():
+        return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
+    try:
+        map_data = get_map_document(g.user_id, map_id)
+        if map_data is None:
+            return jsonify({'error': 'Mapa nie znaleziona'}), 404
+        map_data = unpack_map_document(map_data)
+        map_data['id'] = map_id
+        return jsonify(map_data), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/create-map', methods=['POST'])
 @require_auth
 def create_map():
     """Create a new map document at users/{userID}/maps (title, content, mapData)."""
-    if db is None:
+    if not map_store.available():
         return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
     
     user_id = g.user_id
     data = request.json
     
-    print(f"🔍 CREATE-MAP: Request received from user: {user_id}")
-    print(f"   Incoming keys: {list(data.keys()) if data else 'NO DATA'}")
+    log.debug(f"🔍 CREATE-MAP: Request received from user: {user_id}")
+    log.debug(f"   Incoming keys: {list(data.keys()) if data else 'NO DATA'}")
     
     if not data:
         return jsonify({'error': 'Brak danych mapy'}), 400
@@ -336,49 +3467,44 @@ def create_map():
     content = data.get('content')
     title = data.get('title')
     
-    print(f"   Content provided: {content is not None}")
-    print(f"   Title: {title}")
+    log.debug(f"   Content provided: {content is not None}")
+    log.debug(f"   Title: {title}")
     
     if not content:
         return jsonify({'error': 'Brak pola content'}), 400
     
+    validate_client_tree(content)
     if not title:
-        if isinstance(content, dict) and 'content' in content:
-            title = str(content['content'])
-        else:
-            title = 'Bez nazwy'
-        print(f"   Generated title fallback: {title}")
+        title = content['content'] or 'Bez nazwy'
+        log.debug(f"   Generated title fallback: {title}")
     
     try:
         firestore_data = {
             'title': title,
-            'content': content,
-            'mapData': content,
+            'revision': 0,
             'createdAt': datetime.utcnow(),
             'lastUpdated': datetime.utcnow()
         }
-        print("📝 Persisting map to Firestore (title + content + mapData)")
-        maps_ref = db.collection('users').document(user_id).collection('maps')
-        write_time, doc_ref = maps_ref.add(firestore_data)
-        map_id = doc_ref.id
-        saved_doc = doc_ref.get()
-        saved_data = saved_doc.to_dict() if saved_doc.exists else None
-        print(f"✅ Created new map: {map_id}")
-        print(f"   Verified stored fields: {list(saved_data.keys()) if saved_data else 'NONE'}")
+        firestore_data.update(map_tree_fields(content))
+        log.debug(f"📝 Persisting map to Firestore (format: {MAP_STORAGE_FORMAT})")
+        map_id = add_map_document(user_id, firestore_data)
+        search_index.index_map(user_id, map_id, title, content)
+        log.info(f"✅ Created new map: {map_id}")
         return jsonify({
             'id': map_id,
             'title': title,
-            'content': content
+            'content': content,
+            'revision': 0
         }), 201
     except Exception as e:
-        print(f"❌ Map creation failed: {e}")
+        log.error(f"❌ Map creation failed: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/update-map', methods=['POST'])
 @require_auth
 def update_map_post():
     """Update an existing map using documentId and newMapData/newMapContent."""
-    if db is None:
+    if not map_store.available():
         return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
     
     user_id = g.user_id
@@ -390,30 +3516,31 @@ def update_map_post():
         return jsonify({'error': 'Brak documentId'}), 400
     if new_map is None:
         return jsonify({'error': 'Brak newMapData/newMapContent'}), 400
+    validate_client_tree(new_map, user_id, document_id)
     
     try:
-        map_ref = db.collection('users').document(user_id).collection('maps').document(document_id)
-        if not map_ref.get().exists:
+        update_payload = {'lastUpdated': datetime.utcnow(), 'revision': firestore.Increment(1)}
+        if write_buffer.enabled:
+            if not write_buffer.is_pending(user_id, document_id) and not map_document_exists(user_id, document_id):
+                return jsonify({'error': 'Mapa nie znaleziona'}), 404
+            write_buffer.enqueue(user_id, document_id, update_payload, tree=new_map)
+            search_index.index_map(user_id, document_id, tree=new_map)
+            return jsonify({'id': document_id, 'updated': True, 'buffered': True}), 200
+        update_payload.update(map_tree_fields(new_map, for_update=True))
+        if not update_map_document(user_id, document_id, update_payload):
             return jsonify({'error': 'Mapa nie znaleziona'}), 404
-        update_payload = {
-            'content': new_map,
-            'mapData': new_map,
-            'lastUpdated': datetime.utcnow()
-        }
-        map_ref.update(update_payload)
-        print(f"✅ [POST /update-map] Updated map {document_id} (user: {user_id}); fields: {list(update_payload.keys())}")
+        search_index.index_map(user_id, document_id, tree=new_map)
+        log.info(f"✅ [POST /update-map] Updated map {document_id} (user: {user_id}); fields: {list(update_payload.keys())}")
         return jsonify({'id': document_id, 'updated': True}), 200
     except Exception as e:
-        import traceback
-        print(f"❌ Map update failed (POST /update-map): {e}")
-        traceback.print_exc()
+        log.exception(f"❌ Map update failed (POST /update-map): {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/update-map/<map_id>', methods=['PUT', 'PATCH'])
 @require_auth
 def update_map(map_id):
     """Update map title/content in users/{userID}/maps and mirror mapData."""
-    if db is None:
+    if not map_store.available():
         return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
     
     user_id = g.user_id
@@ -421,133 +3548,728 @@ def update_map(map_id):
     
     if not data:
         return jsonify({'error': 'Brak danych do aktualizacji'}), 400
+    if 'content' in data:
+        validate_client_tree(data['content'], user_id, map_id)
     
     try:
-        map_ref = db.collection('users').document(user_id).collection('maps').document(map_id)
-        map_doc = map_ref.get()
-        if not map_doc.exists:
-            return jsonify({'error': 'Mapa nie znaleziona'}), 404
         update_data = {
-            'lastUpdated': datetime.utcnow()
+            'lastUpdated': datetime.utcnow(),
+            'revision': firestore.Increment(1)
         }
-        if 'content' in data:
-            update_data['content'] = data['content']
-            update_data['mapData'] = data['content']
         if 'title' in data:
             update_data['title'] = data['title']
-        map_ref.update(update_data)
-        print(f"✅ Updated map: {map_id} for user: {user_id}")
+        if write_buffer.enabled:
+            if not write_buffer.is_pending(user_id, map_id) and not map_document_exists(user_id, map_id):
+                return jsonify({'error': 'Mapa nie znaleziona'}), 404
+            write_buffer.enqueue(user_id, map_id, update_data, tree=data.get('content', _MISSING))
+            search_index.index_map(user_id, map_id, data.get('title'), data.get('content', _MISSING))
+            return jsonify({'id': map_id, 'updated': True, 'buffered': True}), 200
+        if 'content' in data:
+            update_data.update(map_tree_fields(data['content'], for_update=True))
+        if not update_map_document(user_id, map_id, update_data):
+            return jsonify({'error': 'Mapa nie znaleziona'}), 404
+        search_index.index_map(user_id, map_id, data.get('title'), data.get('content', _MISSING))
+        log.info(f"✅ Updated map: {map_id} for user: {user_id}")
         return jsonify({'id': map_id, 'updated': True}), 200
     except Exception as e:
-        print(f"❌ Map update error: {e}")
+        log.error(f"❌ Map update error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/patch-map/<map_id>', methods=['POST'])
+@require_auth
+def patch_map(map_id):
+    """Apply RFC 6902 operations to a stored map tree, guarded by its revision number.
+
+    Body: {"operations": [...], "revision": n}. Without "revision" the patch is
+    applied to whatever is stored (use "test" operations to guard it).
+    """
+    if not map_store.available():
+        return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
+
+    data = request.json or {}
+    operations = data.get('operations')
+    expected_revision = data.get('revision')
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'Brak operacji patch'}), 400
+    if expected_revision is not None and not isinstance(expected_revision, int):
+        return jsonify({'error': 'Pole revision musi być liczbą całkowitą'}), 400
+
+    try:
+        operations = normalize_patch_values(operations)
+        revision = patch_map_document(g.user_id, map_id, operations, expected_revision)
+    except RevisionConflict as e:
+        return jsonify({'error': str(e), 'revision': e.current_revision}), 409
+    except TreeValidationError:
+        raise
+    except JsonPatchTestFailed as e:
+        return jsonify({'error': str(e)}), 409
+    except JsonPatchError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error(f"❌ Map patch failed: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    if revision is None:
+        return jsonify({'error': 'Mapa nie znaleziona'}), 404
+    search_index.invalidate(g.user_id, map_id)
+    # Wartości po normalizacji (w kolejności operacji), żeby klient zsynchronizował swoje drzewo
+    values = [operation.get('value') if isinstance(operation, dict) and operation.get('op') in ('add', 'replace') else None
+              for operation in operations]
+    return jsonify({'id': map_id, 'revision': revision, 'values': values}), 200
+
+# Indeks wyszukiwania: ilu użytkowników trzymać w pamięci i po ilu sekundach odbudować indeks z bazy
+SEARCH_INDEX_MAX_USERS = int(os.getenv('SEARCH_INDEX_MAX_USERS', 500))
+SEARCH_INDEX_TTL = float(os.getenv('SEARCH_INDEX_TTL', 600))
+# Ile razy ponowić budowę indeksu, gdy w jej trakcie zapisano mapę użytkownika
+SEARCH_INDEX_BUILD_ATTEMPTS = int(os.getenv('SEARCH_INDEX_BUILD_ATTEMPTS', 3))
+SEARCH_RESULTS_MAX = 100
+SEARCH_MATCHES_PER_MAP = 5
+# Parametry BM25 (nasycenie tf i normalizacja długości węzła)
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+_SEARCH_FOLD = str.maketrans({'ł': 'l', 'Ł': 'l', 'ø': 'o', 'đ': 'd', 'ß': 'ss'})
+_SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+
+def search_tokens(text):
+    """Split text into case- and diacritic-insensitive tokens ('Źródło' -> 'zrodlo')."""
+    text = unicodedata.normalize('NFKD', str(text).translate(_SEARCH_FOLD))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return _SEARCH_TOKEN_RE.findall(text)
+
+
+class UserSearchIndex:
+    """Inverted index over the node texts of one user's maps.
+
+    postings[token][map_id][node] holds the term frequency, so replacing a
+    map touches only that map's tokens and a query reads only the postings
+    of its own terms. Nodes are stored as (text, parent, pointer, length)
+    and paths are rebuilt only for returned matches.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_freq = {}
+        self.maps = {}
+        self.stale = set()
+        self.node_count = 0
+        self.token_count = 0
+        self.built_at = time.monotonic()
+
+    def add_map(self, map_id, title, tree):
+        self.remove_map(map_id)
+        nodes = []
+        tokens = {}
+        stack = [(tree, -1, '')] if isinstance(tree, dict) else []
+        while stack:
+            node, parent, pointer = stack.pop()
+            text = node.get('content', node.get('text', ''))
+            text = text if isinstance(text, str) else str(text)
+            node_tokens = search_tokens(text)
+            index = len(nodes)
+            nodes.append((text, parent, pointer, len(node_tokens)))
+            for token in node_tokens:
+                counts = tokens.setdefault(token, {})
+                counts[index] = counts.get(index, 0) + 1
+            children = node.get('children')
+            if isinstance(children, list):
+                for position in range(len(children) - 1, -1, -1):
+                    if isinstance(children[position], dict):
+                        stack.append((children[position], index, f'{pointer}/children/{position}'))
+        for token, counts in tokens.items():
+            self.postings.setdefault(token, {})[map_id] = counts
+            self.doc_freq[token] = self.doc_freq.get(token, 0) + len(counts)
+        self.maps[map_id] = {'title': title, 'nodes': nodes, 'tokens': list(tokens)}
+        self.node_count += len(nodes)
+        self.token_count += sum(node[3] for node in nodes)
+        self.stale.discard(map_id)
+
+    def remove_map(self, map_id):
+        entry = self.maps.pop(map_id, None)
+        if entry is None:
+            return
+        for token in entry['tokens']:
+            counts = self.postings[token].pop(map_id)
+            if not self.postings[token]:
+                del self.postings[token]
+                del self.doc_freq[token]
+            else:
+                self.doc_freq[token] -= len(counts)
+        self.node_count -= len(entry['nodes'])
+        self.token_count -= sum(node[3] for node in entry['nodes'])
+
+    def set_title(self, map_id, title):
+        if map_id in self.maps:
+            self.maps[map_id]['title'] = title
+
+    def node_path(self, map_id, index):
+        nodes = self.maps[map_id]['nodes']
+        path = []
+        while index >= 0:
+            path.append(nodes[index][0])
+            index = nodes[index][1]
+        return path[::-1]
+
+    def search(self, terms, limit):
+        """Rank maps by how many query terms they contain, then by their best node's BM25 score."""
+        if not self.node_count:
+            return 0, []
+        average_length = max(1.0, self.token_count / self.node_count)
+        node_scores = {}
+        map_terms = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            df = self.doc_freq[term]
+            idf = math.log(1 + (self.node_count - df + 0.5) / (df + 0.5))
+            for map_id, counts in postings.items():
+                map_terms.setdefault(map_id, set()).add(term)
+                nodes = self.maps[map_id]['nodes']
+                for index, tf in counts.items():
+                    norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * nodes[index][3] / average_length)
+                    key = (map_id, index)
+                    node_scores[key] = node_scores.get(key, 0.0) + idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+        by_map = {}
+        for (map_id, index), score in node_scores.items():
+            by_map.setdefault(map_id, []).append((score, index))
+        ranked = sorted(by_map.items(), key=lambda item: (len(map_terms[item[0]]), max(item[1])[0]), reverse=True)
+        results = []
+        for map_id, matches in ranked[:limit]:
+            matches.sort(reverse=True)
+            nodes = self.maps[map_id]['nodes']
+            results.append({
+                'id': map_id,
+                'title': self.maps[map_id]['title'],
+                'score': round(matches[0][0], 4),
+                'matchedTerms': len(map_terms[map_id]),
+                'matchCount': len(matches),
+                'matches': [{
+                    'text': nodes[index][0],
+                    'path': self.node_path(map_id, index),
+                    'pointer': nodes[index][2],
+                    'score': round(score, 4)
+                } for score, index in matches[:SEARCH_MATCHES_PER_MAP]]
+            })
+        return len(by_map), results
+
+
+class MapSearchIndex:
+    """Per-user UserSearchIndex instances, built from storage on a user's first search.
+
+    Map routes keep loaded indexes current: create/update pass the new tree,
+    patches only mark the map stale so it is re-read on the next search.
+    Users without a loaded index are skipped, and indexes older than `ttl`
+    are rebuilt to pick up writes made by other workers. While a user's index
+    is being built, writes bump that user's generation; a build that saw the
+    generation change may miss the write, so it is discarded and redone.
+    """
+
+    def __init__(self, max_users, ttl):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._generations = {}
+        self.builds = 0
+        self.discarded_builds = 0
+        self.refreshes = 0
+        self.queries = 0
+
+    def _loaded(self, user_id):
+        index = self._users.get(user_id)
+        if index is not None and time.monotonic() - index.built_at > self.ttl:
+            del self._users[user_id]
+            return None
+        return index
+
+    def _build(self, user_id):
+        index = UserSearchIndex()
+        for doc_id, map_data in list_map_documents(user_id):
+            index.add_map(doc_id, resolve_map_title(doc_id, map_data), extract_map_tree(map_data))
+        return index
+
+    def _index_for(self, user_id):
+        with self._lock:
+            index = self._loaded(user_id)
+            if index is not None:
+                self._users.move_to_end(user_id)
+                return index
+            build_lock = self._build_locks.setdefault(user_id, threading.Lock())
+        with build_lock:
+            with self._lock:
+                index = self._loaded(user_id)
+            attempt = 0
+            while index is None:
+                attempt += 1
+                with self._lock:
+                    self._generations[user_id] = 0
+                try:
+                    write_buffer.flush_user(user_id)
+                    built = self._build(user_id)
+                finally:
+                    with self._lock:
+                        changed = self._generations.pop(user_id)
+                if changed and attempt < SEARCH_INDEX_BUILD_ATTEMPTS:
+                    with self._lock:
+                        self.discarded_builds += 1
+                    log.info(f"🔎 Map written during the search index build for user {user_id}, rebuilding")
+                    continue
+                index = built
+                with self._lock:
+                    self.builds += 1
+                    # Po wyczerpaniu prób indeks służy tylko temu zapytaniu, następne zbuduje go od nowa
+                    if not changed:
+                        self._users[user_id] = index
+                        while len(self._users) > self.max_users:
+                            self._users.popitem(last=False)
+                    self._build_locks.pop(user_id, None)
+                log.info(f"🔎 Built search index for user {user_id}: {len(index.maps)} map(s), {index.node_count} node(s)")
+        return index
+
+    def _bump_generation(self, user_id):
+        if user_id in self._generations:
+            self._generations[user_id] += 1
+
+    def index_map(self, user_id, map_id, title=None, tree=_MISSING):
+        """Reindex one map of a loaded user; title=None keeps the indexed title."""
+        with self._lock:
+            self._bump_generation(user_id)
+            index = self._users.get(user_id)
+            if index is None:
+                return
+            if tree is _MISSING:
+                if title is not None:
+                    index.set_title(map_id, title)
+                return
+            if title is None:
+                title = index.maps[map_id]['title'] if map_id in index.maps else resolve_map_title(map_id, {'content': tree})
+            index.add_map(map_id, title, tree)
+
+    def invalidate(self, user_id, map_id):
+        with self._lock:
+            self._bump_generation(user_id)
+            index = self._users.get(user_id)
+            if index is not None:
+                index.stale.add(map_id)
+
+    def search(self, user_id, query, limit):
+        terms = list(dict.fromkeys(search_tokens(query)))
+        index = self._index_for(user_id)
+        with self._lock:
+            stale = list(index.stale)
+        for map_id in stale:
+            map_data = get_map_document(user_id, map_id)
+            with self._lock:
+                if map_data is None:
+                    index.remove_map(map_id)
+                    index.stale.discard(map_id)
+                else:
+                    index.add_map(map_id, resolve_map_title(map_id, map_data), extract_map_tree(map_data))
+                self.refreshes += 1
+        with self._lock:
+            self.queries += 1
+            total, results = index.search(terms, limit)
+        return terms, total, results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'maxUsers': self.max_users,
+                'ttlSeconds': self.ttl,
+                'maps': sum(len(index.maps) for index in self._users.values()),
+                'nodes': sum(index.node_count for index in self._users.values()),
+                'terms': sum(len(index.postings) for index in self._users.values()),
+                'builds': self.builds,
+                'discardedBuilds': self.discarded_builds,
+                'refreshes': self.refreshes,
+                'queries': self.queries
+            }
+
+
+search_index = MapSearchIndex(SEARCH_INDEX_MAX_USERS, SEARCH_INDEX_TTL)
+
+
+@app.route('/search', methods=['GET'])
+@require_auth
+def search_maps():
+    """Full-text search over the node texts of all the user's maps.
+
+    ?q=<query>&limit=<n>. Returns maps ranked by matched terms and BM25
+    score, each with its best matching nodes: text, path from the root and
+    the JSON Pointer usable with /patch-map.
+    """
+    if not map_store.available():
+        return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Brak parametru q'}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'Parametr limit musi być liczbą'}), 400
+    limit = max(1, min(limit, SEARCH_RESULTS_MAX))
+
+    try:
+        terms, total, results = search_index.search(g.user_id, query, limit)
+    except Exception as e:
+        log.error(f"❌ Search failed: {e}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'query': query, 'terms': terms, 'total': total, 'results': results}), 200
+
+EXPORT_FORMATS = {
+    'md': ('text/markdown; charset=utf-8', 'md'),
+    'txt': ('text/plain; charset=utf-8', 'txt'),
+    'opml': ('text/x-opml; charset=utf-8', 'opml'),
+    'json': ('application/json; charset=utf-8', 'json')
+}
+# Rozmiar porcji wysyłanej klientowi podczas eksportu (bajty tekstu przed zakodowaniem)
+EXPORT_CHUNK_CHARS = int(os.getenv('EXPORT_CHUNK_CHARS', 16 * 1024))
+
+
+def _walk_tree_events(tree):
+    """Iterative pre-order walk yielding ('open', depth, position, node) and ('close', depth, position, node).
+
+    The stack holds one child iterator per level, so memory grows with
+    tree depth, not size. 'close' is emitted after all descendants.
+    """
+    if not isinstance(tree, dict):
+        tree = {'content': '' if tree is None else str(tree)}
+    stack = [(None, 0, iter([(0, tree)]))]
+    while stack:
+        parent, depth, children = stack[-1]
+        entry = next(children, None)
+        if entry is None:
+            stack.pop()
+            if parent is not None:
+                yield 'close', depth - 1, parent[0], parent[1]
+            continue
+        position, node = entry
+        yield 'open', depth, position, node
+        stack.append(((position, node), depth + 1, enumerate(_export_children(node))))
+
+
+def _export_children(node):
+    children = node.get('children')
+    return [child for child in children if isinstance(child, dict)] if isinstance(children, list) else []
+
+
+def _export_text(node):
+    text = node.get('content', node.get('text', ''))
+    return ' '.join(str(text).split())
+
+
+def _export_lines(tree, fmt, title):
+    """Yield the export document piece by piece for one of EXPORT_FORMATS."""
+    if fmt == 'opml':
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<opml version="2.0">\n'
+        yield f'  <head><title>{html.escape(title)}</title></head>\n  <body>\n'
+    for event, depth, position, node in _walk_tree_events(tree):
+        if fmt == 'md':
+            if event == 'open':
+                yield f"{'  ' * depth}- {_export_text(node)}\n"
+        elif fmt == 'txt':
+            if event == 'open':
+                yield f"{'  ' * depth}{_export_text(node)}\n"
+        elif fmt == 'opml':
+            indent = '  ' * (depth + 2)
+            has_children = bool(_export_children(node))
+            if event == 'open':
+                outline = f'{indent}<outline text="{html.escape(_export_text(node), quote=True)}"'
+                yield f'{outline}>\n' if has_children else f'{outline}/>\n'
+            elif has_children:
+                yield f'{indent}</outline>\n'
+        else:
+            has_children = bool(_export_children(node))
+            if event == 'open':
+                fields = {key: value for key, value in node.items() if key != 'children'}
+                document = json.dumps(fields, ensure_ascii=False)
+                if has_children:
+                    document = document[:-1] + (', ' if fields else '') + '"children": ['
+                yield f', {document}' if position else document
+            elif has_children:
+                yield ']}'
+    if fmt == 'opml':
+        yield '  </body>\n</opml>\n'
+
+
+def _chunked(pieces, size):
+    """Join small string pieces into chunks of about `size` characters."""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _export_filename(title, extension):
+    stem = unicodedata.normalize('NFKD', title.translate(_SEARCH_FOLD)).encode('ascii', 'ignore').decode('ascii')
+    stem = re.sub(r'[^a-z0-9]+', '_', stem.lower()).strip('_')[:50]
+    return f"{stem or 'mapa'}.{extension}"
+
+
+@app.route('/export/<map_id>', methods=['GET'])
+@require_auth
+def export_map(map_id):
+    """Stream a stored map as ?format=md|txt|opml|json (default md) as a file download.
+
+    The tree is walked iteratively and written out in EXPORT_CHUNK_CHARS
+    chunks, so no second copy of the document is built in memory.
+    """
+    if not map_store.available():
+        return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
+    fmt = request.args.get('format', 'md')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Nieobsługiwany format eksportu (dostępne: {', '.join(EXPORT_FORMATS)})"}), 400
+    try:
+        map_data = get_map_document(g.user_id, map_id)
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
+    if map_data is None:
+        return jsonify({'error': 'Mapa nie znaleziona'}), 404
+
+    title = str(resolve_map_title(map_id, map_data))
+    tree = extract_map_tree(map_data)
+    del map_data
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    log.info(f"📤 Exporting map {map_id} as {fmt} (user: {g.user_id})")
+    return Response(
+        stream_with_context(_chunked(_export_lines(tree, fmt, title), EXPORT_CHUNK_CHARS)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{_export_filename(title, extension)}"'}
+    )
+
+MIGRATION_BATCH_SIZE = min(int(os.getenv('MIGRATION_BATCH_SIZE', 500)), 500)
+
+
+def build_migration_update(doc_id, map_data):
+    """Return the fields that bring a legacy document to the name + mapData structure, or None.
+
+    A document that already has the structure but no lastUpdated gets an
+    empty update, so the caller still stamps it and it shows up in the
+    ordered listing.
+    """
+    has_name = 'name' in map_data
+    has_mapData = 'mapData' in map_data or 'packedTree' in map_data
+
+    if has_name and has_mapData:
+        return None if map_data.get('lastUpdated') is not None else {}
+
+    update_data = {}
+
+    if not has_name:
+        if 'packedTree' in map_data:
+            update_data['name'] = map_data.get('title') or f'Mapa {doc_id[:8]}'
+        elif 'mapStructure' in map_data and isinstance(map_data['mapStructure'], dict):
+            if 'content' in map_data['mapStructure']:
+                update_data['name'] = str(map_data['mapStructure']['content'])
+            else:
+                update_data['name'] = f'Mapa {doc_id[:8]}'
+        elif 'mapData' in map_data and isinstance(map_data['mapData'], dict):
+            if 'content' in map_data['mapData']:
+                update_data['name'] = str(map_data['mapData']['content'])
+            else:
+                update_data['name'] = f'Mapa {doc_id[:8]}'
+        elif 'content' in map_data:
+            if isinstance(map_data['content'], dict) and 'content' in map_data['content']:
+                update_data['name'] = str(map_data['content']['content'])
+            else:
+                update_data['name'] = str(map_data['content'])
+        else:
+            update_data['name'] = f'Mapa {doc_id[:8]}'
+
+    if not has_mapData:
+        if 'mapStructure' in map_data:
+            update_data['mapData'] = map_data['mapStructure']
+        elif 'content' in map_data:
+            update_data['mapData'] = map_data['content']
+        else:
+            temp_data = dict(map_data)
+            temp_data.pop('name', None)
+            temp_data.pop('createdAt', None)
+            temp_data.pop('lastUpdated', None)
+            update_data['mapData'] = temp_data
+
+    if 'mapData' in update_data and 'content' not in map_data:
+        update_data['content'] = update_data['mapData']
+
+    return update_data
+
+
+class MigrationJob:
+    """Background migration of one user's maps, committed in batches of up to 500 writes.
+
+    Progress is mirrored to users/{uid}/jobs/{job_id} (through map_store) so
+    any worker can report it, and `cursor` (the last processed document id)
+    lets a new job resume.
+    """
+
+    def __init__(self, user_id, cursor=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.cursor = cursor
+        self.status = 'running'
+        self.migrated = 0
+        self.skipped = 0
+        self.errors = []
+        self.started_at = datetime.utcnow()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'migrated': self.migrated,
+            'skipped': self.skipped,
+            'errorCount': len(self.errors),
+            'errors': self.errors[-50:],
+            'total': self.migrated + self.skipped,
+            'cursor': self.cursor,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+
+    def _save(self):
+        try:
+            map_store.save_job(self.user_id, self.id, self.to_dict())
+        except Exception as e:
+            log.warning(f"⚠️ Could not persist migration job {self.id}: {e}")
+
+    def _migrate_page(self, documents):
+        written = {}
+        migrated_at = datetime.utcnow()
+        for doc_id, map_data in documents:
+            update_data = build_migration_update(doc_id, map_data)
+            if update_data is None:
+                self.skipped += 1
+                continue
+            update_data['lastUpdated'] = migrated_at
+            written[doc_id] = update_data
+        if not written:
+            return
+        try:
+            map_store.update_many(self.user_id, written)
+        except MapNotFound:
+            # Mapa usunięta w trakcie zadania: zapisujemy ponownie tylko te, które jeszcze istnieją
+            existing = map_store.get_fields(self.user_id, list(written), ['name'])
+            for doc_id in [doc_id for doc_id in written if existing.get(doc_id) is None]:
+                del written[doc_id]
+                self.skipped += 1
+            if not written:
+                return
+            map_store.update_many(self.user_id, written)
+        for doc_id in written:
+            map_read_cache.invalidate(self.user_id, doc_id)
+
+        verified = set()
+        for doc_id, data in map_store.get_fields(self.user_id, list(written), ['name', 'lastUpdated']).items():
+            stamp = data.get('lastUpdated') if data else None
+            if data and 'name' in data and stamp is not None and stamp.replace(tzinfo=None) == migrated_at:
+                verified.add(doc_id)
+        for doc_id in written:
+            if doc_id in verified:
+                self.migrated += 1
+            else:
+                self.errors.append(f"Map {doc_id} failed post-migration verification")
+
+    def run(self):
+        log.info(f"🔄 MIGRATE-MAPS: job {self.id} started for user {self.user_id} (cursor: {self.cursor})")
+        try:
+            while True:
+                documents = map_store.list_after(self.user_id, self.cursor, MIGRATION_BATCH_SIZE)
+                if not documents:
+                    break
+                self._migrate_page(documents)
+                self.cursor = documents[-1][0]
+                self._save()
+                if len(documents) < MIGRATION_BATCH_SIZE:
+                    break
+            self.status = 'done'
+        except Exception as e:
+            log.error(f"❌ Map migration error (job {self.id}): {e}")
+            self.errors.append(str(e))
+            self.status = 'error'
+        self.finished_at = datetime.utcnow()
+        self._save()
+        log.info(f"✅ Migration job {self.id} finished: {self.status}, migrated={self.migrated}, skipped={self.skipped}")
+
+
+MIGRATION_JOBS_KEPT = 100
+migration_jobs = {}
+migration_jobs_lock = threading.Lock()
+
 
 @app.route('/migrate-maps', methods=['POST'])
 @require_auth
 def migrate_maps():
-    """Migrate legacy map documents to the name + mapData structure."""
-    if db is None:
+    """Start (or resume from a cursor) a background migration to the name + mapData structure."""
+    if not map_store.available():
         return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
     
     user_id = g.user_id
-    print(f"🔄 MIGRATE-MAPS: Migrating maps for user: {user_id}")
-    
+    cursor = (request.get_json(silent=True) or {}).get('cursor')
+
+    with migration_jobs_lock:
+        finished = [job_id for job_id, job in migration_jobs.items() if job.status != 'running']
+        for job_id in finished[:-MIGRATION_JOBS_KEPT]:
+            del migration_jobs[job_id]
+        for job in migration_jobs.values():
+            if job.user_id == user_id and job.status == 'running':
+                return jsonify(job.to_dict()), 202
+        job = MigrationJob(user_id, cursor)
+        migration_jobs[job.id] = job
+
+    threading.Thread(target=job.run, name=f'migrate-{job.id}', daemon=True).start()
+    return jsonify(job.to_dict()), 202
+
+@app.route('/migrate-maps/<job_id>', methods=['GET'])
+@require_auth
+def migrate_maps_status(job_id):
+    """Report progress of a migration job started by /migrate-maps."""
+    job = migration_jobs.get(job_id)
+    if job is not None and job.user_id == g.user_id:
+        return jsonify(job.to_dict()), 200
+    if not map_store.available():
+        return jsonify({'error': 'Firebase nie jest zainicjalizowany'}), 500
     try:
-        maps_ref = db.collection('users').document(user_id).collection('maps')
-        maps_stream = maps_ref.stream()
-        
-        migrated_count = 0
-        skipped_count = 0
-        errors = []
-        
-        for doc in maps_stream:
-            map_data = doc.to_dict()
-            doc_id = doc.id
-            
-            has_name = 'name' in map_data
-            has_mapData = 'mapData' in map_data
-            
-            if has_name and has_mapData:
-                print(f"   ⏭️  Map {doc_id} already has the correct structure, skipping")
-                skipped_count += 1
-                continue
-            
-            print(f"   🔄 Migrating map {doc_id}...")
-            
-            update_data = {}
-            
-            
-            if not has_name:
-                if 'mapStructure' in map_data and isinstance(map_data['mapStructure'], dict):
-                    if 'content' in map_data['mapStructure']:
-                        update_data['name'] = str(map_data['mapStructure']['content'])
-                    else:
-                        update_data['name'] = f'Mapa {doc_id[:8]}'
-                elif 'mapData' in map_data and isinstance(map_data['mapData'], dict):
-                    if 'content' in map_data['mapData']:
-                        update_data['name'] = str(map_data['mapData']['content'])
-                    else:
-                        update_data['name'] = f'Mapa {doc_id[:8]}'
-                elif 'content' in map_data:
-                    if isinstance(map_data['content'], dict) and 'content' in map_data['content']:
-                        update_data['name'] = str(map_data['content']['content'])
-                    else:
-                        update_data['name'] = str(map_data['content'])
-                else:
-                    update_data['name'] = f'Mapa {doc_id[:8]}'
-            
-            if not has_mapData:
-                if 'mapStructure' in map_data:
-                    update_data['mapData'] = map_data['mapStructure']
-                    print("      ➕ Copying 'mapData' from 'mapStructure'")
-                elif 'content' in map_data:
-                    update_data['mapData'] = map_data['content']
-                    print("      ➕ Copying 'mapData' from 'content'")
-                else:
-                    temp_data = dict(map_data)
-                    temp_data.pop('name', None)
-                    temp_data.pop('createdAt', None)
-                    temp_data.pop('lastUpdated', None)
-                    update_data['mapData'] = temp_data
-                    print("      ➕ Copying 'mapData' from the entire document (fallback)")
-            
-            if 'mapData' in update_data and 'content' not in map_data:
-                update_data['content'] = update_data['mapData']
-                print("      ➕ Copying 'content' as a mirror of 'mapData'")
-            
-            if update_data:
-                update_data['lastUpdated'] = datetime.utcnow()
-                
-                doc_ref = maps_ref.document(doc_id)
-                doc_ref.update(update_data)
-                
-                verified_doc = doc_ref.get()
-                verified_data = verified_doc.to_dict() if verified_doc.exists else None
-                has_name_after = verified_data and 'name' in verified_data
-                has_mapData_after = verified_data and 'mapData' in verified_data
-                has_content_after = verified_data and 'content' in verified_data
-                
-                print(f"      ✅ Updated map {doc_id}")
-                print(f"         After migration: name={has_name_after}, mapData={has_mapData_after}, content={has_content_after}")
-                
-                if has_name_after and (has_mapData_after or has_content_after):
-                    migrated_count += 1
-                else:
-                    errors.append(f"Map {doc_id} failed post-migration verification")
-        
-        result = {
-            'migrated': migrated_count,
-            'skipped': skipped_count,
-            'total': migrated_count + skipped_count,
-            'errors': errors
-        }
-        
-        print(f"✅ Migration completed: {result}")
-        return jsonify(result), 200
-        
+        stored_job = map_store.get_job(g.user_id, job_id)
     except Exception as e:
-        print(f"❌ Map migration error: {e}")
         return jsonify({'error': str(e)}), 500
+    if stored_job is None:
+        return jsonify({'error': 'Zadanie nie znalezione'}), 404
+    return jsonify(stored_job), 200
+
+# Rozgrzewka w tle: klienci, kanał gRPC i certyfikaty tokenów, zanim przyjdzie pierwszy request
+WARMUP_ON_START = os.getenv('WARMUP_ON_START') == '1'
+
+
+def warm_up():
+    """Create the heavy clients and open their connections ahead of the first request."""
+    started = time.perf_counter()
+    if LLM_BACKEND == 'groq':
+        clients.groq
+    if MAP_STORE == 'firestore' and clients.ensure_firebase():
+        # Certyfikaty tokenów pobiera już wątek auth-cert-refresh uruchomiony przy inicjalizacji
+        try:
+            # Odczyt nieistniejącego dokumentu otwiera kanał gRPC i uwierzytelnia klienta
+            clients.db.collection('_warmup').document('ping').get()
+        except Exception as e:
+            log.warning(f"⚠️ Firestore warm-up read failed: {e}")
+    log.info(f"🔥 Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+
+if WARMUP_ON_START:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 if __name__ == '__main__':
     DEBUG_MODE = os.getenv('FLASK_DEBUG') == '1'
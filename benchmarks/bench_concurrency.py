@@ -0,0 +1,151 @@
+"""Concurrency benchmark: real gunicorn sync workers vs. gthread workers.
+
+Each layout WxT starts gunicorn with gunicorn.conf.py (WEB_CONCURRENCY=W,
+GUNICORN_THREADS=T, so T=1 means `-k sync` and T>1 means `-k gthread`) on a
+local port, with the fake LLM (fixed latency), the in-memory map store and
+Firebase auth stubbed. The same number of HTTP clients then send unique
+/expand-node requests, so the numbers show how many slow LLM calls each
+layout keeps in flight, not model speed.
+
+    python benchmarks/bench_concurrency.py --requests 400 --clients 64 --latency 1.0 --layouts 2x1,2x8,2x32
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def create_app():
+    """gunicorn entry point (benchmarks.bench_concurrency:create_app()): the app with auth stubbed."""
+    sys.path.insert(0, ROOT)
+    import app as flow_app
+    flow_app.auth.verify_id_token = lambda token, **kwargs: {'uid': token, 'exp': time.time() + 3600}
+    return flow_app.app
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _server_env(workers, threads, latency, port):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'WEB_CONCURRENCY': str(workers),
+        'GUNICORN_THREADS': str(threads),
+        'LLM_BACKEND': 'fake',
+        'MAP_STORE': 'memory',
+        'FAKE_LLM_LATENCY_MS': str(latency * 1000),
+        'FAKE_LLM_LATENCY_SIGMA': '0',
+        'LLM_HEDGE': '0',
+        'LOG_LEVEL': 'WARNING',
+        'PYTHONPATH': ROOT,
+    })
+    env.setdefault('GROQ_API_KEY', 'benchmark')
+    # Mierzymy sam model współbieżności - bez limitów admission control
+    for name in ('USER_RATE_PER_MINUTE', 'USER_BURST', 'LLM_MAX_CONCURRENCY', 'LLM_QUEUE_MAX'):
+        env.setdefault(name, '1000000')
+    return env
+
+
+def _wait_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {process.returncode}')
+        try:
+            with urllib.request.urlopen(f'{base_url}/healthz', timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not become ready in time')
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), method='POST', headers={
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer bench'
+    })
+    with urllib.request.urlopen(request, timeout=300) as response:
+        response.read()
+        return response.status
+
+
+def run(workers, threads, clients, total, latency):
+    layout = f'{workers}x{threads}'
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         'benchmarks.bench_concurrency:create_app()'],
+        cwd=ROOT, env=_server_env(workers, threads, latency, port),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_ready(base_url, process)
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+
+        def one(i):
+            nonlocal failures
+            started = time.perf_counter()
+            try:
+                status = _post(f'{base_url}/expand-node', {'path': ['Temat', layout, f'Węzeł {i}']})
+            except (urllib.error.URLError, ConnectionError):
+                status = None
+            with lock:
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    failures += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            list(pool.map(one, range(total)))
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    latencies.sort()
+    return {
+        'layout': layout,
+        'workerClass': 'gthread' if threads > 1 else 'sync',
+        'clients': clients,
+        'requests': total,
+        'failures': failures,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_s': round(statistics.median(latencies), 3) if latencies else None,
+        'p95_s': round(latencies[max(0, int(len(latencies) * 0.95) - 1)], 3) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=64, help='concurrent HTTP clients (same for every layout)')
+    parser.add_argument('--latency', type=float, default=1.0, help='fake LLM latency in seconds')
+    parser.add_argument('--layouts', default='2x1,2x8,2x32',
+                        help='comma-separated WORKERSxTHREADS gunicorn layouts')
+    args = parser.parse_args()
+
+    for layout in args.layouts.split(','):
+        workers, threads = (int(part) for part in layout.split('x'))
+        print(json.dumps(run(workers, threads, args.clients, args.requests, args.latency)))
+
+
+if __name__ == '__main__':
+    main()
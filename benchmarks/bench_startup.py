@@ -0,0 +1,86 @@
+"""Cold-start benchmark: module import time and time until the first /healthz answer.
+
+Each sample runs in a fresh interpreter. With --ref the same measurement is
+repeated for app.py from another git revision (exported to a temporary
+directory), which gives before/after numbers for startup changes:
+
+    python benchmarks/bench_startup.py --runs 5 --ref HEAD~1
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Uruchamiane w świeżym procesie: czas importu, potem pierwsza odpowiedź przez test_client
+# (starsze wersje nie mają /healthz - wtedy strona główna)
+PROBE = r'''
+import json, sys, time
+started = time.perf_counter()
+import app as flow_app
+imported = time.perf_counter()
+client = flow_app.app.test_client()
+rules = {rule.rule for rule in flow_app.app.url_map.iter_rules()}
+response = client.get('/healthz' if '/healthz' in rules else '/')
+answered = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - started,
+    'healthz_s': answered - started,
+    'healthz_status': response.status_code,
+    'heavy_modules': sorted(m for m in ('groq', 'firebase_admin', 'google.cloud.firestore', 'grpc') if m in sys.modules)
+}))
+'''
+
+
+def sample(app_dir, env):
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=app_dir, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(label, app_dir, runs, env):
+    samples = [sample(app_dir, env) for _ in range(runs)]
+    return {
+        'version': label,
+        'runs': runs,
+        'import_median_s': round(statistics.median(s['import_s'] for s in samples), 3),
+        'first_healthz_median_s': round(statistics.median(s['healthz_s'] for s in samples), 3),
+        'heavy_modules_loaded': samples[-1]['heavy_modules'],
+    }
+
+
+def export_revision(ref, target):
+    source = subprocess.run(['git', 'show', f'{ref}:app.py'], cwd=ROOT, capture_output=True, check=True).stdout
+    with open(os.path.join(target, 'app.py'), 'wb') as f:
+        f.write(source)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--ref', help='git revision to compare against (e.g. HEAD~1)')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('GROQ_API_KEY', 'benchmark')
+    env.setdefault('LOG_LEVEL', 'ERROR')
+    env.pop('WARMUP_ON_START', None)
+
+    results = []
+    if args.ref:
+        with tempfile.TemporaryDirectory() as target:
+            export_revision(args.ref, target)
+            results.append(measure(args.ref, target, args.runs, env))
+    results.append(measure('working tree', ROOT, args.runs, env))
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Size and speed of the packed map codec versus the legacy content + mapData layout.
+
+Legacy size is measured as the JSON encoding of both copies of the tree,
+which is a close proxy for the Firestore nested-map document size.
+
+    python benchmarks/bench_storage_codec.py --nodes 500 5000 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+
+import app as flow_app  # noqa: E402
+
+WORDS = ['Fotosynteza', 'Faza świetlna', 'Chlorofil', 'Energia', 'Glukoza', 'Tlen', 'Woda',
+         'Cykl Calvina', 'ATP', 'NADPH', 'Stroma', 'Tylakoid', 'Światło', 'Dwutlenek węgla']
+EMOJIS = ['🌱', '☀️', '🌙', '🔬', '💡', '🌍', '📚', '🔥', '💧']
+
+
+def synthetic_tree(node_count, fanout=5, seed=7):
+    """Build a breadth-first tree with node_count nodes and emoji-prefixed texts."""
+    rng = random.Random(seed)
+    root = {'content': f"{rng.choice(EMOJIS)} {rng.choice(WORDS)}"}
+    queue = [root]
+    created = 1
+    while created < node_count:
+        parent = queue.pop(0)
+        parent['children'] = []
+        for _ in range(min(fanout, node_count - created)):
+            child = {'content': f"{rng.choice(EMOJIS)} {rng.choice(WORDS)} {created}"}
+            parent['children'].append(child)
+            queue.append(child)
+            created += 1
+    return root
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    for node_count in args.nodes:
+        tree = synthetic_tree(node_count)
+        legacy, legacy_ms = timed(
+            lambda: json.dumps({'content': tree, 'mapData': tree}, ensure_ascii=False).encode('utf-8'),
+            args.repeat
+        )
+        blob, encode_ms = timed(lambda: flow_app.encode_map_tree(tree), args.repeat)
+        decoded, decode_ms = timed(lambda: flow_app.decode_map_tree(blob), args.repeat)
+        assert decoded == tree
+        print(json.dumps({
+            'nodes': node_count,
+            'legacy_bytes': len(legacy),
+            'packed_bytes': len(blob),
+            'ratio': round(len(legacy) / len(blob), 1),
+            'legacy_json_ms': round(legacy_ms, 3),
+            'encode_ms': round(encode_ms, 3),
+            'decode_ms': round(decode_ms, 3),
+        }))
+
+
+if __name__ == '__main__':
+    main()
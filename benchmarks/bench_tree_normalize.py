@@ -0,0 +1,131 @@
+"""Speed and memory of normalize_tree versus the old recursive add_emoji_to_content.
+
+Model-shaped trees ({'text', 'emoji', 'children'}) are generated wide
+(breadth-first, fixed fanout) and deep (a single chain). Every run gets a
+fresh copy, since both functions work in place. The "bounded" column
+runs with the default TREE_* limits and reports how many nodes survive.
+
+    python benchmarks/bench_tree_normalize.py --nodes 10000 100000 --depths 500 5000 50000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import app as flow_app  # noqa: E402
+
+EMOJIS = ['🌱', '☀️', '🌙', '🔬', '💡', '🌍', '📚', '🔥', '💧']
+
+
+def legacy_add_emoji_to_content(node):
+    """The recursive normalizer used by generate-map before normalize_tree (baseline only)."""
+    emoji = node.get('emoji', '📌')
+    text = node.get('text', node.get('content', ''))
+    node['content'] = f"{emoji} {text}"
+    node.pop('text', None)
+    node.pop('emoji', None)
+    if 'children' in node and isinstance(node['children'], list):
+        for child in node['children']:
+            legacy_add_emoji_to_content(child)
+    return node
+
+
+def wide_tree(node_count, fanout=5, seed=7):
+    rng = random.Random(seed)
+    root = {'text': 'Temat', 'emoji': rng.choice(EMOJIS)}
+    queue = [root]
+    head = 0
+    created = 1
+    while created < node_count:
+        parent = queue[head]
+        head += 1
+        parent['children'] = []
+        for _ in range(min(fanout, node_count - created)):
+            child = {'text': f'Węzeł {created}', 'emoji': rng.choice(EMOJIS)}
+            parent['children'].append(child)
+            queue.append(child)
+            created += 1
+    return root
+
+
+def deep_tree(depth):
+    root = node = {'text': 'Poziom 0', 'emoji': '📚'}
+    for level in range(1, depth):
+        child = {'text': f'Poziom {level}', 'emoji': '📚'}
+        node['children'] = [child]
+        node = child
+    return root
+
+
+def count_nodes(tree):
+    count, stack = 0, [tree]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.get('children') or [])
+    return count
+
+
+def measure(fn, make_tree, repeat):
+    """Return (best ms, peak traced KB) or the exception name if fn fails."""
+    best = None
+    for _ in range(repeat):
+        tree = make_tree()
+        started = time.perf_counter()
+        try:
+            fn(tree)
+        except RecursionError as e:
+            return type(e).__name__, None
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    tree = make_tree()
+    tracemalloc.start()
+    fn(tree)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(best, 2), round(peak / 1024, 1)
+
+
+def unbounded(tree):
+    limits = flow_app.TREE_MAX_NODES, flow_app.TREE_MAX_TEXT_CHARS
+    flow_app.TREE_MAX_NODES = flow_app.TREE_MAX_TEXT_CHARS = sys.maxsize
+    try:
+        return flow_app.normalize_tree(tree, True, max_depth=sys.maxsize)
+    finally:
+        flow_app.TREE_MAX_NODES, flow_app.TREE_MAX_TEXT_CHARS = limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--depths', type=int, nargs='+', default=[500, 5000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    shapes = [('wide', count, lambda count=count: wide_tree(count)) for count in args.nodes]
+    shapes += [('deep', depth, lambda depth=depth: deep_tree(depth)) for depth in args.depths]
+    for shape, size, make_tree in shapes:
+        legacy_ms, legacy_kb = measure(legacy_add_emoji_to_content, make_tree, args.repeat)
+        iterative_ms, iterative_kb = measure(unbounded, make_tree, args.repeat)
+        bounded_ms, _ = measure(lambda tree: flow_app.normalize_tree(tree, True), make_tree, args.repeat)
+        print(json.dumps({
+            'shape': shape,
+            'size': size,
+            'legacy_ms': legacy_ms,
+            'legacy_peak_kb': legacy_kb,
+            'iterative_ms': iterative_ms,
+            'iterative_peak_kb': iterative_kb,
+            'bounded_ms': bounded_ms,
+            'bounded_nodes': count_nodes(flow_app.normalize_tree(make_tree(), True)),
+        }))
+
+
+if __name__ == '__main__':
+    main()
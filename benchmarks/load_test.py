@@ -0,0 +1,173 @@
+"""Load test: mixed API traffic against the fake LLM backend and the in-memory map store.
+
+Runs offline (LLM_BACKEND=fake, MAP_STORE=memory, Firebase auth stubbed), so
+the numbers measure the app itself: routing, prompt building, parsing,
+caching and storage code paths. The fake LLM latency is log-normal with
+the given median; every run with the same --seed issues the same requests
+and gets the same trees back.
+
+    python benchmarks/load_test.py --requests 2000 --concurrency 32 --llm-latency-ms 300
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Udział ścieżek w ruchu (wagi)
+ROUTES = {
+    '/generate-map': 1,
+    '/expand-node': 4,
+    '/get-maps': 3,
+    '/get-map': 3,
+    '/create-map': 1,
+    '/update-map': 3,
+    '/patch-map': 2,
+}
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def configure(args):
+    """Select the offline backends; must run before the app module is imported."""
+    os.environ['LLM_BACKEND'] = 'fake'
+    os.environ['MAP_STORE'] = 'memory'
+    os.environ['FAKE_LLM_LATENCY_MS'] = str(args.llm_latency_ms)
+    os.environ['FAKE_LLM_FANOUT'] = str(args.fanout)
+    os.environ['FAKE_LLM_DEPTH'] = str(args.depth)
+    os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+    # Bez limitów per użytkownik, chyba że ustawione jawnie w środowisku
+    os.environ.setdefault('USER_RATE_PER_MINUTE', '1000000')
+    os.environ.setdefault('USER_BURST', '1000000')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import app as flow_app
+    flow_app.auth.verify_id_token = lambda token, **kwargs: {'uid': token, 'exp': time.time() + 3600}
+    return flow_app
+
+
+class Workload:
+    def __init__(self, flow_app, users, seed):
+        self.client = flow_app.app.test_client()
+        self.users = [f'bench-user-{index}' for index in range(users)]
+        self.seed = seed
+        self.maps = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def headers(self, user):
+        return {'Authorization': f'Bearer {user}'}
+
+    def seed_maps(self, per_user):
+        for user in self.users:
+            for index in range(per_user):
+                self.create(user, random.Random(f'{self.seed}-{user}-{index}'))
+
+    def create(self, user, rng):
+        topic = f'Temat {rng.randint(1, 10_000)}'
+        tree = {'content': topic, 'children': [{'content': f'{topic} {i}'} for i in range(rng.randint(2, 6))]}
+        response = self.client.post('/create-map', json={'title': topic, 'content': tree}, headers=self.headers(user))
+        if response.status_code == 201:
+            with self.lock:
+                self.maps[user].append(response.get_json()['id'])
+        return response
+
+    def pick_map(self, user, rng):
+        with self.lock:
+            maps = self.maps[user]
+            return rng.choice(maps) if maps else None
+
+    def request(self, route, user, rng):
+        headers = self.headers(user)
+        if route == '/generate-map':
+            # Mała pula tematów, żeby część zapytań trafiała w cache map
+            return self.client.post(route, json={'topic': f'Temat {rng.randint(1, 50)}'}, headers=headers)
+        if route == '/expand-node':
+            path = ['Temat', f'Gałąź {rng.randint(1, 20)}', f'Węzeł {rng.randint(1, 1000)}']
+            return self.client.post(route, json={'path': path}, headers=headers)
+        if route == '/get-maps':
+            return self.client.get(f'{route}?view=summary&limit=20', headers=headers)
+        if route == '/create-map':
+            return self.create(user, rng)
+        map_id = self.pick_map(user, rng)
+        if route == '/get-map':
+            return self.client.get(f'{route}/{map_id}', headers=headers)
+        if route == '/update-map':
+            tree = {'content': 'Zmieniona', 'children': [{'content': f'Punkt {i}'} for i in range(rng.randint(2, 8))]}
+            return self.client.put(f'{route}/{map_id}', json={'content': tree}, headers=headers)
+        operations = [{'op': 'add', 'path': '/children/-', 'value': {'content': f'Nowy {rng.randint(1, 1000)}'}}]
+        return self.client.post(f'{route}/{map_id}', json={'operations': operations}, headers=headers)
+
+
+def run(workload, total, concurrency):
+    rng = random.Random(workload.seed)
+    routes = list(ROUTES)
+    weights = [ROUTES[route] for route in routes]
+    plan = [(rng.choices(routes, weights)[0], rng.choice(workload.users), rng.random()) for _ in range(total)]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def one(step):
+        route, user, seed = step
+        started = time.perf_counter()
+        response = workload.request(route, user, random.Random(seed))
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[route].append(elapsed)
+            if response.status_code >= 400:
+                errors[route] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - started
+
+    results = []
+    for route in routes + ['all']:
+        values = sorted(latencies[route] if route != 'all' else [v for vs in latencies.values() for v in vs])
+        if not values:
+            continue
+        results.append({
+            'route': route,
+            'requests': len(values),
+            'errors': errors[route] if route != 'all' else sum(errors.values()),
+            'throughput_rps': round(len(values) / wall, 1),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+        })
+    return wall, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel client threads')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--maps-per-user', type=int, default=25, help='maps created before the run')
+    parser.add_argument('--llm-latency-ms', type=float, default=300, help='median fake LLM latency')
+    parser.add_argument('--fanout', type=int, default=4, help='mean fake tree fanout')
+    parser.add_argument('--depth', type=int, default=3, help='fake map depth')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    flow_app = configure(args)
+    workload = Workload(flow_app, args.users, args.seed)
+    workload.seed_maps(args.maps_per_user)
+    wall, results = run(workload, args.requests, args.concurrency)
+    print(json.dumps({'requests': args.requests, 'concurrency': args.concurrency, 'wall_s': round(wall, 2)}))
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import os
+
+# GUNICORN_THREADS=1 (domyślnie): workery sync, jeden request na proces.
+# GUNICORN_THREADS>1: workery gthread - wątki procesu czekają na Groq/Firestore równolegle
+# (I/O zwalnia GIL), więc jeden proces obsługuje wiele wolnych wywołań LLM naraz.
+THREADS = int(os.getenv('GUNICORN_THREADS', 1))
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+
+if THREADS > 1:
+    worker_class = 'gthread'
+    threads = THREADS
+    timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+else:
+    worker_class = 'sync'
+    timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
@@ -75,6 +75,7 @@ const firebaseConfig = {
 let app, auth, googleProvider, db;
 let currentUser = null;
 let currentMapId = null;
+let currentMapRevision = null;
 
 try {
     if (typeof firebase !== 'undefined') {
@@ -279,6 +280,7 @@ const saveMapToFirestore = async (mapData) => {
                 showFeedback('Błąd podczas aktualizacji mapy!');
                 throw new Error(errorData.error || `HTTP ${response.status}`);
             }
+            await refreshMapRevision(currentMapId);
             console.log("✅ Map '" + currentMapId + "' updated by backend");
             try { localStorage.setItem(LAST_MAP_KEY, currentMapId); } catch {}
             showFeedback("Zaktualizowano mapę! Twoje zmiany zostały zapisane.");
@@ -306,6 +308,7 @@ const saveMapToFirestore = async (mapData) => {
             const result = await response.json();
             console.log("📥 Received backend response:", result);
             currentMapId = result.id;
+            currentMapRevision = typeof result.revision === 'number' ? result.revision : null;
             try { localStorage.setItem(LAST_MAP_KEY, currentMapId); } catch {}
             console.log("✅ New map created by backend with ID:", currentMapId);
             showFeedback("Mapa została zapisana! Możesz ją znaleźć w swoim panelu map.");
@@ -319,6 +322,188 @@ const saveMapToFirestore = async (mapData) => {
     }
 };
 
+const jsonPointerForPath = (root, path) => {
+    let pointer = '';
+    let currentNode = root;
+    for (let i = 1; i < path.length; i++) {
+        const index = (currentNode.children || []).findIndex(child => child.content === path[i]);
+        if (index === -1) return null;
+        pointer += `/children/${index}`;
+        currentNode = currentNode.children[index];
+    }
+    return pointer;
+};
+
+const refreshMapRevision = async (mapId) => {
+    try {
+        const docData = await fetchMapDocument(mapId);
+        currentMapRevision = docData && typeof docData.revision === 'number' ? docData.revision : null;
+    } catch (error) {
+        currentMapRevision = null;
+        console.warn('⚠️ Could not refresh the map revision:', error);
+    }
+};
+
+const nodeForJsonPointer = (root, pointer) => {
+    const tokens = pointer.split('/').slice(1);
+    let currentNode = root;
+    for (let i = 0; i + 1 < tokens.length; i += 2) {
+        if (tokens[i] !== 'children' || !currentNode.children) return null;
+        currentNode = currentNode.children[Number(tokens[i + 1])];
+        if (!currentNode) return null;
+    }
+    return tokens.length % 2 === 0 ? currentNode : null;
+};
+
+const syncNodeFromServer = (localNode, serverNode) => {
+    if (!localNode || !serverNode) return;
+    localNode.content = serverNode.content;
+    const localChildren = localNode.children || [];
+    (serverNode.children || []).forEach((child, index) => syncNodeFromServer(localChildren[index], child));
+};
+
+// Serwer normalizuje wartości (np. obcina spacje); przepisujemy je do lokalnego drzewa,
+// żeby kolejne operacje 'test' porównywały to, co faktycznie zapisano
+const applyServerPatchValues = (root, operations, values) => {
+    if (!Array.isArray(values)) return;
+    operations.forEach((operation, index) => {
+        const value = values[index];
+        if (value === null || value === undefined) return;
+        if (operation.path.endsWith('/content') && typeof value === 'string') {
+            const node = nodeForJsonPointer(root, operation.path.slice(0, -'/content'.length));
+            if (node) node.content = value;
+        } else if (operation.path.endsWith('/children') && Array.isArray(value)) {
+            const node = nodeForJsonPointer(root, operation.path.slice(0, -'/children'.length));
+            if (node) syncNodeFromServer({ children: node.children }, { children: value });
+        } else if (typeof value === 'object') {
+            syncNodeFromServer(nodeForJsonPointer(root, operation.path), value);
+        }
+    });
+};
+
+const sendMapPatch = (authToken, revision, operations) => fetch(`/patch-map/${encodeURIComponent(currentMapId)}`, {
+    method: 'POST',
+    headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${authToken}`
+    },
+    body: JSON.stringify({ revision, operations })
+});
+
+const reloadMapAfterConflict = async (mapId) => {
+    const docData = await fetchMapDocument(mapId);
+    if (!docData) {
+        showFeedback('Mapa została usunięta w innym miejscu.');
+        return;
+    }
+    const mapData = docData.mapData || docData.mapStructure || docData.content;
+    if (mapData) {
+        rebuildMapFromData(mapData);
+    }
+    currentMapId = mapId;
+    currentMapRevision = typeof docData.revision === 'number' ? docData.revision : null;
+    showFeedback('Mapa została zmieniona w innym miejscu. Wczytano najnowszą wersję – wprowadź zmianę ponownie.');
+};
+
+const saveMapPatch = async (operations, mapData) => {
+    if (!currentUser || !currentMapId || !operations) {
+        return saveMapToFirestore(mapData);
+    }
+    let response;
+    try {
+        const authToken = await getAuthToken();
+        if (!authToken) {
+            return saveMapToFirestore(mapData);
+        }
+        response = await sendMapPatch(authToken, currentMapRevision, operations);
+        if (response.status === 409) {
+            const conflict = await response.json().catch(() => ({}));
+            if (typeof conflict.revision === 'number') {
+                // Nieaktualna rewizja: operacje 'test' pilnują edytowanego węzła, więc ponawiamy je na najnowszej wersji
+                console.warn('⚠️ Stale map revision, reapplying the patch on revision', conflict.revision);
+                response = await sendMapPatch(authToken, conflict.revision, operations);
+            }
+        }
+    } catch (error) {
+        console.warn('⚠️ Error during map patch, falling back to a full save:', error);
+        return saveMapToFirestore(mapData);
+    }
+    if (response.status === 409) {
+        // Konflikt: nie nadpisujemy cudzych zmian pełnym zapisem, tylko wczytujemy aktualną mapę
+        const conflict = await response.json().catch(() => ({}));
+        console.warn('⚠️ Map patch conflict, reloading the stored map:', conflict);
+        try {
+            await reloadMapAfterConflict(currentMapId);
+        } catch (error) {
+            console.error('❌ Failed to reload the map after a conflict:', error);
+            showFeedback('Mapa została zmieniona w innym miejscu. Otwórz ją ponownie.');
+        }
+        return;
+    }
+    if (!response.ok) {
+        const errorData = await response.json().catch(() => ({ error: `HTTP ${response.status}` }));
+        console.warn('⚠️ Patch rejected, falling back to a full save:', errorData);
+        return saveMapToFirestore(mapData);
+    }
+    const result = await response.json();
+    currentMapRevision = result.revision;
+    applyServerPatchValues(mapData, operations, result.values);
+    console.log("✅ Map '" + currentMapId + "' patched, revision:", currentMapRevision);
+    showFeedback("Zaktualizowano mapę! Twoje zmiany zostały zapisane.");
+};
+
+const MIGRATION_POLL_INTERVAL = 2000;
+
+const pollMigrationJob = async (jobId, authToken) => {
+    try {
+        const response = await fetch(`/migrate-maps/${encodeURIComponent(jobId)}`, {
+            method: 'GET',
+            headers: {
+                'Authorization': `Bearer ${authToken}`
+            }
+        });
+        if (!response.ok) {
+            console.warn("⚠️ Map migration status request failed:", response.status);
+            return;
+        }
+        const migrateResult = await response.json();
+        if (migrateResult.status === 'running') {
+            setTimeout(() => pollMigrationJob(jobId, authToken), MIGRATION_POLL_INTERVAL);
+            return;
+        }
+        console.log("🔄 Map migration result:", migrateResult);
+        if (migrateResult.migrated > 0) {
+            console.log(`✅ Migrated ${migrateResult.migrated} map(s) to the new structure`);
+            alert(`Zmigrowano ${migrateResult.migrated} map. Odśwież aplikację mobilną!`);
+        } else {
+            console.log("ℹ️ All maps already follow the latest structure");
+        }
+    } catch (error) {
+        console.warn("⚠️ Map migration status request failed:", error);
+    }
+};
+
+const fetchMapDocument = async (mapId) => {
+    const authToken = await getAuthToken();
+    if (!authToken) {
+        throw new Error('Brak tokena autoryzacji');
+    }
+    const response = await fetch(`/get-map/${encodeURIComponent(mapId)}`, {
+        method: 'GET',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${authToken}`
+        }
+    });
+    if (response.status === 404) {
+        return null;
+    }
+    if (!response.ok) {
+        throw new Error(`Błąd pobierania mapy: ${response.status}`);
+    }
+    return response.json();
+};
+
 const loadMapFromFirestore = (userId) => {
     if (!db) {
         console.error("❌ Firestore nie jest zainicjalizowany.");
@@ -327,11 +512,9 @@ const loadMapFromFirestore = (userId) => {
 
     const lastId = (() => { try { return localStorage.getItem(LAST_MAP_KEY); } catch { return null; } })();
     if (lastId) {
-        const mapDocRef = db.collection('users').doc(userId).collection('maps').doc(lastId);
-        mapDocRef.get()
-            .then((doc) => {
-                if (doc.exists) {
-                    const docData = doc.data();
+        fetchMapDocument(lastId)
+            .then((docData) => {
+                if (docData) {
                     let mapData = null;
                     if (docData.content) mapData = docData.content;
                     else if (docData.mapData) mapData = docData.mapData;
@@ -340,6 +523,7 @@ const loadMapFromFirestore = (userId) => {
                     if (!mapData) return;
                     rebuildMapFromData(mapData);
                     currentMapId = lastId;
+                    currentMapRevision = typeof docData.revision === 'number' ? docData.revision : null;
                     console.log("✅ Opened the last map:", lastId);
                 }
             })
@@ -452,6 +636,7 @@ const clearMap = () => {
     
     window.rootDataGlobal = null;
     currentMapId = null;
+    currentMapRevision = null;
 };
 
 const renderMapItem = (map) => {
@@ -573,6 +758,42 @@ const renderMapItem = (map) => {
     mapList.appendChild(listItem);
 };
 
+const MAPS_PAGE_SIZE = 50;
+
+const renderLoadMoreItem = (nextCursor, authToken) => {
+    const mapList = document.getElementById('map-list');
+    if (!mapList || !nextCursor) return;
+
+    const listItem = document.createElement('li');
+    const link = document.createElement('a');
+    link.href = '#';
+    link.textContent = 'Pokaż więcej…';
+    link.style.opacity = '0.7';
+    link.addEventListener('click', async (e) => {
+        e.preventDefault();
+        listItem.remove();
+        try {
+            const response = await fetch(`/get-maps?view=summary&limit=${MAPS_PAGE_SIZE}&cursor=${encodeURIComponent(nextCursor)}`, {
+                method: 'GET',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${authToken}`
+                }
+            });
+            if (!response.ok) {
+                throw new Error(`Błąd pobierania map: ${response.status}`);
+            }
+            const page = await response.json();
+            page.maps.forEach((map) => renderMapItem(map));
+            renderLoadMoreItem(page.nextCursor, authToken);
+        } catch (error) {
+            console.error("❌ Error while loading more maps:", error);
+        }
+    });
+    listItem.appendChild(link);
+    mapList.appendChild(listItem);
+};
+
 const loadUserMaps = async (userId) => {
     const mapList = document.getElementById('map-list');
 
@@ -591,7 +812,7 @@ const loadUserMaps = async (userId) => {
             return;
         }
 
-        const response = await fetch('/get-maps', {
+        const response = await fetch(`/get-maps?view=summary&limit=${MAPS_PAGE_SIZE}`, {
             method: 'GET',
             headers: {
                 'Content-Type': 'application/json',
@@ -603,7 +824,8 @@ const loadUserMaps = async (userId) => {
             throw new Error(`Błąd pobierania map: ${response.status}`);
         }
 
-        const maps = await response.json();
+        const page = await response.json();
+        const maps = page ? page.maps : null;
 
         console.log("📋 Maps received from backend:", maps);
 
@@ -627,10 +849,8 @@ const loadUserMaps = async (userId) => {
         
         console.log(`📋 Found ${maps.length} map(s) to display`);
 
-        maps.forEach((map, index) => {
-            console.log(`🗺️ Map ${index + 1}/${maps.length}:`, JSON.stringify(map, null, 2));
-            renderMapItem(map);
-        });
+        maps.forEach((map) => renderMapItem(map));
+        renderLoadMoreItem(page.nextCursor, authToken);
 
         console.log("✅ Map list loaded successfully");
         
@@ -727,13 +947,9 @@ const openMap = (mapId) => {
 
     clearMap();
 
-    const userId = currentUser.uid;
-    const mapDocRef = db.collection('users').doc(userId).collection('maps').doc(mapId);
-
-    mapDocRef.get()
-        .then((doc) => {
-            if (doc.exists) {
-                const docData = doc.data();
+    fetchMapDocument(mapId)
+        .then((docData) => {
+            if (docData) {
                 console.log("🔍 Map data from Firestore:", docData);
                 
                 let mapData = null;
@@ -760,6 +976,7 @@ const openMap = (mapId) => {
                 
                 rebuildMapFromData(mapData);
                 currentMapId = mapId;
+                currentMapRevision = typeof docData.revision === 'number' ? docData.revision : null;
                 
                 console.log("✅ Map '" + mapId + "' loaded successfully.");
                 
@@ -814,6 +1031,47 @@ const downloadAsFile = (content, filename) => {
     URL.revokeObjectURL(element.href);
 };
 
+const readEventStream = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            const dataLines = [];
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+            });
+            if (dataLines.length > 0) {
+                onEvent(eventName, JSON.parse(dataLines.join('\n')));
+            }
+        }
+    }
+};
+
+const insertStreamedNode = (root, path, content) => {
+    if (path.length === 0) {
+        return { content, children: [] };
+    }
+    let parent = root;
+    for (let i = 0; i < path.length - 1; i++) {
+        parent = parent.children[path[i]];
+    }
+    parent.children = parent.children || [];
+    parent.children[path[path.length - 1]] = { content, children: [] };
+    return root;
+};
+
 const showFeedback = (message) => {
     const feedbackElement = document.getElementById('feedback-message');
     if (!feedbackElement) return;
@@ -885,7 +1143,7 @@ document.addEventListener('DOMContentLoaded', () => {
         mainContent.style.display = 'none';
         try {
             const emojisEnabled = localStorage.getItem('emojisEnabled') === 'true';
-            const response = await fetch('/generate-map', { 
+            const response = await fetch('/generate-map/stream', { 
                 method: 'POST', 
                 headers: { 
                     'Content-Type': 'application/json',
@@ -894,19 +1152,48 @@ document.addEventListener('DOMContentLoaded', () => {
                 body: JSON.stringify({ topic, emojisEnabled }) 
             });
             if (!response.ok) throw new Error((await response.json()).error);
-            rootData = await response.json();
+
+            let partialRoot = null;
+            let renderScheduled = false;
+            const showMap = (data) => {
+                if (!markmapInstance || svgElement.childElementCount === 0) {
+                    mindmapContainer.style.display = 'block';
+                    searchContainer.style.display = 'block';
+                    resetBtn.style.display = 'block';
+                    exportBtn.style.display = 'block';
+                    exportPngBtn.style.display = 'block';
+                    svgElement.innerHTML = '';
+                    markmapInstance = Markmap.create(svgElement, null, data);
+                    window.markmapInstanceGlobal = markmapInstance;
+                } else {
+                    markmapInstance.setData(data);
+                }
+            };
+
+            rootData = null;
+            svgElement.innerHTML = '';
+            await readEventStream(response, (eventName, payload) => {
+                if (eventName === 'node') {
+                    partialRoot = insertStreamedNode(partialRoot, payload.path, payload.content);
+                    if (!renderScheduled) {
+                        renderScheduled = true;
+                        requestAnimationFrame(() => {
+                            renderScheduled = false;
+                            if (!rootData) showMap(partialRoot);
+                        });
+                    }
+                } else if (eventName === 'done') {
+                    rootData = payload;
+                } else if (eventName === 'error') {
+                    throw new Error(payload.error);
+                }
+            });
+            if (!rootData) throw new Error('Strumień zakończył się bez mapy.');
             window.rootDataGlobal = rootData;
             
             playSound(AUDIO_SUCCESS);
             
-            mindmapContainer.style.display = 'block';
-            searchContainer.style.display = 'block';
-            resetBtn.style.display = 'block';
-            exportBtn.style.display = 'block';
-            exportPngBtn.style.display = 'block';
-            svgElement.innerHTML = '';
-            markmapInstance = Markmap.create(svgElement, null, rootData);
-            window.markmapInstanceGlobal = markmapInstance;
+            showMap(rootData);
             
             saveMapToFirestore(rootData);
         } catch (error) {
@@ -965,7 +1252,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     'Content-Type': 'application/json',
                     'Authorization': `Bearer ${authToken}`
                 }, 
-                body: JSON.stringify({ path, emojisEnabled }) 
+                body: JSON.stringify({ path, emojisEnabled, hydrate: true }) 
             });
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({ error: `HTTP ${response.status}` }));
@@ -994,47 +1281,24 @@ document.addEventListener('DOMContentLoaded', () => {
                 return currentNode;
             };
             const targetNode = findNodeByPath(rootData, path);
+            const targetPointer = jsonPointerForPath(rootData, path);
             
             if (targetNode) {
                 targetNode.children = newChildren;
             } else {
                 throw new Error("Failed to update the map.");
             }
+            const patchOperations = targetPointer === null ? null : [
+                { op: 'test', path: `${targetPointer}/content`, value: targetNode.content },
+                { op: 'add', path: `${targetPointer}/children`, value: newChildren.map(child => sanitizeMapData(child)) }
+            ];
             
             markmapInstance.setData(rootData);
             window.rootDataGlobal = rootData;
 
             console.log("💾 Persisting the updated map after expanding a branch. currentMapId:", currentMapId);
 
-            try {
-                const authToken2 = await getAuthToken();
-                if (authToken2 && currentMapId) {
-                    const sanitized = sanitizeMapData(rootData);
-                    const cleaned = cleanUndefinedFromObject(sanitized);
-                    if (cleaned && cleaned.content && typeof cleaned.content === 'string' && !cleaned.title) {
-                        cleaned.title = cleaned.content;
-                    }
-                    const resp = await fetch('/update-map', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'Authorization': `Bearer ${authToken2}`
-                        },
-                        body: JSON.stringify({
-                            documentId: currentMapId,
-                            newMapData: cleaned
-                        })
-                    });
-                    if (!resp.ok) {
-                        const err = await resp.json().catch(() => ({ error: `HTTP ${resp.status}` }));
-                        console.warn('⚠️ POST /update-map failed:', err);
-                    }
-                }
-            } catch (e) {
-                console.warn('⚠️ Error during POST /update-map:', e);
-            }
-
-            await saveMapToFirestore(rootData);
+            await saveMapPatch(patchOperations, rootData);
             
             if (searchInput.value.trim() !== '') {
                 setTimeout(() => filterNodes(), 100);
@@ -1186,8 +1450,13 @@ document.addEventListener('DOMContentLoaded', () => {
         const targetNode = findNodeInDataByPath(rootData, path);
         
         if (targetNode) {
+            const targetPointer = jsonPointerForPath(rootData, path);
+            const patchOperations = targetPointer === null ? null : [
+                { op: 'test', path: `${targetPointer}/content`, value: targetNode.content },
+                { op: 'replace', path: `${targetPointer}/content`, value: newText }
+            ];
             targetNode.content = newText;
-            saveMapToFirestore(rootData);
+            saveMapPatch(patchOperations, rootData);
             window.rootDataGlobal = rootData;
             markmapInstance.setData(rootData);
             
@@ -1473,14 +1742,9 @@ document.addEventListener('DOMContentLoaded', () => {
                         });
                         
                         if (migrateResponse.ok) {
-                            const migrateResult = await migrateResponse.json();
-                            console.log("🔄 Map migration result:", migrateResult);
-                            if (migrateResult.migrated > 0) {
-                                console.log(`✅ Migrated ${migrateResult.migrated} map(s) to the new structure`);
-                                alert(`Zmigrowano ${migrateResult.migrated} map. Odśwież aplikację mobilną!`);
-                            } else {
-                                console.log("ℹ️ All maps already follow the latest structure");
-                            }
+                            const migrateJob = await migrateResponse.json();
+                            console.log("🔄 Map migration job started:", migrateJob);
+                            pollMigrationJob(migrateJob.jobId, authToken);
                         } else {
                             const error = await migrateResponse.json();
                             console.warn("⚠️ Map migration endpoint returned an error:", error);
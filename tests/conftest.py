@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# Testy działają bez Groq i Firestore: fałszywy model i mapy w pamięci
+os.environ.setdefault('MAP_STORE', 'memory')
+os.environ.setdefault('LLM_BACKEND', 'fake')
+os.environ.setdefault('FAKE_LLM_LATENCY_MS', '0')
+os.environ.setdefault('GROQ_API_KEY', 'test')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Flask test client whose bearer token is taken as the user id."""
+    import app
+    monkeypatch.setattr(app.clients, 'ensure_firebase', lambda: False)
+    monkeypatch.setattr(app.auth, 'verify_id_token', lambda token, **kwargs: {'uid': token, 'exp': 4102444800})
+    return app.app.test_client()
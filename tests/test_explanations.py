@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import app
+
+
+def _events(response):
+    events = []
+    for block in response.get_data(as_text=True).strip().split('\n\n'):
+        name, data = block.split('\n', 1)
+        events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    calls = []
+
+    def counting(method):
+        original = getattr(app.llm_backend, method)
+
+        def call(**kwargs):
+            calls.append(method)
+            return original(**kwargs)
+        return call
+
+    for method in ('create', 'stream'):
+        monkeypatch.setattr(app.llm_backend, method, counting(method))
+    return calls
+
+
+def test_stream_fills_cache_and_replays_it(client, llm_calls):
+    body = {'prompt': 'Wyjaśnij fotosyntezę (stream)'}
+    first = _events(client.post('/get-explanation/stream', json=body, headers={'Authorization': 'Bearer u1'}))
+    assert [name for name, _ in first[:-1]] == ['token'] * (len(first) - 1)
+    done = first[-1]
+    assert done[0] == 'done'
+    assert done[1]['explanation'] == ''.join(data['text'] for _, data in first[:-1])
+    assert llm_calls == ['stream']
+
+    replay = _events(client.post('/get-explanation/stream', json=body, headers={'Authorization': 'Bearer u2'}))
+    assert replay == [('token', {'text': done[1]['explanation']}), done]
+    assert client.post('/get-explanation', json=body, headers={'Authorization': 'Bearer u3'}).get_json() == done[1]
+    assert llm_calls == ['stream']
+
+
+def test_prompt_validation(client, monkeypatch):
+    headers = {'Authorization': 'Bearer u1'}
+    assert client.post('/get-explanation/stream', json={}, headers=headers).status_code == 400
+    monkeypatch.setattr(app, 'EXPLANATION_MAX_PROMPT_CHARS', 10)
+    assert client.post('/get-explanation', json={'prompt': 'x' * 11}, headers=headers).status_code == 413
+
+
+def test_truncated_explanation_is_flagged(client, monkeypatch):
+    monkeypatch.setattr(app, 'EXPLANATION_MAX_TOKENS', 5)
+    result = client.post('/get-explanation', json={'prompt': 'Wyjaśnij krótko'},
+                         headers={'Authorization': 'Bearer u1'}).get_json()
+    assert result['truncated'] is True
+    assert len(result['explanation']) == 20
@@ -0,0 +1,86 @@
+import pytest
+
+import app
+
+
+def _tree():
+    return {'content': 'Temat', 'children': [{'content': 'A'}, {'content': 'B', 'children': [{'content': 'B1'}]}]}
+
+
+def test_apply_add_replace_remove():
+    tree = app.apply_json_patch(_tree(), [
+        {'op': 'add', 'path': '/children/-', 'value': {'content': 'C'}},
+        {'op': 'replace', 'path': '/children/0/content', 'value': 'A2'},
+        {'op': 'remove', 'path': '/children/1/children/0'},
+    ])
+    assert [child['content'] for child in tree['children']] == ['A2', 'B', 'C']
+    assert tree['children'][1]['children'] == []
+
+
+def test_apply_move_and_copy():
+    tree = app.apply_json_patch(_tree(), [
+        {'op': 'move', 'from': '/children/1/children/0', 'path': '/children/0'},
+        {'op': 'copy', 'from': '/children/0', 'path': '/children/-'},
+    ])
+    assert [child['content'] for child in tree['children']] == ['B1', 'A', 'B', 'B1']
+    assert tree['children'][0] is not tree['children'][3]
+
+
+def test_move_into_own_descendant_is_rejected():
+    with pytest.raises(app.JsonPatchError):
+        app.apply_json_patch(_tree(), [{'op': 'move', 'from': '/children/1', 'path': '/children/1/children/0'}])
+
+
+def test_failed_test_operation():
+    with pytest.raises(app.JsonPatchTestFailed):
+        app.apply_json_patch(_tree(), [{'op': 'test', 'path': '/children/0/content', 'value': 'X'}])
+
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'add', 'path': '/children/5', 'value': {'content': 'X'}},
+    {'op': 'remove', 'path': '/children/01'},
+    {'op': 'replace', 'path': 'children/0', 'value': {'content': 'X'}},
+    {'op': 'remove', 'path': ''},
+    {'op': 'frobnicate', 'path': '/children/0'},
+])
+def test_invalid_operations(operation):
+    with pytest.raises(app.JsonPatchError):
+        app.apply_json_patch(_tree(), [operation])
+
+
+def test_escaped_pointer_tokens():
+    document = app.apply_json_patch({'a/b': {'~': 1}}, [{'op': 'replace', 'path': '/a~1b/~0', 'value': 2}])
+    assert document == {'a/b': {'~': 2}}
+
+
+def test_patched_update_bumps_revision():
+    update = app._build_patched_update({'revision': 3, 'content': _tree(), 'mapData': _tree()},
+                                       [{'op': 'replace', 'path': '/content', 'value': 'Nowy'}], 3)
+    assert update['revision'] == 4
+    assert update['mapData']['content'] == 'Nowy'
+
+
+def test_stale_revision_conflicts():
+    with pytest.raises(app.RevisionConflict) as excinfo:
+        app._build_patched_update({'revision': 5, 'content': _tree()},
+                                  [{'op': 'replace', 'path': '/content', 'value': 'Nowy'}], 4)
+    assert excinfo.value.current_revision == 5
+
+
+def test_store_patch_conflict_leaves_map_unchanged():
+    store = app.MemoryMapStore()
+    map_id = store.add('user', {'revision': 0, **app.map_tree_fields(_tree())})
+    assert store.patch('user', map_id, [{'op': 'replace', 'path': '/content', 'value': 'v1'}], 0) == 1
+    with pytest.raises(app.RevisionConflict):
+        store.patch('user', map_id, [{'op': 'replace', 'path': '/content', 'value': 'v2'}], 0)
+    stored = store.get('user', map_id)
+    assert stored['revision'] == 1
+    assert app.extract_map_tree(stored)['content'] == 'v1'
+    assert store.patch('user', 'missing', [{'op': 'remove', 'path': '/children/0'}], None) is None
+
+
+def test_patch_cannot_grow_past_limits(monkeypatch):
+    monkeypatch.setattr(app, 'TREE_MAX_NODES', 3)
+    with pytest.raises(app.TreeValidationError):
+        app._build_patched_update({'revision': 0, 'content': _tree()},
+                                  [{'op': 'add', 'path': '/children/-', 'value': {'content': 'C'}}], None)
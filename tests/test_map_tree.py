@@ -0,0 +1,114 @@
+import zlib
+
+import msgpack
+import pytest
+
+import app
+
+
+def _chain(depth):
+    root = node = {'content': 'poziom 0'}
+    for level in range(1, depth + 1):
+        child = {'content': f'poziom {level}'}
+        node['children'] = [child]
+        node = child
+    return root
+
+
+def test_codec_round_trip():
+    tree = {'content': 'Zażółć 🧠', 'children': [{'content': 'x' * 5000}, {'content': 'b', 'children': []}]}
+    blob = app.encode_map_tree(tree)
+    assert blob[:3] == app.MAP_CODEC_MAGIC
+    assert len(blob) < len(msgpack.packb(tree, use_bin_type=True))
+    assert app.decode_map_tree(blob) == tree
+    assert app.decode_map_tree(bytearray(blob)) == tree
+
+
+def _blob(raw, version=None, length=None):
+    header = app.MAP_CODEC_HEADER.pack(app.MAP_CODEC_MAGIC, version or app.MAP_CODEC_VERSION,
+                                       len(raw) if length is None else length)
+    return header + zlib.compress(raw)
+
+
+@pytest.mark.parametrize('blob', [
+    b'FMT',
+    b'XYZ' + app.encode_map_tree({'content': 'a'})[3:],
+    _blob(msgpack.packb({'content': 'a'}), version=2),
+    _blob(msgpack.packb({'content': 'a'}), length=1),
+    _blob(msgpack.packb({'content': 'a'}))[:-2],
+])
+def test_codec_rejects_malformed_blobs(blob):
+    with pytest.raises(ValueError):
+        app.decode_map_tree(blob)
+
+
+def test_codec_rejects_oversized_payload(monkeypatch):
+    monkeypatch.setattr(app, 'MAP_CODEC_MAX_RAW_BYTES', 1024)
+    with pytest.raises(ValueError):
+        app.decode_map_tree(_blob(b'\0' * 4096))
+
+
+def test_normalize_converts_model_nodes():
+    tree = app.normalize_tree({'text': ' Temat ', 'emoji': '🧠', 'children': [
+        {'text': 'A', 'emoji': '🔥'}, {'content': 3}, 'goły tekst', 7, {'text': 'B', 'children': None}
+    ]}, emojis_enabled=True)
+    assert tree == {'content': '🧠 Temat', 'children': [
+        {'content': '🔥 A'}, {'content': '📌 3'}, {'content': '📌 goły tekst'}, {'content': '📌 B'}
+    ]}
+
+
+def test_lenient_mode_prunes_past_the_limits():
+    tree = app.normalize_tree(_chain(10), max_depth=3)
+    assert app.tree_extent(tree)[1] == 3
+    wide = app.normalize_tree({'content': 'T', 'children': [{'content': str(i)} for i in range(10)]}, max_nodes=4)
+    assert [child['content'] for child in wide['children']] == ['0', '1', '2']
+    assert app.normalize_tree({'content': 'x' * 50}, max_text_chars=10)['content'] == 'x' * 10
+
+
+@pytest.mark.parametrize('tree, limits, status', [
+    (_chain(4), {'max_depth': 3}, 413),
+    ({'content': 'T', 'children': [{'content': 'a'}, {'content': 'b'}]}, {'max_nodes': 2}, 413),
+    ({'content': 'x' * 11}, {'max_text_chars': 10}, 413),
+    ({'content': 'T', 'children': ['goły tekst']}, {}, 400),
+    ({'content': 'T', 'children': {'content': 'a'}}, {}, 400),
+    ({'content': ['a']}, {}, 400),
+    (['nie obiekt'], {}, 400),
+])
+def test_strict_mode_rejects(tree, limits, status):
+    with pytest.raises(app.TreeValidationError) as excinfo:
+        app.normalize_tree(tree, strict=True, **limits)
+    assert excinfo.value.status_code == status
+
+
+def test_deep_tree_does_not_recurse():
+    depth = 50000
+    tree = app.normalize_tree(_chain(depth), strict=True, max_depth=depth, max_nodes=depth + 1)
+    assert app.tree_extent(tree) == (depth + 1, depth, len(f'poziom {depth}'))
+
+
+def test_drop_empty_children():
+    tree = app.normalize_tree({'content': 'T', 'children': [{'content': ' '}, {'content': 'a'}]}, drop_empty=True)
+    assert tree['children'] == [{'content': 'a'}]
+
+
+def test_stored_limits_let_old_maps_shrink_but_not_grow(monkeypatch):
+    monkeypatch.setattr(app, 'TREE_MAX_DEPTH', 3)
+    monkeypatch.setattr(app, 'TREE_MAX_TEXT_CHARS', 10)
+    stored = {'content': 'x' * 20, 'children': [_chain(5)]}
+    limits = app.stored_tree_limits(stored)
+    assert limits['max_depth'] == 6
+    assert limits['max_text_chars'] == 20
+    app.normalize_tree({'content': 'x' * 20, 'children': [_chain(4)]}, strict=True, **limits)
+    with pytest.raises(app.TreeValidationError):
+        app.normalize_tree({'content': 'x' * 21}, strict=True, **limits)
+    with pytest.raises(app.TreeValidationError):
+        app.normalize_tree({'content': 'T', 'children': [_chain(6)]}, strict=True, **limits)
+
+
+def test_update_of_existing_map_uses_its_own_limits(client, monkeypatch):
+    headers = {'Authorization': 'Bearer tree-limits'}
+    map_id = client.post('/create-map', json={'title': 'Stara', 'content': _chain(6)}, headers=headers).get_json()['id']
+    monkeypatch.setattr(app, 'TREE_MAX_DEPTH', 3)
+    assert client.put(f'/update-map/{map_id}', json={'content': _chain(5)}, headers=headers).status_code == 200
+    assert client.put(f'/update-map/{map_id}', json={'content': _chain(7)}, headers=headers).status_code == 413
+    assert client.post('/create-map', json={'title': 'Nowa', 'content': _chain(5)}, headers=headers).status_code == 413
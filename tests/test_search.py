@@ -0,0 +1,85 @@
+import app
+
+
+def _index(*maps):
+    index = app.UserSearchIndex()
+    for map_id, tree in maps:
+        index.add_map(map_id, map_id.upper(), tree)
+    return index
+
+
+def _search(index, query, limit=10):
+    return index.search(list(dict.fromkeys(app.search_tokens(query))), limit)
+
+
+def test_tokens_fold_case_and_diacritics():
+    assert app.search_tokens('Źródło ŁÓDŹ, straße') == ['zrodlo', 'lodz', 'strasse']
+
+
+def test_maps_matching_more_terms_rank_first():
+    index = _index(
+        ('a', {'content': 'Fotosynteza', 'children': [{'content': 'fotosynteza fotosynteza fotosynteza'}]}),
+        ('b', {'content': 'Fotosynteza i chlorofil'}),
+    )
+    total, results = _search(index, 'fotosynteza chlorofil')
+    assert total == 2
+    assert [result['id'] for result in results] == ['b', 'a']
+    assert results[0]['matchedTerms'] == 2
+
+
+def test_rare_terms_and_short_nodes_score_higher():
+    index = _index(
+        ('a', {'content': 'wspólne rzadkie'}),
+        ('b', {'content': 'wspólne', 'children': [{'content': 'wspólne słowo w bardzo długim węźle opisowym rzadkie'}]}),
+        ('c', {'content': 'wspólne'}),
+    )
+    _, results = _search(index, 'rzadkie')
+    assert [result['id'] for result in results] == ['a', 'b']
+    assert results[0]['score'] > results[1]['score']
+
+
+def test_matches_report_path_and_pointer():
+    index = _index(('m', {'content': 'Temat', 'children': [{'content': 'A'}, {'content': 'B', 'children': [{'content': 'Cel'}]}]}))
+    _, [result] = _search(index, 'cel')
+    assert result['matches'] == [{'text': 'Cel', 'path': ['Temat', 'B', 'Cel'], 'pointer': '/children/1/children/0',
+                                  'score': result['score']}]
+
+
+def test_replacing_and_removing_a_map_updates_postings():
+    index = _index(('m', {'content': 'stare słowo'}), ('n', {'content': 'słowo'}))
+    index.add_map('m', 'M', {'content': 'nowe'})
+    assert _search(index, 'stare') == (0, [])
+    assert index.doc_freq['slowo'] == 1
+    index.remove_map('n')
+    assert 'slowo' not in index.postings
+    assert (index.node_count, index.token_count) == (1, 1)
+    assert _search(index, 'nowe')[0] == 1
+
+
+def test_limit_and_total():
+    index = _index(*((f'm{i}', {'content': f'wspólne {i}'}) for i in range(5)))
+    total, results = _search(index, 'wspólne', limit=2)
+    assert total == 5
+    assert len(results) == 2
+
+
+def test_write_during_build_is_not_lost(client, monkeypatch):
+    headers = {'Authorization': 'Bearer search-race'}
+    map_id = client.post('/create-map', json={'title': 'Mapa', 'content': {'content': 'Alfa'}},
+                         headers=headers).get_json()['id']
+    build = app.search_index._build
+    writes = []
+
+    def build_with_concurrent_write(user_id):
+        index = build(user_id)
+        if not writes:
+            # Zapis trafia do bazy już po odczycie map przez budowany indeks
+            writes.append(client.put(f'/update-map/{map_id}', json={'content': {'content': 'Beta'}}, headers=headers))
+        return index
+
+    monkeypatch.setattr(app.search_index, '_build', build_with_concurrent_write)
+    discarded = app.search_index.discarded_builds
+    results = client.get('/search?q=beta', headers=headers).get_json()['results']
+    assert writes[0].status_code == 200
+    assert [result['id'] for result in results] == [map_id]
+    assert app.search_index.discarded_builds == discarded + 1
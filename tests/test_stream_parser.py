@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import app
+
+MAP = {'content': 'Temat', 'children': [
+    {'content': 'A "cytat" \\ ł', 'children': [{'content': 'A1', 'weight': -1.5e2}]},
+    {'content': 'B', 'done': True, 'note': None},
+]}
+
+
+def _feed(parser, text, size):
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    root, tail = parser.close()
+    return root, events + tail
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 10000])
+def test_chunking_does_not_change_result(size):
+    text = json.dumps(MAP, ensure_ascii=False, indent=2)
+    root, events = _feed(app.IncrementalTreeParser(), text, size)
+    assert root == MAP
+    assert [(path, node['content']) for path, node in events] == [
+        ([], 'Temat'), ([0], 'A "cytat" \\ ł'), ([0, 0], 'A1'), ([1], 'B')
+    ]
+
+
+def test_node_is_reported_when_its_children_open():
+    parser = app.IncrementalTreeParser()
+    assert parser.feed('{"content": "Temat", "children": [') == [([], {'content': 'Temat', 'children': []})]
+    assert parser.feed('{"content": "A"') == []
+    assert [path for path, _ in parser.feed('}')] == [[0]]
+
+
+def test_expansion_mode_reports_only_list_items():
+    text = json.dumps({'nodes': [{'text': 'X', 'emoji': '🔥'}, {'text': 'Y', 'children': [{'text': 'Y1'}]}]})
+    root, events = _feed(app.IncrementalTreeParser(root_is_node=False), text, 3)
+    assert root['nodes'][1]['children'][0] == {'text': 'Y1'}
+    assert [(path, node['text']) for path, node in events] == [([0], 'X'), ([1], 'Y'), ([1, 0], 'Y1')]
+
+
+def test_other_lists_are_not_nodes():
+    root, events = _feed(app.IncrementalTreeParser(), '{"content": "T", "tags": [{"content": "nie węzeł"}]}', 4)
+    assert [path for path, _ in events] == [[]]
+
+
+def test_number_split_across_chunks():
+    parser = app.IncrementalTreeParser()
+    parser.feed('{"content": "T", "weight": 12')
+    parser.feed('34}')
+    root, _ = parser.close()
+    assert root['weight'] == 1234
+
+
+@pytest.mark.parametrize('text', ['{"content": "T", "children": [', '{"content": "T', '', '{"a": 1} x'])
+def test_incomplete_document_fails_on_close(text):
+    parser = app.IncrementalTreeParser()
+    parser.feed(text)
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_unexpected_token_raises():
+    with pytest.raises(ValueError):
+        app.IncrementalTreeParser().feed('{"content": nope, ')